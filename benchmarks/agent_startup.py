@@ -0,0 +1,187 @@
+"""Benchmark the import time and startup time of the OCS Agents.
+
+Each Agent module listed in :mod:`ocs.plugin` is imported in a fresh
+interpreter with ``python -X importtime``, and the total import time is
+reported along with the imports that took the most time themselves. In
+another fresh interpreter, the time to import the module and construct an
+OCSAgent, which is everything an Agent does before connecting to crossbar, is
+reported.
+
+Optionally, Agent instances from a site config file are launched with
+``ocs-agent-cli``, and the time until the Agent has joined the crossbar realm
+is reported. This requires a crossbar server to be running, e.g. the one
+started for the integration tests.
+
+Examples::
+
+    # Import and construction time of every Agent
+    python benchmarks/agent_startup.py
+
+    # Also time startup of two Agents, against the test crossbar server
+    python benchmarks/agent_startup.py --site-file tests/default.yaml \\
+        --instance-id fake-data-local aggregator-local
+
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from ocs.plugin import agents
+
+
+def parse_importtime(stderr):
+    """Parse the output of ``python -X importtime``.
+
+    Returns:
+        list: (module, self time, cumulative time) tuples, with times in
+        seconds, in the order the imports finished.
+
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        imports.append((module.strip(), int(self_us) * 1e-6,
+                        int(cumulative_us) * 1e-6))
+    return imports
+
+
+def time_import(module, top=5):
+    """Import a module in a new interpreter and time it.
+
+    Args:
+        module (str): Name of the module to import.
+        top (int): Number of the slowest imports to report.
+
+    Returns:
+        dict: Wall time of the interpreter, cumulative import time of the
+        module, and the slowest imports by self time, in seconds.
+
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           f'import {module}'],
+                          capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    imports = parse_importtime(proc.stderr)
+    cumulative = next(c for m, s, c in imports if m == module)
+    slowest = sorted(imports, key=lambda i: i[1], reverse=True)[:top]
+    return {'wall_s': round(wall, 3),
+            'import_s': round(cumulative, 3),
+            'slowest': {m: round(s, 3) for m, s, c in slowest}}
+
+
+#: Run in a new interpreter to time constructing an OCSAgent.
+CONSTRUCT_SCRIPT = """
+import argparse, json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+imported = time.perf_counter()
+from autobahn.wamp.types import ComponentConfig
+from ocs.ocs_agent import OCSAgent
+site_args = argparse.Namespace(instance_id='bench', access_policy=None,
+                               address_root='observatory',
+                               working_dir='./', log_dir=None)
+OCSAgent(ComponentConfig('test_realm', {}), site_args,
+         address='observatory.bench')
+constructed = time.perf_counter()
+print(json.dumps([imported - start, constructed - start]))
+"""
+
+
+def time_construction(module):
+    """Import a module and construct an OCSAgent in a new interpreter.
+
+    Args:
+        module (str): Name of the Agent module to import.
+
+    Returns:
+        dict: Time in seconds to import the module, and to import it and
+        construct the OCSAgent.
+
+    """
+    proc = subprocess.run([sys.executable, '-c', CONSTRUCT_SCRIPT, module],
+                          capture_output=True, text=True, check=True)
+    imported, constructed = json.loads(proc.stdout.splitlines()[-1])
+    return {'import_s': round(imported, 3),
+            'constructed_s': round(constructed, 3)}
+
+
+def time_startup(site_file, instance_id, timeout):
+    """Launch an Agent and time how long it takes to join the realm.
+
+    Args:
+        site_file (str): Path to the site config file.
+        instance_id (str): instance-id of the Agent to launch.
+        timeout (float): Time in seconds to wait for the Agent to join.
+
+    Returns:
+        float: Time in seconds from launch until the Agent logged that its
+        session joined, or None if it didn't within the timeout.
+
+    """
+    env = dict(os.environ, LOGLEVEL='info', PYTHONUNBUFFERED='1')
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'ocs.agent_cli',
+                             '--site-file', site_file,
+                             '--instance-id', instance_id],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, env=env)
+    joined = threading.Event()
+    elapsed = []
+
+    def _watch():
+        for line in proc.stdout:
+            if 'session joined' in line:
+                elapsed.append(time.perf_counter() - start)
+                joined.set()
+                return
+
+    threading.Thread(target=_watch, daemon=True).start()
+    joined.wait(timeout)
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    return round(elapsed[0], 3) if elapsed else None
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--agent', nargs='+', default=list(agents),
+                        help="Agent classes to time the import of.")
+    parser.add_argument('--top', type=int, default=5,
+                        help="Number of the slowest imports to report.")
+    parser.add_argument('--site-file',
+                        help="Site config file of the Agents to launch.")
+    parser.add_argument('--instance-id', nargs='*', default=[],
+                        help="instance-ids of the Agents to launch.")
+    parser.add_argument('--timeout', type=float, default=30.,
+                        help="Time in seconds to wait for each Agent to join.")
+    return parser
+
+
+def main(args=None):
+    args = make_parser().parse_args(args)
+    if args.instance_id and args.site_file is None:
+        raise ValueError('--site-file is required to launch Agents.')
+
+    results = {'import': {}, 'construct': {}, 'startup': {}}
+    for agent_class in args.agent:
+        module = agents[agent_class]['module']
+        results['import'][agent_class] = time_import(module, top=args.top)
+        results['construct'][agent_class] = time_construction(module)
+    for instance_id in args.instance_id:
+        results['startup'][instance_id] = time_startup(
+            args.site_file, instance_id, args.timeout)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
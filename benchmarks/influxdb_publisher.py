@@ -0,0 +1,192 @@
+"""Benchmark the InfluxDB Publishers against a local InfluxDB stand-in.
+
+The stand-in (:class:`ocs.testing.FakeInfluxDB`) runs in a separate process so
+its CPU use is not counted against the publisher. A backlog of synthetic feed
+messages is queued up front, and the publisher run loop is timed until the
+backlog has been drained and written. Optionally, new messages keep arriving
+at a fixed rate while the publisher runs.
+
+Examples::
+
+    # v1 publisher, 10k messages of 10 fields x 10 samples
+    python benchmarks/influxdb_publisher.py --messages 10000
+
+    # v2 publisher with 50 ms write latency and a 5 s outage after 2 s
+    python benchmarks/influxdb_publisher.py --publisher v2 --latency 0.05 \\
+        --outage 2 7
+
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import time
+import tracemalloc
+import urllib.request
+
+from ocs.testing import FakeInfluxDB
+
+
+def _serve(port_queue, kwargs):
+    server = FakeInfluxDB(store_lines=False, **kwargs)
+    server.databases.add('ocs_feeds')
+    server.buckets.add('ocs_feeds')
+    port_queue.put(server.port)
+    server.serve_forever()
+
+
+def _get_stats(url):
+    with urllib.request.urlopen(f"{url}/_stats") as resp:
+        return json.loads(resp.read())
+
+
+def make_message(i, n_fields, n_samples, t0):
+    """Make a (data, feed) pair like those passed to the publisher."""
+    timestamps = [t0 + i * n_samples + j for j in range(n_samples)]
+    data = {'block': {'block_name': 'block',
+                      'timestamps': timestamps,
+                      'data': {f'field_{k}': [float(i + j + k) for j in range(n_samples)]
+                               for k in range(n_fields)}}}
+    feed = {'agent_address': f'observatory.bench{i % 10}',
+            'agg_params': {},
+            'feed_name': 'bench',
+            'address': f'observatory.bench{i % 10}.feeds.bench',
+            'record': True,
+            'session_id': '0'}
+    return data, feed
+
+
+def make_publisher(args, incoming_data, url, port):
+    if args.publisher == 'v1':
+        from ocs.agents.influxdb_publisher.drivers import Publisher
+        return Publisher('localhost', 'ocs_feeds', incoming_data,
+                         port=port, protocol=args.protocol, gzip=args.gzip)
+
+    from ocs.agents.influxdb_publisher_v2.drivers import Publisher
+    os.environ['INFLUXDB_V2_URL'] = url
+    os.environ['INFLUXDB_V2_ORG'] = 'ocs'
+    os.environ['INFLUXDB_V2_BUCKET'] = 'ocs_feeds'
+    os.environ['INFLUXDB_V2_TOKEN'] = 'token'
+    os.environ['INFLUXDB_V2_ENABLE_GZIP'] = str(args.gzip).lower()
+    return Publisher(incoming_data, protocol=args.protocol, gzip=args.gzip)
+
+
+def run(args):
+    kwargs = {'latency': args.latency,
+              'error_rate': args.error_rate,
+              'outages': [tuple(args.outage)] if args.outage else None,
+              'seed': 0}
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(port_queue, kwargs),
+                                     daemon=True)
+    server.start()
+    port = port_queue.get(timeout=10)
+    url = f"http://localhost:{port}"
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    incoming_data = queue.Queue()
+    t0 = 1.7e9
+    for i in range(args.messages):
+        incoming_data.put(make_message(i, args.fields, args.samples, t0))
+    n_messages = args.messages
+
+    publisher = make_publisher(args, incoming_data, url, port)
+
+    rusage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    next_message = start
+    while True:
+        if time.perf_counter() - start < args.duration:
+            # Keep messages arriving at a fixed rate while running
+            while args.rate and next_message <= time.perf_counter():
+                incoming_data.put(make_message(n_messages, args.fields,
+                                               args.samples, t0))
+                n_messages += 1
+                next_message += 1 / args.rate
+        elif incoming_data.empty():
+            break
+        publisher.run()
+        time.sleep(args.loop_time)
+
+    if args.publisher == 'v2':
+        publisher.close()
+    else:
+        publisher.close(timeout=60)
+
+    # Wait for in-flight writes to land, timing up to the last one
+    expected = n_messages * args.samples
+    stats = _get_stats(url)
+    last_change = time.perf_counter()
+    while stats['lines'] < expected and time.perf_counter() - last_change < 1:
+        time.sleep(0.05)
+        new_stats = _get_stats(url)
+        if new_stats['lines'] != stats['lines']:
+            last_change = time.perf_counter()
+        stats = new_stats
+    elapsed = min(last_change, time.perf_counter()) - start
+    rusage_end = resource.getrusage(resource.RUSAGE_SELF)
+    server.terminate()
+
+    cpu = ((rusage_end.ru_utime - rusage_start.ru_utime)
+           + (rusage_end.ru_stime - rusage_start.ru_stime))
+    results = {
+        'publisher': args.publisher,
+        'protocol': args.protocol,
+        'messages': n_messages,
+        'lines_expected': expected,
+        'lines_written': stats['lines'],
+        'write_requests': stats['write_requests'],
+        'failed_requests': stats['failed_requests'],
+        'bytes_written': stats['bytes'],
+        'elapsed_s': round(elapsed, 3),
+        'lines_per_s': round(stats['lines'] / elapsed, 1),
+        'cpu_s': round(cpu, 3),
+        'max_rss_mb': round(rusage_end.ru_maxrss / 1024, 1),
+    }
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        results['traced_peak_mb'] = round(peak / 1024**2, 1)
+
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--publisher', choices=['v1', 'v2'], default='v1')
+    parser.add_argument('--protocol', choices=['line', 'json'], default='line')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help="Number of messages queued before starting.")
+    parser.add_argument('--fields', type=int, default=10,
+                        help="Number of fields per message.")
+    parser.add_argument('--samples', type=int, default=10,
+                        help="Number of samples per field per message.")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Messages per second added while running.")
+    parser.add_argument('--duration', type=float, default=0,
+                        help="Time in seconds to keep adding messages.")
+    parser.add_argument('--loop-time', type=float, default=0.,
+                        help="Sleep between publisher run loop iterations.")
+    parser.add_argument('--latency', type=float, default=0.,
+                        help="Latency in seconds added to each request.")
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help="Fraction of write requests that fail.")
+    parser.add_argument('--outage', type=float, nargs=2, metavar=('START', 'STOP'),
+                        help="Outage window in seconds after server start.")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Report the tracemalloc peak. Slows the benchmark.")
+    return parser
+
+
+def main(args=None):
+    args = make_parser().parse_args(args)
+    results = run(args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Benchmark Operation start latency for each way of running an Operation.
+
+An OCSAgent is created without connecting to crossbar, and Tasks of each
+kind are registered: a blocking function run in a worker thread, an
+``inlineCallbacks`` generator run in the reactor, and an ``async def``
+coroutine run as an asyncio Task. Each Task is started repeatedly, timing the
+delay from the start request to the Task body running, and to the session
+being marked done.
+
+Optionally, a number of other blocking Tasks are kept running in the
+background, to show the effect of a busy thread pool.
+
+Examples::
+
+    python benchmarks/op_start_latency.py --iterations 1000
+
+    # With 9 of the 10 threads in the pool kept busy
+    python benchmarks/op_start_latency.py --busy-threads 9
+
+"""
+from ocs.ocs_twisted import install_asyncio_reactor
+install_asyncio_reactor()
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+
+import numpy as np  # noqa: E402
+import txaio  # noqa: E402
+from autobahn.wamp.types import ComponentConfig  # noqa: E402
+from twisted.internet import reactor  # noqa: E402
+from twisted.internet.defer import inlineCallbacks  # noqa: E402
+
+from ocs.ocs_agent import OCSAgent  # noqa: E402
+
+txaio.use_twisted()
+
+MODES = ['blocking', 'reactor', 'coroutine']
+
+
+class LatencyAgent:
+    """Tasks that record when their body starts running."""
+
+    def __init__(self, agent):
+        self.started = None
+        self.release = threading.Event()
+        agent.register_task('blocking', self.blocking)
+        agent.register_task('reactor', self.in_reactor, blocking=False)
+        agent.register_task('coroutine', self.coroutine)
+
+    def blocking(self, session, params):
+        self.started = time.perf_counter()
+        return True, 'Done.'
+
+    @inlineCallbacks
+    def in_reactor(self, session, params):
+        self.started = time.perf_counter()
+        yield
+        return True, 'Done.'
+
+    async def coroutine(self, session, params):
+        self.started = time.perf_counter()
+        await asyncio.sleep(0)
+        return True, 'Done.'
+
+    def busy(self, session, params):
+        self.release.wait()
+        return True, 'Done.'
+
+
+def make_agent(args):
+    site_args = argparse.Namespace(instance_id='latency', access_policy=None,
+                                   thread_pool_size=args.thread_pool_size,
+                                   session_feed_interval=None,
+                                   working_dir='./', log_dir=None)
+    return OCSAgent(ComponentConfig('test_realm', {}), site_args,
+                    address='observatory.latency')
+
+
+def summarize(values):
+    values = np.array(values) * 1e6
+    return {'median_us': round(float(np.median(values)), 1),
+            'p90_us': round(float(np.percentile(values, 90)), 1),
+            'max_us': round(float(values.max()), 1)}
+
+
+@inlineCallbacks
+def run(args, results):
+    agent = make_agent(args)
+    agent.log = txaio.make_logger()
+    txaio.set_global_log_level('warn')
+    ops = LatencyAgent(agent)
+    for i in range(args.busy_threads):
+        agent.register_task(f'busy{i}', ops.busy)
+        agent.start(f'busy{i}')
+
+    try:
+        for mode in MODES:
+            to_start, to_done = [], []
+            for _ in range(args.iterations):
+                t0 = time.perf_counter()
+                agent.start(mode)
+                yield agent.wait(mode, timeout=10)
+                t1 = time.perf_counter()
+                to_start.append(ops.started - t0)
+                to_done.append(t1 - t0)
+            results[mode] = {'start': summarize(to_start),
+                             'done': summarize(to_done)}
+    finally:
+        ops.release.set()
+        reactor.stop()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=200,
+                        help="Number of times each Task is started.")
+    parser.add_argument('--busy-threads', type=int, default=0,
+                        help="Number of blocking Tasks kept running in the "
+                             "background. Must be less than the thread pool "
+                             "size.")
+    parser.add_argument('--thread-pool-size', type=int, default=10,
+                        help="Number of threads in the Agent's thread pool.")
+    return parser
+
+
+def main(args=None):
+    args = make_parser().parse_args(args)
+    if args.busy_threads >= args.thread_pool_size:
+        raise ValueError('--busy-threads must be less than --thread-pool-size.')
+    results = {'iterations': args.iterations,
+               'busy_threads': args.busy_threads}
+    reactor.callWhenRunning(run, args, results)
+    reactor.run()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Benchmark the cost of @param validation when starting an Operation.
+
+Two things are measured. First, the time to validate a params dict alone,
+using :class:`ocs.ocs_agent.ParamHandler` as was done on every start request
+before, and using the validator compiled by
+:func:`ocs.ocs_agent.compile_params` at registration. Second, the round-trip
+latency of ``OCSAgent.start()`` for a reactor Task with no @param decorators,
+one that accepts no params, and one with several params, timing both the
+``start()`` call itself, where params are checked, and the delay until the
+session is done.
+
+An OCSAgent is created without connecting to crossbar.
+
+Examples::
+
+    python benchmarks/param_validation.py
+
+    python benchmarks/param_validation.py --iterations 10000
+
+"""
+import argparse
+import json
+import time
+import timeit
+
+import numpy as np
+import txaio
+from autobahn.wamp.types import ComponentConfig
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from ocs.ocs_agent import OCSAgent, ParamHandler, compile_params, param
+
+txaio.use_twisted()
+
+#: Params passed to the 'setpoint' Task.
+SETPOINT_PARAMS = {'heater': 'main', 'setpoint': 1.5, 'ramp': 0.1,
+                   'channels': [1, 2], 'wait': True}
+
+
+def no_params(session, params):
+    return True, 'Done.'
+
+
+@param('_')
+def empty_params(session, params):
+    return True, 'Done.'
+
+
+@param('heater', choices=['main', 'aux'])
+@param('setpoint', type=float, check=lambda x: 0 <= x <= 10)
+@param('ramp', default=None, type=float)
+@param('channels', default=None, type=tuple)
+@param('wait', default=False, type=bool)
+def setpoint(session, params):
+    return True, 'Done.'
+
+
+#: Task name, function and params for each case.
+CASES = [('no_params', no_params, None),
+         ('empty_params', empty_params, {}),
+         ('setpoint', setpoint, SETPOINT_PARAMS)]
+
+
+def make_agent():
+    site_args = argparse.Namespace(instance_id='params', access_policy=None,
+                                   thread_pool_size=None,
+                                   session_feed_interval=None,
+                                   reactor_lag_interval=None,
+                                   working_dir='./', log_dir=None)
+    return OCSAgent(ComponentConfig('test_realm', {}), site_args,
+                    address='observatory.params')
+
+
+def summarize(values):
+    values = np.array(values) * 1e6
+    return {'median_us': round(float(np.median(values)), 2),
+            'p90_us': round(float(np.percentile(values, 90)), 2),
+            'max_us': round(float(values.max()), 2)}
+
+
+def time_validation(iterations):
+    """Time validation of SETPOINT_PARAMS alone, per call."""
+    instructions = setpoint._ocs_prescreen
+    validator = compile_params(instructions)
+    handler = timeit.timeit(
+        lambda: ParamHandler(SETPOINT_PARAMS).batch(instructions),
+        number=iterations)
+    compiled = timeit.timeit(lambda: validator(SETPOINT_PARAMS),
+                             number=iterations)
+    return {'param_handler_us': round(handler / iterations * 1e6, 3),
+            'compiled_us': round(compiled / iterations * 1e6, 3)}
+
+
+@inlineCallbacks
+def run(args, results):
+    agent = make_agent()
+    agent.log = txaio.make_logger()
+    txaio.set_global_log_level('warn')
+    for name, func, _ in CASES:
+        agent.register_task(name, func, blocking=False)
+
+    try:
+        for name, _, params in CASES:
+            in_start, to_done = [], []
+            for _ in range(args.iterations):
+                t0 = time.perf_counter()
+                agent.start(name, params=params)
+                t1 = time.perf_counter()
+                yield agent.wait(name, timeout=10)
+                t2 = time.perf_counter()
+                in_start.append(t1 - t0)
+                to_done.append(t2 - t0)
+            results['start'][name] = {'start_call': summarize(in_start),
+                                      'done': summarize(to_done)}
+    finally:
+        reactor.stop()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help="Number of times each Task is started.")
+    parser.add_argument('--validations', type=int, default=100000,
+                        help="Number of times params are validated alone.")
+    return parser
+
+
+def main(args=None):
+    args = make_parser().parse_args(args)
+    results = {'iterations': args.iterations,
+               'validation': time_validation(args.validations),
+               'start': {}}
+    reactor.callWhenRunning(run, args, results)
+    reactor.run()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,18 +5,19 @@ from . import site_config  # noqa: F401
 # Define the variable '__version__':
 # This has the closest behavior to versioneer that I could find
 # https://github.com/maresb/hatch-vcs-footgun-example
-try:
-    # If setuptools_scm is installed (e.g. in a development environment with
-    # an editable install), then use it to determine the version dynamically.
-    from setuptools_scm import get_version
-
-    # This will fail with LookupError if the package is not installed in
-    # editable mode or if Git is not installed.
-    __version__ = get_version(root="..", relative_to=__file__, version_scheme="no-guess-dev")
-except (ImportError, LookupError):
-    # As a fallback, use the version that is hard-coded in the file.
+# It is computed on first access, since setuptools_scm is slow to import and
+# runs git, which would otherwise slow down every import of ocs.
+
+
+def _installed_version():
+    """Return the version written to ocs/_version.py at install time.  This
+    is fast, but may be stale in an editable install; use it where the
+    cost of running setuptools_scm matters, e.g. on Agent startup.
+
+    """
     try:
-        from ocs._version import __version__  # noqa: F401
+        from ocs._version import __version__
+        return __version__
     except ModuleNotFoundError:
         # The user is probably trying to run this without having installed
         # the package, so complain.
@@ -24,3 +25,25 @@ except (ImportError, LookupError):
             "ocs is not correctly installed. "
             "Please install it with pip."
         )
+
+
+def _get_version():
+    try:
+        # If setuptools_scm is installed (e.g. in a development environment with
+        # an editable install), then use it to determine the version dynamically.
+        from setuptools_scm import get_version
+
+        # This will fail with LookupError if the package is not installed in
+        # editable mode or if Git is not installed.
+        return get_version(root="..", relative_to=__file__, version_scheme="no-guess-dev")
+    except (ImportError, LookupError):
+        # As a fallback, use the version that is hard-coded in the file.
+        return _installed_version()
+
+
+def __getattr__(name):
+    if name == '__version__':
+        global __version__
+        __version__ = _get_version()
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -9,8 +9,6 @@ from os import environ
 from ocs import ocs_agent, site_config
 from ocs.base import OpCode
 
-from ocs.agents.aggregator.drivers import Aggregator
-
 # For logging
 txaio.use_twisted()
 LOG = txaio.make_logger()
@@ -110,6 +108,9 @@ class AggregatorAgent:
                          "last_block_received": "temps"}}}
 
         """
+        # Imported here, as so3g is slow to import
+        from ocs.agents.aggregator.drivers import Aggregator
+
         self.aggregate = True
 
         try:
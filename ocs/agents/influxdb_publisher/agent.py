@@ -8,7 +8,7 @@ from os import environ
 from ocs import ocs_agent, site_config
 from ocs.base import OpCode
 
-from ocs.agents.influxdb_publisher.drivers import Publisher
+from ocs.common.influxdb_drivers import FieldFilter, WindowAggregator
 
 # For logging
 txaio.use_twisted()
@@ -91,25 +91,37 @@ class InfluxDBAgent:
 
                 >>> response.session['data']
                 {'connected': True,
+                 'backends': {'influxdb:8086/ocs_feeds': {'connected': True,
+                                                         'alive': True,
+                                                         'queued_batches': 0,
+                                                         'dropped_batches': 0,
+                                                         'last_error': None}},
                  'last_updated': 1774389203.53926}
 
         """
+        # Imported here, as the influxdb client is slow to import
+        from ocs.agents.influxdb_publisher.drivers import (Publisher,
+                                                           parse_backend_url)
+
         self.aggregate = True
 
         self.log.debug("Instatiating Publisher class")
-        try:
-            publisher = Publisher(self.args.host,
-                                  self.args.database,
-                                  self.incoming_data,
-                                  port=self.args.port,
-                                  protocol=self.args.protocol,
-                                  ssl=self.args.ssl,
-                                  verify_ssl=self.args.verify_ssl,
-                                  gzip=self.args.gzip,
-                                  operate_callback=lambda: self.aggregate,
-                                  )
-        except ConnectionError:
-            return False, "Failed to connect to InfluxDB"
+        publisher = Publisher(self.args.host,
+                              self.args.database,
+                              self.incoming_data,
+                              port=self.args.port,
+                              protocol=self.args.protocol,
+                              ssl=self.args.ssl,
+                              verify_ssl=self.args.verify_ssl,
+                              gzip=self.args.gzip,
+                              precision=self.args.precision,
+                              extra_backends=[parse_backend_url(url) for url
+                                              in self.args.extra_backends],
+                              max_queued_batches=self.args.max_queued_batches,
+                              field_filter=self._create_field_filter(),
+                              downsampler=self._create_downsampler(),
+                              downsample_retention_policy=self.args.downsample_retention_policy,
+                              )
 
         while self.aggregate:
             time.sleep(self.loop_time)
@@ -122,6 +134,7 @@ class InfluxDBAgent:
                 session.degraded = False
 
             data = {"connected": publisher.connected,
+                    "backends": publisher.backend_status(),
                     "last_updated": time.time()}
             session.data.update(data)
 
@@ -132,6 +145,22 @@ class InfluxDBAgent:
 
         return True, "Aggregation has ended"
 
+    def _create_field_filter(self):
+        filter_config = self.args.filter_config
+        if filter_config:
+            self.log.info(f"Loading field filter rules from {filter_config}")
+            return FieldFilter.from_file(filter_config)
+        return FieldFilter()
+
+    def _create_downsampler(self):
+        if self.args.downsample_window is None:
+            return None
+        self.log.info("Downsampling enabled with "
+                      + f"{self.args.downsample_window} s windows")
+        return WindowAggregator(
+            self.args.downsample_window,
+            measurement_suffix=self.args.downsample_measurement_suffix)
+
     def _stop_record(self, session, params):
         if OpCode(session.op_code) in [OpCode.STARTING, OpCode.RUNNING]:
             session.set_status('stopping')
@@ -178,6 +207,49 @@ def make_parser(parser=None):
                         type=bool,
                         default=False,
                         help="Use gzip content encoding to compress requests.")
+    pgroup.add_argument('--extra-backend',
+                        dest='extra_backends',
+                        action='append',
+                        default=[],
+                        help="Additional InfluxDB instance to write to, given "
+                             "as http[s]://<host>[:<port>]/<database>. Can be "
+                             "repeated. Data is encoded once and written to "
+                             "each backend independently.")
+    pgroup.add_argument('--max-queued-batches',
+                        type=int,
+                        default=300,
+                        help="Maximum number of batches queued per backend "
+                             "while it is slow or unreachable, before the "
+                             "oldest are dropped.")
+    pgroup.add_argument('--precision',
+                        default='ns',
+                        choices=['s', 'ms', 'us', 'ns'],
+                        help="Precision of timestamps written to InfluxDB. "
+                             "Coarser precision reduces payload size and "
+                             "improves compression for slowly sampled data.")
+    pgroup.add_argument('--filter-config',
+                        default=None,
+                        help="Path to a YAML file containing a list of field "
+                             "filter rules, used to drop redundant samples of "
+                             "slowly changing fields. Rules in feed agg_params "
+                             "are applied regardless of this option.")
+    pgroup.add_argument('--downsample-window',
+                        type=float,
+                        default=None,
+                        help="Length in seconds of wall-clock aligned windows "
+                             "over which min/max/mean/count of each numeric "
+                             "field are computed and written in addition to "
+                             "the full rate data. Disabled if not set.")
+    pgroup.add_argument('--downsample-measurement-suffix',
+                        default='_ds',
+                        help="Suffix appended to the measurement name of "
+                             "downsampled data, so it is kept apart from the "
+                             "full rate data.")
+    pgroup.add_argument('--downsample-retention-policy',
+                        default=None,
+                        help="Retention policy to write downsampled data to. Must already exist. "
+                             "Defaults to the database's default retention "
+                             "policy.")
 
     return parser
 
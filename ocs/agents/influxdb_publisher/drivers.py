@@ -1,7 +1,9 @@
 import os
-import time
+import threading
 
+from collections import deque
 from dataclasses import dataclass, asdict
+from urllib.parse import urlparse
 
 import txaio
 
@@ -9,7 +11,8 @@ from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 from requests.exceptions import ConnectionError as RequestsConnectionError
 
-from ocs.common.influxdb_drivers import format_data
+from ocs.common.influxdb_drivers import (V1_PRECISIONS, PayloadAssembler,
+                                         format_data)
 
 # For logging
 txaio.use_twisted()
@@ -65,6 +68,344 @@ class _InfluxDBClientArgs:
     gzip: bool
 
 
+def parse_backend_url(url):
+    """Parse an InfluxDB backend URL into Publisher backend arguments.
+
+    URLs take the form ``http[s]://<host>[:<port>]/<database>``, for example
+    ``https://influxdb.example.org:8086/ocs_feeds``. The port defaults to
+    8086. SSL is enabled, with certificate verification, for https URLs.
+
+    Args:
+        url (str): Backend URL.
+
+    Returns:
+        dict: host, port, database, ssl and verify_ssl keys.
+
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError(f"Invalid InfluxDB backend URL: {url}")
+    database = parsed.path.strip('/')
+    if not database:
+        raise ValueError(f"No database given in InfluxDB backend URL: {url}")
+    ssl = parsed.scheme == 'https'
+    return {'host': parsed.hostname,
+            'port': parsed.port or 8086,
+            'database': database,
+            'ssl': ssl,
+            'verify_ssl': ssl}
+
+
+# Outcomes of a single write attempt by a Backend
+_WRITE_OK = 'ok'
+_WRITE_RETRY = 'retry'
+_WRITE_DROP = 'drop'
+
+
+class Backend:
+    """A single InfluxDB instance that the Publisher writes to.
+
+    Each backend has its own queue of batches, written by a dedicated thread,
+    so a slow or unreachable backend does not hold up writes to the others.
+    The thread first waits for InfluxDB to become reachable, creating the
+    database if it does not exist, while batches are queued.
+    Batches that fail due to connection or server errors, or any unexpected
+    error, are retried, with exponential backoff, until they succeed. Batches
+    rejected by InfluxDB (client errors) are dropped. If the queue grows past
+    ``max_queued_batches`` the oldest queued batches are dropped.
+
+    Args:
+        client_args (_InfluxDBClientArgs):
+            arguments passed to InfluxDB client
+        database (str):
+            database name within InfluxDB to publish to
+        precision (str, optional):
+            Timestamp precision of the batches, one of 's', 'ms', 'us' or
+            'ns'.
+        max_queued_batches (int, optional):
+            Maximum number of batches waiting to be written.
+        retry_interval (float, optional):
+            Initial time in seconds to wait before retrying a failed write.
+        max_retry_interval (float, optional):
+            Maximum time in seconds to wait before retrying a failed write.
+
+    Attributes:
+        name (str):
+            Name identifying the backend, ``<host>:<port>/<database>``.
+        db (str):
+            database name within InfluxDB to publish to
+        client:
+            InfluxDB client connection
+        connected (bool):
+            True if connected to InfluxDB, False if not.
+        alive (bool):
+            False if the writer thread ended without being stopped.
+        dropped_batches (int):
+            Number of batches dropped due to a full queue or rejected writes.
+        last_error (str):
+            Description of the most recent write error.
+
+    """
+
+    def __init__(self, client_args, database, precision='ns',
+                 max_queued_batches=300, retry_interval=1.,
+                 max_retry_interval=30.):
+        self.client_args = client_args
+        self.db = database
+        self.precision = precision
+        self.max_queued_batches = max_queued_batches
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+
+        self.name = f"{client_args.host}:{client_args.port}/{database}"
+        self.client = InfluxDBClient(**asdict(self.client_args))
+        self.connected = False
+        self.dropped_batches = 0
+        self.last_error = None
+
+        self._queue = deque()
+        self._item = None
+        self._in_flight = False
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _setup(self):
+        """Check InfluxDB is reachable, and create the database if needed.
+
+        Returns:
+            bool: True if the database is ready to be written to.
+
+        """
+        try:
+            db_list = self.client.get_list_database()
+        except RequestsConnectionError:
+            LOG.error("Connection error to {n}, will retry.", n=self.name)
+            self.last_error = "Connection error"
+            self.client = InfluxDBClient(**asdict(self.client_args))
+            return False
+        except InfluxDBClientError as err:
+            if err.code == 401:
+                LOG.error("Failed to authenticate. Check your credentials.")
+            else:
+                LOG.error(f"Unknown client error: {err}")
+            self.last_error = f"Client error: {err}"
+            return False
+        except InfluxDBServerError as err:
+            LOG.error("InfluxDB Server Error from {n}: {e}", n=self.name, e=err)
+            self.last_error = f"Server error: {err}"
+            return False
+        except Exception as err:
+            LOG.error("Unexpected error connecting to {n}: {e}", n=self.name,
+                      e=repr(err))
+            self.last_error = f"Unexpected error: {err!r}"
+            return False
+
+        db_names = [x['name'] for x in db_list]
+
+        if self.db not in db_names:
+            print(f"{self.db} DB doesn't exist, creating DB")
+            try:
+                self.client.create_database(self.db)
+            except Exception as err:
+                LOG.error("Failed to create {d} at {n}: {e}", d=self.db,
+                          n=self.name, e=repr(err))
+                self.last_error = f"Failed to create database: {err!r}"
+                return False
+
+        self.client.switch_database(self.db)
+        LOG.info("Connected to InfluxDB at {n}.", n=self.name)
+        self.connected = True
+        return True
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"influxdb-{self.name}")
+        self._thread.start()
+
+    def put(self, batch, retention_policy=None):
+        """Queue a batch for writing.
+
+        Args:
+            batch (bytes or list):
+                Batch from the PayloadAssembler.
+            retention_policy (str, optional):
+                Retention policy to write the batch to.
+
+        """
+        with self._cond:
+            self._queue.append((batch, retention_policy))
+            while len(self._queue) > self.max_queued_batches:
+                self._queue.popleft()
+                self.dropped_batches += 1
+            self._cond.notify_all()
+
+    @property
+    def queued_batches(self):
+        """Number of batches waiting to be written."""
+        return len(self._queue) + int(self._in_flight)
+
+    @property
+    def alive(self):
+        """False if the writer thread ended without being stopped."""
+        return self._thread is not None and \
+            (self._thread.is_alive() or self._stopping)
+
+    def status(self):
+        """Summary of the backend state, for session.data."""
+        return {'connected': self.connected,
+                'alive': self.alive,
+                'queued_batches': self.queued_batches,
+                'dropped_batches': self.dropped_batches,
+                'last_error': self.last_error}
+
+    def _write(self, batch, retention_policy):
+        try:
+            LOG.debug("payload: {p}", p=batch)
+            precision = V1_PRECISIONS[self.precision]
+            if isinstance(batch, bytes):
+                params = {'db': self.db, 'precision': precision}
+                if retention_policy is not None:
+                    params['rp'] = retention_policy
+                # The client only re-encodes data for the 'json' and 'line'
+                # protocols, anything else is sent as is
+                self.client.write(batch, params=params,
+                                  expected_response_code=204,
+                                  protocol='bytes')
+            else:
+                self.client.write_points(batch,
+                                         time_precision=precision,
+                                         protocol='json',
+                                         retention_policy=retention_policy,
+                                         )
+            if not self.connected:
+                self.connected = True
+                LOG.info("Reconnected to InfluxDB at {n}!", n=self.name)
+            LOG.debug("wrote payload to influx")
+            return _WRITE_OK
+        except RequestsConnectionError:
+            LOG.error("InfluxDB at {n} unavailable, attempting to reconnect.",
+                      n=self.name)
+            self.last_error = "Connection error"
+            self.connected = False
+            self.client = InfluxDBClient(**asdict(self.client_args))
+            self.client.switch_database(self.db)
+            return _WRITE_RETRY
+        except InfluxDBServerError as err:
+            LOG.error("InfluxDB Server Error from {n}: {e}", n=self.name, e=err)
+            self.last_error = f"Server error: {err}"
+            self.connected = False
+            return _WRITE_RETRY
+        except InfluxDBClientError as err:
+            LOG.error("InfluxDB Client Error from {n}: {e}", n=self.name, e=err)
+            self.last_error = f"Client error: {err}"
+            self.connected = False
+            self.dropped_batches += 1
+            return _WRITE_DROP
+        except Exception as err:
+            # e.g. read timeouts, or a response cut short
+            LOG.error("Unexpected error writing to {n}: {e}", n=self.name,
+                      e=repr(err))
+            self.last_error = f"Unexpected error: {err!r}"
+            self.connected = False
+            return _WRITE_RETRY
+
+    def _wait(self, timeout):
+        """Wait for timeout seconds, or until stopped. Batches queued in the
+        meantime do not end the wait early.
+
+        Returns:
+            bool: True if the backend is stopping.
+
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._stopping, timeout)
+
+    def _run(self):
+        # Anything unexpected escaping the loop is logged, and the loop
+        # restarted, rather than ending the thread with batches queued
+        backoff = self.retry_interval
+        while True:
+            try:
+                self._run_loop()
+                return
+            except Exception as err:
+                LOG.error("Writer for {n} failed, restarting: {e}", n=self.name,
+                          e=repr(err))
+                self.last_error = f"Unexpected error: {err!r}"
+                self.connected = False
+            if self._wait(backoff):
+                with self._cond:
+                    self._in_flight = False
+                    self._cond.notify_all()
+                return
+            backoff = min(2 * backoff, self.max_retry_interval)
+
+    def _run_loop(self):
+        # Batches are queued while waiting for InfluxDB to become reachable
+        backoff = self.retry_interval
+        while not self._setup():
+            if self._wait(backoff):
+                return
+            backoff = min(2 * backoff, self.max_retry_interval)
+
+        backoff = self.retry_interval
+        while True:
+            with self._cond:
+                if self._item is None:
+                    while not self._queue and not self._stopping:
+                        self._cond.wait()
+                    if not self._queue:
+                        return
+                    self._item = self._queue.popleft()
+                    self._in_flight = True
+
+            if self._write(*self._item) == _WRITE_RETRY:
+                if self._wait(backoff):
+                    with self._cond:
+                        self._in_flight = False
+                        self._cond.notify_all()
+                    return
+                backoff = min(2 * backoff, self.max_retry_interval)
+                continue
+
+            self._item = None
+            backoff = self.retry_interval
+            with self._cond:
+                self._in_flight = False
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait for all queued batches to be written.
+
+        Args:
+            timeout (float, optional): Maximum time in seconds to wait.
+
+        Returns:
+            bool: True if the queue was emptied within the timeout.
+
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._queue and not self._in_flight, timeout)
+
+    def stop(self, timeout=None):
+        """Write out queued batches and stop the writer thread.
+
+        Batches that are being retried when stopping are dropped.
+
+        Args:
+            timeout (float, optional): Maximum time in seconds to wait.
+
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
 class Publisher:
     """
     Data publisher. This manages data to be published to the InfluxDB.
@@ -72,6 +413,13 @@ class Publisher:
     This class should only be accessed by a single thread. Data can be passed
     to it by appending it to the referenced `incoming_data` queue.
 
+    Connections are established in the background, so data can be queued
+    immediately, even if InfluxDB is not yet reachable. Data is encoded once,
+    then queued for writing to each backend. The primary
+    backend is set by the host, port, database, ssl, verify_ssl and gzip
+    arguments. Additional backends can be given with ``extra_backends``. Each
+    backend is written to by its own thread, see :class:`Backend`.
+
     Args:
         incoming_data (queue.Queue):
             A thread-safe queue of (data, feed) pairs.
@@ -89,9 +437,32 @@ class Publisher:
             Verify SSL certificates for HTTPS requests, defaults to False.
         gzip (bool, optional):
             compress influxdb requsts with gzip
-        operate_callback (callable, optional):
-            Function to call to see if failed connections should be
-            retried (to prevent a thread from locking).
+        field_filter (FieldFilter, optional):
+            Filter applied to each data point before it is written, used to
+            drop redundant samples of slowly changing fields.
+        downsampler (WindowAggregator, optional):
+            Aggregator used to compute windowed statistics of the incoming
+            data, written in addition to the full rate data.
+        downsample_retention_policy (str, optional):
+            Retention policy to write downsampled data to. Defaults to the
+            database's default retention policy. The retention policy must
+            already exist.
+        batch_size (int, optional):
+            Maximum number of points written per request, defaults to 10000.
+        precision (str, optional):
+            Timestamp precision, one of 's', 'ms', 'us' or 'ns', defaults to
+            'ns'. Coarser precision gives smaller payloads and better
+            compression within InfluxDB.
+        extra_backends (list, optional):
+            List of dicts describing additional InfluxDB instances to write
+            to, with 'host' and 'database' keys, and optional 'port', 'ssl',
+            'verify_ssl' and 'gzip' keys. See :func:`parse_backend_url`.
+        max_queued_batches (int, optional):
+            Maximum number of batches queued per backend before the oldest are
+            dropped, defaults to 300.
+        retry_interval (float, optional):
+            Initial time in seconds to wait before retrying a failed write,
+            doubling on each attempt up to 30 seconds. Defaults to 1.
 
     Attributes:
         db (str):
@@ -100,12 +471,15 @@ class Publisher:
             Protocol for writing data. Either 'line' or 'json'.
         incoming_data:
             data to be published
+        backends (list):
+            :class:`Backend` for each InfluxDB instance, the first being the
+            primary backend.
         client_args:
-            arguments passed to InfluxDB client
+            arguments passed to InfluxDB client for the primary backend
         client:
-            InfluxDB client connection
+            InfluxDB client connection for the primary backend
         connected (bool):
-            True if connected to InfluxDB, False if not.
+            True if connected to all InfluxDB backends, False if not.
 
     """
 
@@ -118,98 +492,119 @@ class Publisher:
                  ssl=False,
                  verify_ssl=False,
                  gzip=False,
-                 operate_callback=None):
+                 field_filter=None,
+                 downsampler=None,
+                 downsample_retention_policy=None,
+                 batch_size=10000,
+                 precision='ns',
+                 extra_backends=None,
+                 max_queued_batches=300,
+                 retry_interval=1.):
         self.db = database
         self.incoming_data = incoming_data
         self.protocol = protocol
+        self.field_filter = field_filter
+        self.downsampler = downsampler
+        self.downsample_retention_policy = downsample_retention_policy
+        self.batch_size = batch_size
+        self.precision = precision
+        self.assembler = PayloadAssembler(protocol, max_lines=batch_size)
 
         print(f"gzip encoding enabled: {gzip}")
         print(f"data protocol: {protocol}")
+        print(f"timestamp precision: {precision}")
 
         username, password = _get_credentials()
 
-        self.client_args = _InfluxDBClientArgs(
-            host=host,
-            port=port,
-            username=username,
-            password=password,
-            ssl=ssl,
-            verify_ssl=verify_ssl,
-            gzip=gzip)
-        self.client = InfluxDBClient(**asdict(self.client_args))
-
-        db_list = None
-        # ConnectionError here is indicative of InfluxDB being down
-        while db_list is None:
-            try:
-                db_list = self.client.get_list_database()
-            except RequestsConnectionError:
-                LOG.error("Connection error, attempting to reconnect to DB.")
-                self.client = InfluxDBClient(**asdict(self.client_args))
-                time.sleep(1)
-            except InfluxDBClientError as err:
-                if err.code == 401:
-                    LOG.error("Failed to authenticate. Check your credentials.")
-                else:
-                    LOG.error(f"Unknown client error: {err}")
-                time.sleep(1)
-            if operate_callback and not operate_callback():
-                break
-
-        if db_list is None:
-            LOG.error("No databases found. Check connection to InfluxDB.")
-            raise ConnectionError
+        backend_args = [dict(host=host, port=port, database=database, ssl=ssl,
+                             verify_ssl=verify_ssl, gzip=gzip)]
+        for extra in extra_backends or []:
+            args = dict(port=8086, ssl=False, verify_ssl=False, gzip=gzip)
+            args.update(extra)
+            backend_args.append(args)
+
+        self.backends = []
+        for args in backend_args:
+            client_args = _InfluxDBClientArgs(
+                host=args['host'],
+                port=args['port'],
+                username=username,
+                password=password,
+                ssl=args['ssl'],
+                verify_ssl=args['verify_ssl'],
+                gzip=args['gzip'])
+            backend = Backend(client_args,
+                              args['database'],
+                              precision=precision,
+                              max_queued_batches=max_queued_batches,
+                              retry_interval=retry_interval)
+            print(f"InfluxDB backend: {backend.name}")
+            backend.start()
+            self.backends.append(backend)
+
+    @property
+    def client_args(self):
+        return self.backends[0].client_args
+
+    @property
+    def client(self):
+        return self.backends[0].client
+
+    @property
+    def connected(self):
+        return all(backend.connected and backend.alive
+                   for backend in self.backends)
+
+    def backend_status(self):
+        """Summarize the state of each backend.
+
+        Returns:
+            dict: Status dict for each backend, keyed by backend name.
 
-        self.connected = True
-
-        db_names = [x['name'] for x in db_list]
-
-        if self.db not in db_names:
-            print(f"{self.db} DB doesn't exist, creating DB")
-            self.client.create_database(self.db)
-
-        self.client.switch_database(self.db)
+        """
+        return {backend.name: backend.status() for backend in self.backends}
 
     def process_incoming_data(self):
         """
-        Takes all data from the incoming_data queue, and writes them to the
-        InfluxDB.
+        Takes all data from the incoming_data queue, and queues it for writing
+        to each InfluxDB backend.
+
+        Data is encoded as it is pulled from the queue, and handed off each
+        time a batch fills up, so memory use here is bounded by the batch size
+        rather than the size of the queue. The encoded batches are shared by
+        all backends.
         """
-        payload = []
         LOG.debug("Pulling data from queue.")
         while not self.incoming_data.empty():
             data, feed = self.incoming_data.get()
             if feed['agg_params'].get('exclude_influx', False):
                 continue
 
-            # Formatted for writing to InfluxDB
-            payload.extend(format_data(data, feed, protocol=self.protocol))
+            if self.downsampler is not None:
+                self.downsampler.add(data, feed)
 
-        # Skip trying to write if payload is empty
-        if not payload:
-            return
-
-        try:
-            LOG.debug("payload: {p}", p=payload)
-            self.client.write_points(payload,
-                                     batch_size=10000,
-                                     protocol=self.protocol,
-                                     )
-            if not self.connected:
-                self.connected = True
-                LOG.info("Reconnected to InfluxDB!")
-            LOG.debug("wrote payload to influx")
-        except RequestsConnectionError:
-            LOG.error("InfluxDB unavailable, attempting to reconnect.")
-            self.connected = False
-            self.client = InfluxDBClient(**asdict(self.client_args))
-            self.client.switch_database(self.db)
-        except InfluxDBClientError as err:
-            LOG.error("InfluxDB Client Error: {e}", e=err)
-            self.connected = False
-        except InfluxDBServerError as err:
-            LOG.error("InfluxDB Server Error: {e}", e=err)
-            self.connected = False
+            # Formatted for writing to InfluxDB
+            points = format_data(data, feed, protocol=self.protocol,
+                                 field_filter=self.field_filter,
+                                 precision=self.precision)
+            for batch in self.assembler.add(points):
+                self._write_payload(batch)
+
+        for batch in self.assembler.flush():
+            self._write_payload(batch)
+
+        if self.downsampler is not None:
+            downsampled = self.downsampler.flush(self.protocol,
+                                                 precision=self.precision)
+            assembler = PayloadAssembler(self.protocol, max_lines=self.batch_size)
+            for batch in assembler.add(downsampled) + assembler.flush():
+                self._write_payload(batch,
+                                    retention_policy=self.downsample_retention_policy)
+
+    def _write_payload(self, payload, retention_policy=None):
+        """Queue a batch from the PayloadAssembler on every backend."""
+        for backend in self.backends:
+            backend.put(payload, retention_policy=retention_policy)
 
     def run(self):
         """Main run iterator for the publisher. This processes all incoming
@@ -218,6 +613,26 @@ class Publisher:
         """
         self.process_incoming_data()
 
-    def close(self):
-        """Flushes all remaining data and closes InfluxDB connection."""
-        pass
+    def flush(self, timeout=None):
+        """Wait for all backends to write their queued batches.
+
+        Args:
+            timeout (float, optional): Maximum time in seconds to wait for each
+                backend.
+
+        Returns:
+            bool: True if all backends emptied their queues.
+
+        """
+        return all([backend.flush(timeout) for backend in self.backends])
+
+    def close(self, timeout=10):
+        """Flushes all remaining data and closes InfluxDB connection.
+
+        Args:
+            timeout (float, optional): Maximum time in seconds to wait for each
+                backend to finish writing.
+
+        """
+        for backend in self.backends:
+            backend.stop(timeout)
@@ -8,7 +8,9 @@ from os import environ
 from ocs import ocs_agent, site_config
 from ocs.base import OpCode
 
-from ocs.agents.influxdb_publisher_v2.drivers import Publisher
+from ocs.common.influxdb_drivers import FieldFilter, WindowAggregator
+from ocs.agents.influxdb_publisher_v2.write_options import (WRITE_OPTION_PRESETS,
+                                                            make_write_options)
 
 # For logging
 txaio.use_twisted()
@@ -88,20 +90,32 @@ class InfluxDBAgentv2:
 
                 >>> response.session['data']
                 {'connected': True,
+                 'pending_batches': 0,
+                 'dropped_batches': 0,
+                 'write_stats': {'successes': 3583,
+                                 'errors': 0,
+                                 'retries': 2,
+                                 'last_error': 'InfluxDBError: ...',
+                                 'last_error_time': 1774388203.18236},
                  'last_updated': 1774389203.53926}
 
         """
+        # Imported here, as influxdb_client is slow to import
+        from ocs.agents.influxdb_publisher_v2.drivers import Publisher
+
         self.aggregate = True
 
         self.log.debug("Instatiating Publisher class")
-        try:
-            publisher = Publisher(self.incoming_data,
-                                  protocol=self.args.protocol,
-                                  gzip=self.args.gzip,
-                                  operate_callback=lambda: self.aggregate,
-                                  )
-        except ConnectionError:
-            return False, "Failed to connect to InfluxDB"
+        publisher = Publisher(self.incoming_data,
+                              protocol=self.args.protocol,
+                              gzip=self.args.gzip,
+                              precision=self.args.precision,
+                              write_options=self._create_write_options(),
+                              field_filter=self._create_field_filter(),
+                              downsampler=self._create_downsampler(),
+                              downsample_bucket=self.args.downsample_bucket,
+                              max_pending_batches=self.args.max_queued_batches,
+                              )
 
         while self.aggregate:
             time.sleep(self.loop_time)
@@ -116,6 +130,9 @@ class InfluxDBAgentv2:
                 self.log.error("Reconnected to InfluxDB.")
 
             data = {"connected": publisher.connection.connected,
+                    "pending_batches": publisher.pending_batches,
+                    "dropped_batches": publisher.dropped_batches,
+                    "write_stats": publisher.callback.stats(),
                     "last_updated": time.time()}
             session.data.update(data)
 
@@ -126,6 +143,36 @@ class InfluxDBAgentv2:
 
         return True, "Aggregation has ended"
 
+    def _create_write_options(self):
+        options = make_write_options(
+            self.args.write_preset,
+            batch_size=self.args.batch_size,
+            flush_interval=self.args.flush_interval,
+            jitter_interval=self.args.jitter_interval,
+            retry_interval=self.args.retry_interval,
+            max_retries=self.args.max_retries,
+            max_retry_delay=self.args.max_retry_delay,
+            max_retry_time=self.args.max_retry_time,
+            exponential_base=self.args.exponential_base)
+        self.log.info(f"Write options: {options}")
+        return options
+
+    def _create_field_filter(self):
+        filter_config = self.args.filter_config
+        if filter_config:
+            self.log.info(f"Loading field filter rules from {filter_config}")
+            return FieldFilter.from_file(filter_config)
+        return FieldFilter()
+
+    def _create_downsampler(self):
+        if self.args.downsample_window is None:
+            return None
+        self.log.info("Downsampling enabled with "
+                      + f"{self.args.downsample_window} s windows")
+        return WindowAggregator(
+            self.args.downsample_window,
+            measurement_suffix=self.args.downsample_measurement_suffix)
+
     def _stop_record(self, session, params):
         if OpCode(session.op_code) in [OpCode.STARTING, OpCode.RUNNING]:
             session.set_status('stopping')
@@ -155,6 +202,77 @@ def make_parser(parser=None):
                         type=bool,
                         default=False,
                         help="Use gzip content encoding to compress requests.")
+    pgroup.add_argument('--write-preset',
+                        default='default',
+                        choices=list(WRITE_OPTION_PRESETS),
+                        help="Preset for the write options below. "
+                             "'low-latency' writes small batches immediately, "
+                             "'bulk' writes large batches for throughput. "
+                             "Options given explicitly override the preset.")
+    pgroup.add_argument('--batch-size',
+                        type=int,
+                        help="Maximum number of points written per request.")
+    pgroup.add_argument('--flush-interval',
+                        type=int,
+                        help="Maximum time in milliseconds data is held back "
+                             "to fill a batch.")
+    pgroup.add_argument('--jitter-interval',
+                        type=int,
+                        help="Random delay in milliseconds added to each "
+                             "flush, to spread out writes from many "
+                             "publishers.")
+    pgroup.add_argument('--retry-interval',
+                        type=int,
+                        help="Time in milliseconds before the first retry of "
+                             "a failed write.")
+    pgroup.add_argument('--max-retries',
+                        type=int,
+                        help="Maximum number of retries of a failed write.")
+    pgroup.add_argument('--max-retry-delay',
+                        type=int,
+                        help="Maximum time in milliseconds between retries.")
+    pgroup.add_argument('--max-retry-time',
+                        type=int,
+                        help="Maximum total time in milliseconds spent "
+                             "retrying a failed write.")
+    pgroup.add_argument('--exponential-base',
+                        type=int,
+                        help="Base of the exponential backoff between "
+                             "retries.")
+    pgroup.add_argument('--max-queued-batches',
+                        type=int,
+                        default=300,
+                        help="Maximum number of batches held while waiting "
+                             "for InfluxDB to become reachable at startup, "
+                             "before the oldest are dropped.")
+    pgroup.add_argument('--precision',
+                        default='ns',
+                        choices=['s', 'ms', 'us', 'ns'],
+                        help="Precision of timestamps written to InfluxDB. "
+                             "Coarser precision reduces payload size and "
+                             "improves compression for slowly sampled data.")
+    pgroup.add_argument('--filter-config',
+                        default=None,
+                        help="Path to a YAML file containing a list of field "
+                             "filter rules, used to drop redundant samples of "
+                             "slowly changing fields. Rules in feed agg_params "
+                             "are applied regardless of this option.")
+    pgroup.add_argument('--downsample-window',
+                        type=float,
+                        default=None,
+                        help="Length in seconds of wall-clock aligned windows "
+                             "over which min/max/mean/count of each numeric "
+                             "field are computed and written in addition to "
+                             "the full rate data. Disabled if not set.")
+    pgroup.add_argument('--downsample-measurement-suffix',
+                        default='_ds',
+                        help="Suffix appended to the measurement name of "
+                             "downsampled data, so it is kept apart from the "
+                             "full rate data.")
+    pgroup.add_argument('--downsample-bucket',
+                        default=None,
+                        help="Bucket to write downsampled data to. Created if "
+                             "it does not exist. Defaults to the bucket set by INFLUXDB_V2_BUCKET.")
 
     return parser
 
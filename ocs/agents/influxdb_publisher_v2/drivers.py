@@ -1,13 +1,17 @@
 import time
 import txaio
+import threading
+from collections import deque
 from os import environ
 
 from influxdb_client import InfluxDBClient, WriteOptions
 from influxdb_client.client.exceptions import InfluxDBError
 from requests.exceptions import ConnectionError as RequestsConnectionError
-from urllib3.exceptions import NewConnectionError, ProtocolError
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
 
-from ocs.common.influxdb_drivers import format_data
+from ocs.common.influxdb_drivers import PayloadAssembler, format_data
+from ocs.agents.influxdb_publisher_v2.write_options import (  # noqa: F401
+    WRITE_OPTION_PRESETS, make_write_options)
 
 # For logging
 txaio.use_twisted()
@@ -32,21 +36,59 @@ class Connection:
 class BatchingCallback:
     """Callback for InfluxDB write_api.
 
+    Tracks connection state, and counts the outcome of each batch written, for
+    reporting in session.data. Callbacks are run in the write_api's background
+    thread.
+
     See: https://influxdb-client.readthedocs.io/en/stable/usage.html#handling-errors
 
+    Attributes:
+        successes (int): Number of batches written successfully.
+        errors (int): Number of batches that failed after all retries.
+        retries (int): Number of retried write attempts.
+        last_error (str): Description of the most recent error or retry.
+        last_error_time (float): ctime of the most recent error or retry.
+
     """
 
     def __init__(self, connection):
         self.connection = connection
+        self.successes = 0
+        self.errors = 0
+        self.retries = 0
+        self.last_error = None
+        self.last_error_time = None
+        self._lock = threading.Lock()
+
+    def _record_error(self, exception):
+        self.last_error = f"{type(exception).__name__}: {exception}"
+        self.last_error_time = time.time()
 
     def success(self, conf: (str, str, str), data: str):
         self.connection.connect()
+        with self._lock:
+            self.successes += 1
 
     def error(self, conf: (str, str, str), data: str, exception: InfluxDBError):
         self.connection.disconnect()
+        with self._lock:
+            self.errors += 1
+            self._record_error(exception)
 
     def retry(self, conf: (str, str, str), data: str, exception: InfluxDBError):
         self.connection.disconnect()
+        with self._lock:
+            self.retries += 1
+            self._record_error(exception)
+
+    def stats(self):
+        """Summary of write outcomes, for session.data."""
+        with self._lock:
+            return {'successes': self.successes,
+                    'errors': self.errors,
+                    'retries': self.retries,
+                    'last_error': self.last_error,
+                    'last_error_time': self.last_error_time}
 
 
 class Publisher:
@@ -56,6 +98,10 @@ class Publisher:
     This class should only be accessed by a single thread. Data can be passed
     to it by appending it to the referenced `incoming_data` queue.
 
+    The connection to InfluxDB is set up in a background thread, which creates
+    the buckets once InfluxDB is reachable. Until then, batches are held in a
+    bounded queue, and written once setup is complete.
+
     Args:
         incoming_data (queue.Queue):
             A thread-safe queue of (data, feed) pairs.
@@ -65,9 +111,34 @@ class Publisher:
             Protocol for writing data. Either 'line' or 'json'.
         gzip (bool, optional):
             compress influxdb requsts with gzip
-        operate_callback (callable, optional):
-            Function to call to see if failed connections should be
-            retried (to prevent a thread from locking).
+        field_filter (FieldFilter, optional):
+            Filter applied to each data point before it is written, used to
+            drop redundant samples of slowly changing fields.
+        downsampler (WindowAggregator, optional):
+            Aggregator used to compute windowed statistics of the incoming
+            data, written in addition to the full rate data.
+        downsample_bucket (str, optional):
+            Bucket to write downsampled data to. Defaults to the same bucket as
+            the full rate data. Created if it does not exist.
+        write_options (dict, optional):
+            Keyword arguments for ``influxdb_client.WriteOptions``, see
+            :func:`make_write_options`. 'batch_size' sets the maximum number
+            of points written per request, and 'flush_interval' the maximum
+            time in milliseconds data is held back to fill a batch. Defaults
+            to the 'default' preset.
+        precision (str, optional):
+            Timestamp precision, one of 's', 'ms', 'us' or 'ns', defaults to
+            'ns'. Coarser precision gives smaller payloads and better
+            compression within InfluxDB.
+        max_pending_batches (int, optional):
+            Maximum number of batches held while waiting for InfluxDB to
+            become reachable at startup. The oldest batches are dropped when
+            full.
+        setup_retry_interval (float, optional):
+            Initial time in seconds between attempts to set up the connection,
+            doubled after each failure up to 30 seconds. Not to be confused
+            with the 'retry_interval' write option, in milliseconds, used for
+            failed writes.
 
     Attributes:
         db (str):
@@ -78,90 +149,173 @@ class Publisher:
             InfluxDB client connection
         connection (Connection):
             Connection state tracking object.
+        dropped_batches (int):
+            Number of batches dropped while waiting for InfluxDB at startup.
 
     """
 
     def __init__(self, incoming_data, protocol='line',
-                 gzip=False, operate_callback=None):
+                 gzip=False, field_filter=None,
+                 downsampler=None, downsample_bucket=None, write_options=None,
+                 precision='ns', max_pending_batches=300,
+                 setup_retry_interval=1.):
         self.org = environ.get('INFLUXDB_V2_ORG')
         self.db = environ.get('INFLUXDB_V2_BUCKET')
         self.incoming_data = incoming_data
         self.protocol = protocol
+        self.field_filter = field_filter
+        self.downsampler = downsampler
+        self.downsample_bucket = downsample_bucket or self.db
+        self.write_options = write_options or make_write_options()
+        self.batch_size = self.write_options['batch_size']
+        self.precision = precision
+        self.assembler = PayloadAssembler(protocol, max_lines=self.batch_size)
+        self._last_flush = 0
         self.gzip = gzip
 
         print(f"gzip encoding enabled: {gzip}")
         print(f"data protocol: {protocol}")
+        print(f"timestamp precision: {precision}")
 
+        # Not connected until the setup thread has reached InfluxDB
         self.connection = Connection()
+        self.connection.disconnect()
+        self.callback = BatchingCallback(connection=self.connection)
         self.client = InfluxDBClient.from_env_properties()
-        self.write_client = self._create_write_client(
-            self.client,
-            self.connection)
-
-        bucket = None
-        # ConnectionError here is indicative of InfluxDB being down
-        while bucket is None:
+        self.write_client = self._create_write_client()
+
+        self.setup_retry_interval = setup_retry_interval
+        self.dropped_batches = 0
+        self._pending = deque(maxlen=max_pending_batches)
+        self._ready = threading.Event()
+        self._closing = threading.Event()
+        self._setup_thread = threading.Thread(target=self._setup_loop,
+                                              name="influxdb-setup",
+                                              daemon=True)
+        self._setup_thread.start()
+
+    @property
+    def ready(self):
+        """True once the buckets exist and data is being written."""
+        return self._ready.is_set()
+
+    @property
+    def pending_batches(self):
+        """Number of batches waiting for InfluxDB to become reachable."""
+        return len(self._pending)
+
+    def _setup(self):
+        """Check InfluxDB is reachable, and create the buckets if needed."""
+        client = InfluxDBClient.from_env_properties()
+        try:
+            buckets_api = client.buckets_api()
+            buckets = [self.db]
+            if self.downsampler is not None and self.downsample_bucket != self.db:
+                buckets.append(self.downsample_bucket)
+            for name in buckets:
+                if buckets_api.find_bucket_by_name(name) is None:
+                    print(f"{name} DB doesn't exist, creating DB")
+                    buckets_api.create_bucket(bucket_name=name, org=self.org)
+        finally:
+            client.close()
+
+    def _setup_loop(self):
+        backoff = self.setup_retry_interval
+        while True:
             try:
-                buckets_api = self.client.buckets_api()
-                bucket = buckets_api.find_bucket_by_name(self.db)
-            except (RequestsConnectionError, NewConnectionError, ProtocolError):
-                LOG.error("Connection error, attempting to reconnect to DB.")
-                self.client = InfluxDBClient.from_env_properties()
-                self.write_client = self._create_write_client(
-                    self.client,
-                    self.connection)
-                time.sleep(1)
-            if operate_callback and not operate_callback():
-                break
-
-        if bucket is None:
-            LOG.error("No buckets found. Check connection to InfluxDB.")
-            raise ConnectionError
-
-        if self.db != bucket.name:
-            print(f"{self.db} DB doesn't exist, creating DB")
-            self.client.buckets_api().create_bucket(bucket_name=self.db,
-                                                    org=self.org)
-
-    @staticmethod
-    def _create_write_client(client, connection):
-        callback = BatchingCallback(connection=connection)
-        write_client = client.write_api(
-            write_options=WriteOptions(batch_size=10000),
-            success_callback=callback.success,
-            error_callback=callback.error,
-            retry_callback=callback.retry)
+                self._setup()
+            except (RequestsConnectionError, MaxRetryError, NewConnectionError,
+                    ProtocolError):
+                LOG.error("Connection error, will retry connecting to DB.")
+            except InfluxDBError as err:
+                LOG.error("InfluxDB Client Error: {e}", e=err)
+            except Exception as err:
+                # Anything else must not end the thread, or data would be
+                # held until dropped without the setup ever completing
+                LOG.error("Unexpected error setting up InfluxDB, will retry: {e}",
+                          e=repr(err))
+            else:
+                LOG.info("Connected to InfluxDB.")
+                self.connection.connect()
+                self._ready.set()
+                return
+            if self._closing.wait(backoff):
+                return
+            backoff = min(2 * backoff, 30.)
+
+    def _create_write_client(self):
+        options = dict(self.write_options)
+        # Line protocol records are already assembled into batches, each of
+        # which should be sent as a single request
+        if self.protocol == 'line':
+            options['batch_size'] = 1
+        write_client = self.client.write_api(
+            write_options=WriteOptions(max_close_wait=10000, **options),
+            success_callback=self.callback.success,
+            error_callback=self.callback.error,
+            retry_callback=self.callback.retry)
         return write_client
 
     def process_incoming_data(self):
         """
         Takes all data from the incoming_data queue, and writes them to the
         InfluxDB.
+
+        Data is encoded as it is pulled from the queue, and handed to the write
+        client each time a batch fills up, so memory use is bounded by the
+        batch size rather than the size of the queue.
         """
-        payload = []
+        # Write out anything held while waiting for setup to complete
+        while self._pending and self.ready:
+            self._write_payload(*self._pending.popleft())
+
         LOG.debug("Pulling data from queue.")
         while not self.incoming_data.empty():
             data, feed = self.incoming_data.get()
             if feed['agg_params'].get('exclude_influx', False):
                 continue
 
-            # Formatted for writing to InfluxDB
-            payload.extend(format_data(data, feed, protocol=self.protocol))
+            if self.downsampler is not None:
+                self.downsampler.add(data, feed)
 
-        # Skip trying to write if payload is empty
-        if not payload:
+            # Formatted for writing to InfluxDB
+            points = format_data(data, feed, protocol=self.protocol,
+                                 field_filter=self.field_filter,
+                                 precision=self.precision)
+            for batch in self.assembler.add(points):
+                self._write_payload(batch, self.db)
+
+        # Hold back partial batches for up to the flush interval
+        now = time.time()
+        if now - self._last_flush >= self.write_options['flush_interval'] / 1000:
+            self._last_flush = now
+            for batch in self.assembler.flush():
+                self._write_payload(batch, self.db)
+
+        if self.downsampler is not None:
+            downsampled = self.downsampler.flush(self.protocol,
+                                                 precision=self.precision)
+            assembler = PayloadAssembler(self.protocol, max_lines=self.batch_size)
+            for batch in assembler.add(downsampled) + assembler.flush():
+                self._write_payload(batch, self.downsample_bucket)
+
+    def _write_payload(self, payload, bucket):
+        """Write a batch from the PayloadAssembler to the given bucket."""
+        if not self.ready:
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped_batches += 1
+            self._pending.append((payload, bucket))
             return
 
         try:
             LOG.debug("payload: {p}", p=payload)
-            self.write_client.write(bucket=self.db, record=payload)
+            self.write_client.write(bucket=bucket, record=payload,
+                                    write_precision=self.precision)
             LOG.debug("wrote payload to influx")
         except (RequestsConnectionError, NewConnectionError, ProtocolError):
             LOG.error("InfluxDB unavailable, attempting to reconnect.")
             self.client = InfluxDBClient.from_env_properties()
-            self.write_client = self._create_write_client(
-                self.client,
-                self.connection)
+            self.write_client = self._create_write_client()
         except InfluxDBError as err:
             LOG.error("InfluxDB Client Error: {e}", e=err)
 
@@ -174,4 +328,14 @@ class Publisher:
 
     def close(self):
         """Flushes all remaining data and closes InfluxDB connection."""
-        pass
+        self._closing.set()
+        self._setup_thread.join()
+        for batch in self.assembler.flush():
+            self._write_payload(batch, self.db)
+        while self._pending and self.ready:
+            self._write_payload(*self._pending.popleft())
+        if self._pending:
+            LOG.warn("InfluxDB unreachable, discarding {n} batches.",
+                     n=len(self._pending))
+            self._pending.clear()
+        self.write_client.close()
@@ -0,0 +1,60 @@
+"""Write options for the InfluxDB v2 Publisher.
+
+Kept separate from the drivers so the Agent can build its argument parser
+without importing ``influxdb_client``.
+
+"""
+
+#: Presets for the write options passed to :func:`make_write_options`.
+#: ``default`` matches the publisher's historical behavior. ``low-latency``
+#: sends small batches immediately and gives up on failed writes quickly, for
+#: live monitoring. ``bulk`` accumulates large batches and retries for longer,
+#: for maximum throughput when latency does not matter, e.g. backfilling.
+#: Intervals and delays are in milliseconds.
+WRITE_OPTION_PRESETS = {
+    'default': {'batch_size': 10000,
+                'flush_interval': 1000,
+                'jitter_interval': 0,
+                'retry_interval': 5000,
+                'max_retries': 5,
+                'max_retry_delay': 125000,
+                'max_retry_time': 180000,
+                'exponential_base': 2},
+    'low-latency': {'batch_size': 1000,
+                    'flush_interval': 100,
+                    'jitter_interval': 0,
+                    'retry_interval': 1000,
+                    'max_retries': 3,
+                    'max_retry_delay': 5000,
+                    'max_retry_time': 15000,
+                    'exponential_base': 2},
+    'bulk': {'batch_size': 50000,
+             'flush_interval': 10000,
+             'jitter_interval': 2000,
+             'retry_interval': 5000,
+             'max_retries': 10,
+             'max_retry_delay': 125000,
+             'max_retry_time': 600000,
+             'exponential_base': 2},
+}
+
+
+def make_write_options(preset='default', **overrides):
+    """Build the write options for the Publisher from a preset.
+
+    Args:
+        preset (str): Name of a preset in :data:`WRITE_OPTION_PRESETS`.
+        **overrides: Options to override in the preset. Options set to None
+            are ignored.
+
+    Returns:
+        dict: Keyword arguments for ``influxdb_client.WriteOptions``.
+
+    """
+    options = dict(WRITE_OPTION_PRESETS[preset])
+    for key, value in overrides.items():
+        if key not in options:
+            raise ValueError(f"Unknown write option: {key}")
+        if value is not None:
+            options[key] = value
+    return options
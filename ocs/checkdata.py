@@ -2,11 +2,16 @@
 # Brian Koopman
 
 import os
+import json
 import time
+import sqlite3
+import multiprocessing
 
 from progress.bar import Bar
 
+import so3g
 from so3g import hk
+from so3g.spt3g import core
 from ocs.ocs_feed import Feed
 
 from colorama import init, Fore, Style
@@ -40,6 +45,212 @@ def _build_file_list(target):
     return _file_list
 
 
+def _default_cache_path():
+    """Default location of the file summary cache, following the XDG base
+    directory specification.
+
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ocs', 'checkdata.db')
+
+
+def summarize_file(path):
+    """Find the last time and value of each field in a file.
+
+    Frames are read one at a time, and only the last sample of each block is
+    kept, so full timelines are never loaded.
+
+    Parameters
+    ----------
+    path : str
+        Full path to the .g3 file.
+
+    Returns
+    -------
+    dict
+        Last (time, value) pair for each field in the file, keyed by full
+        field name, i.e. 'ADDRESS_ROOT.INSTANCE_ID.feeds.FEED.FIELD'.
+
+    """
+    summary = {}
+    _read_last_samples(path, summary)
+    return summary
+
+
+def _read_last_samples(path, summary, start=0, providers=None):
+    """Update summary in place with the last samples of each field in a file,
+    so that samples read before an error are kept.
+
+    Reading can start part way through the file, at the byte offset of a
+    frame from a previous read, with the providers known at that point. Only
+    the frames appended since then are decoded.
+
+    Returns
+    -------
+    tuple
+        (offset, providers), the byte offset after the last frame read, and
+        the providers, keyed by prov_id, to resume reading from there.
+
+    """
+    reader = core.G3Reader(path)
+    if start:
+        reader.seek(start)
+    translator = hk.HKTranslator()
+    providers = dict(providers or {})
+    offset = start
+    while True:
+        frames = reader(None)
+        if not frames:
+            break
+        offset = reader.tell()
+        for frame in translator(frames[0]):
+            if frame.type != core.G3FrameType.Housekeeping:
+                continue
+            if frame['hkagg_type'] == so3g.HKFrameType.status:
+                providers = {p['prov_id'].value: p['description'].value
+                             for p in frame['providers']}
+            elif frame['hkagg_type'] == so3g.HKFrameType.data:
+                address = providers.get(frame['prov_id'])
+                if address is None:
+                    continue
+                for block in frame['blocks']:
+                    if len(block.times) == 0:
+                        continue
+                    t_last = block.times[-1].time / core.G3Units.s
+                    for field in block.keys():
+                        full_name = f"{address}.{field}"
+                        if full_name not in summary or t_last >= summary[full_name][0]:
+                            summary[full_name] = (t_last, block[field][-1])
+    return offset, providers
+
+
+def latest_values(target, fields):
+    """Find the last time and value of each of the given fields.
+
+    Files are read newest first, based on the ctime in their file names, and
+    no older files are read once every field has been found. The time taken
+    depends on how long ago the fields last reported, not on the size of the
+    archive.
+
+    Parameters
+    ----------
+    target : str
+        File or directory to search.
+    fields : list of str
+        Full field names, i.e. 'ADDRESS_ROOT.INSTANCE_ID.feeds.FEED.FIELD'.
+
+    Returns
+    -------
+    dict
+        Last (time, value) pair for each field, keyed by field name. Fields
+        not found in any file are omitted.
+
+    """
+    remaining = set(fields)
+    latest = {}
+    file_list = sorted(_build_file_list(target), key=os.path.basename,
+                       reverse=True)
+    for _file in file_list:
+        if not remaining:
+            break
+        summary = {}
+        try:
+            _read_last_samples(_file, summary)
+        except RuntimeError:
+            # The newest file may still be being written, keep what was read
+            pass
+        for field in remaining & summary.keys():
+            latest[field] = summary[field]
+        remaining -= summary.keys()
+    return latest
+
+
+def _summarize_file(task):
+    """Summarize a file in a worker process, returning errors rather than
+    raising them.
+
+    The task is a (path, resume) tuple, where resume is the (summary, offset,
+    providers) cached for a file that has grown since, or None to read the
+    whole file.
+
+    """
+    path, resume = task
+    summary, offset, providers = ({}, 0, None) if resume is None else resume
+    try:
+        offset, providers = _read_last_samples(path, summary, offset, providers)
+        return path, (summary, offset, providers), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+class _SummaryCache:
+    """On-disk cache of file summaries, keyed by path, and invalidated when a
+    file's size or modification time changes. Files that have grown since
+    they were summarized, such as the file being written by the aggregator,
+    are read again from where the summary left off.
+
+    Parameters
+    ----------
+    path : str
+        Path to the sqlite database used for the cache.
+
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS summaries "
+                          "(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, summary TEXT, "
+                          "offset INTEGER, providers TEXT)")
+        self.conn.commit()
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    def get(self, path):
+        """Get the cached summary of a file.
+
+        Returns
+        -------
+        summary : dict
+            The cached summary, or None if the file isn't cached or has
+            changed.
+        resume : tuple
+            If the file has grown since it was summarized, the (summary,
+            offset, providers) to resume reading it from, otherwise None.
+
+        """
+        row = self.conn.execute("SELECT size, mtime, summary, offset, providers "
+                                "FROM summaries WHERE path=?", (path, )).fetchone()
+        if row is None:
+            return None, None
+        size, mtime, summary, offset, providers = row
+        summary = {k: tuple(v) for k, v in json.loads(summary).items()}
+        stat = self._stat(path)
+        if stat == (size, mtime) and offset == size:
+            return summary, None
+        if offset and stat[0] > offset and stat[1] >= mtime:
+            providers = {int(k): v for k, v in json.loads(providers).items()}
+            return None, (summary, offset, providers)
+        return None, None
+
+    def put(self, path, summary, offset=0, providers=None):
+        """Cache the summary of a file, read up to the byte offset given, with
+        the providers known at that point.
+
+        """
+        self.conn.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)",
+                          (path, *self._stat(path), json.dumps(summary), offset,
+                           json.dumps(providers or {})))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
 class DataChecker:
     """Check data for latest feeds and fields.
 
@@ -49,36 +260,39 @@ class DataChecker:
         File or directory to scan.
     verbose : bool
         Verbose output flag
+    workers : int
+        Number of processes scanning files in parallel.
+    cache : str or bool
+        Path to an on-disk cache of file summaries, so that repeated scans
+        only read new, modified or appended data, or True to use
+        ``$XDG_CACHE_HOME/ocs/checkdata.db``. No cache is used by default.
 
     Attributes
     ----------
-    hkas : so3g.hk.HKArchiveScanner
-        HKArchiveScanner for reading in the data
-    cat :
-        Finalized HKArchiveScanner
     target : str
         File or directory to scan.
     verbose : bool
         Verbose output flag
+    summaries : dict
+        Last (time, value) pair of each field, per file, as returned by
+        summarize_file(), keyed by file path.
     fields : dict
-        fields returned from a cat.get_fields call
-    timelines : dict
-        timelines returned from a cat.get_fields call
+        Last (time, value) pair of each field across all files, keyed by full
+        field name.
     instances : dict
         Agent/feed/field information for each instance-id, format described in
         _populate_instances docstring
 
     """
 
-    def __init__(self, target, verbose=False):
+    def __init__(self, target, verbose=False, workers=1, cache=None):
         self.target = target
         self.verbose = verbose
+        self.workers = workers
+        self.cache = _default_cache_path() if cache is True else cache
 
-        self.hkas = hk.HKArchiveScanner()
-        self.cat = None
-
+        self.summaries = {}
         self.fields = None
-        self.timelines = None
 
         self.instances = {}
 
@@ -86,18 +300,66 @@ class DataChecker:
         self._file_list = _build_file_list(target)
         self._field_count = 0
 
+    def _open_cache(self):
+        if not self.cache:
+            return None
+        try:
+            return _SummaryCache(self.cache)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Unable to open cache {self.cache}, continuing without: {e}")
+            return None
+
     def scan_files(self):
-        """Scan all the files with the HKArchiveScanner for later processing."""
+        """Summarize all the files for later processing.
+
+        Summaries of unchanged files are read from the cache, and files that
+        have grown are only read from where their cached summary left off.
+        The remaining files are scanned, in parallel if ``workers`` is greater
+        than one.
+
+        """
         _bar = Bar('Scanning', max=len(self._file_list))
+        cache = self._open_cache()
+
+        to_scan = []
         for _file in self._file_list:
-            try:
-                self.hkas.process_file(_file)
-            except Exception as e:
-                print(e)
+            summary, resume = cache.get(_file) if cache is not None else (None, None)
+            if summary is None:
+                to_scan.append((_file, resume))
+            else:
+                self.summaries[_file] = summary
+                _bar.next()
+
+        if self.workers > 1 and len(to_scan) > 1:
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap_unordered(_summarize_file, to_scan)
+        else:
+            pool = None
+            results = map(_summarize_file, to_scan)
+
+        for _file, result, error in results:
+            if error is not None:
+                print(error)
+            else:
+                summary, offset, providers = result
+                self.summaries[_file] = summary
+                if cache is not None:
+                    cache.put(_file, summary, offset, providers)
             _bar.next()
         _bar.finish()
 
-        self.cat = self.hkas.finalize()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.close()
+
+        # Merge summaries, keeping the latest sample of each field
+        self.fields = {}
+        for summary in self.summaries.values():
+            for field, (t_last, v_last) in summary.items():
+                if field not in self.fields or t_last >= self.fields[field][0]:
+                    self.fields[field] = (t_last, v_last)
 
     def _populate_instances(self):
         """Populate the instances dictionary with information about each agent,
@@ -144,23 +406,22 @@ class DataChecker:
                 self._field_count += 1
 
     def process_files(self):
-        """Process all files, resquesting simple data points for each dataset
-        and determining the last time we saw the field and the last value that
-        field held.
+        """Process all files, determining the last time we saw each field and
+        the last value that field held from the file summaries.
 
         """
         _bar = Bar('Processing', max=self._field_count)
         for instance_id, feeds in self.instances.items():
             for feed, fields in feeds.items():
                 for field, d_info in fields['fields'].items():
-                    t, x = self.cat.simple(d_info['full_name'])
-                    d_info['t_last'] = t[-1]
-                    d_info['v_last'] = x[-1]
+                    t_last, v_last = self.fields[d_info['full_name']]
+                    d_info['t_last'] = t_last
+                    d_info['v_last'] = v_last
 
                     if fields['t_last'] is None:
-                        fields['t_last'] = t[-1]
-                    elif t[-1] < fields['t_last']:
-                        fields['t_last'] = t[-1]
+                        fields['t_last'] = t_last
+                    elif t_last < fields['t_last']:
+                        fields['t_last'] = t_last
                     else:
                         pass
 
@@ -171,7 +432,6 @@ class DataChecker:
     def run(self):
         """Run data checker, scan and process all files in target."""
         self.scan_files()
-        self.fields, self.timelines = self.cat.get_fields()
         self._populate_instances()
         self.process_files()
 
@@ -257,7 +517,37 @@ class DataChecker:
         return description_string
 
 
-def main(target, verbose=False):
-    checker = DataChecker(target, verbose)
+def main(target, verbose=False, workers=1, cache=None):
+    checker = DataChecker(target, verbose, workers=workers, cache=cache)
     checker.run()
     print(checker)
+
+
+def main_latest(target, fields, json_output=False):
+    """Print the last time and value of each of the given fields, as found by
+    latest_values().
+
+    """
+    latest = latest_values(target, fields)
+    if json_output:
+        print(json.dumps({field: {'t_last': t_last, 'v_last': v_last}
+                          for field, (t_last, v_last) in latest.items()}))
+        return
+
+    field_str_len = max([20] + [len(f) for f in fields])
+    print("-" * (69 + field_str_len))
+    print("Field".rjust(field_str_len) + " | "
+          + "{:>20} | {:>20} | {:>20}".format("Last Seen [s ago]", "Seen At [ctime]", "Value"))
+    print("-" * (69 + field_str_len))
+    for field in fields:
+        if field not in latest:
+            print(Fore.YELLOW + field.rjust(field_str_len) + Style.RESET_ALL + " | "
+                  + "{:>20}".format("not found"))
+            continue
+        t_last, v_last = latest[field]
+        t_diff = time.time() - t_last
+        _t_diff_string = "{:>20.1f}".format(t_diff)
+        if t_diff > 600:
+            _t_diff_string = Fore.RED + _t_diff_string + Style.RESET_ALL
+        print(field.rjust(field_str_len) + " | " + _t_diff_string + " | "
+              + "{:>20} | {:>20}".format(t_last, v_last))
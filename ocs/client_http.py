@@ -12,6 +12,8 @@ class ControlClient():
         self.agent_addr = agent_addr
         self.realm = kwargs['realm']
         self.call_url = kwargs['url']
+        # Websocket URL of the WAMP router, for subscribing to feeds.
+        self.wamp_server = kwargs.get('wamp_server')
 
     # start and stop are just to imitate wampy client...
     def start(self, *args, **kwargs):
@@ -99,6 +101,24 @@ class ControlClient():
         """
         return self.call(self.agent_addr + '.ops', action, op_name, params, **kw)
 
+    def batch(self, requests, concurrent=False, **kw):
+        """
+        Issue several requests on an Agent's .ops interface in one call.
+
+        Args:
+          requests (list): Requests, each of the form (action, op_name),
+            (action, op_name, params) or (action, op_name, params,
+            kwargs).
+          concurrent (bool): If True, the Agent issues all requests at
+            once, rather than in order.
+
+        Returns:
+          List of tuples (status, message, session), one per request.
+          See :func:`ocs.ocs_agent.OCSAgent._batch_handler`.
+        """
+        return self.call(self.agent_addr, 'batch', requests=requests,
+                         concurrent=concurrent, **kw)
+
     def special(self, subaddr, *args, **kwargs):
         """Execute a an arbitrary method associated with an Agent.
         This is intended for use with special, centralized services,
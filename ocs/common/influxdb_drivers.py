@@ -1,7 +1,32 @@
+import fnmatch
+import math
+from collections import namedtuple
 from datetime import datetime, timezone
+from numbers import Real
 
+import numpy as np
+import txaio
+import yaml
 
-def timestamp2influxtime(time, protocol):
+# For logging
+txaio.use_twisted()
+LOG = txaio.make_logger()
+
+# Timestamp precisions supported by both InfluxDB v1 and v2 APIs, and the
+# multiplier to convert a ctime to integer timestamps of that precision.
+PRECISIONS = {'s': 1, 'ms': 10**3, 'us': 10**6, 'ns': 10**9}
+
+# Precision names used by the InfluxDB v1 write API
+V1_PRECISIONS = {'s': 's', 'ms': 'ms', 'us': 'u', 'ns': 'n'}
+
+# JSON time strings are limited to microsecond resolution
+_JSON_UNITS = {'s': 's', 'ms': 'ms', 'us': 'us', 'ns': 'us'}
+_JSON_FORMATS = {'s': "%Y-%m-%dT%H:%M:%S",
+                 'ms': "%Y-%m-%dT%H:%M:%S.%f",
+                 'us': "%Y-%m-%dT%H:%M:%S.%f"}
+
+
+def timestamp2influxtime(time, protocol, precision='ns'):
     """Convert timestamp for influx, always in UTC.
 
     Args:
@@ -9,18 +34,65 @@ def timestamp2influxtime(time, protocol):
             ctime timestamp
         protocol:
             'json' or line'
+        precision:
+            Timestamp precision, one of 's', 'ms', 'us' or 'ns'. Defaults to
+            'ns'.
 
     """
     if protocol == 'json':
         t_dt = datetime.fromtimestamp(time)
         # InfluxDB expects UTC by default
         t_dt = t_dt.astimezone(tz=timezone.utc)
-        influx_t = t_dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        unit = _JSON_UNITS[precision]
+        influx_t = t_dt.strftime(_JSON_FORMATS[unit])
+        if unit == 'ms':
+            influx_t = influx_t[:-3]
     elif protocol == 'line':
-        influx_t = int(time * 1e9)  # ns
+        influx_t = int(time * PRECISIONS[precision])
     return influx_t
 
 
+def timestamps2influxtimes(times, protocol, precision='ns'):
+    """Vectorized version of :func:`timestamp2influxtime`, converting a whole
+    block of timestamps at once.
+
+    Args:
+        times (list):
+            ctime timestamps
+        protocol (str):
+            'json' or line'
+        precision (str):
+            Timestamp precision, one of 's', 'ms', 'us' or 'ns'. Defaults to
+            'ns'.
+
+    Returns:
+        list: Converted timestamps, with None in place of any timestamp that
+        cannot be represented by InfluxDB.
+
+    """
+    t = np.asarray(times, dtype=np.float64)
+    if protocol == 'json':
+        # Round the fractional part to microseconds, as datetime.fromtimestamp
+        # does, to avoid float error in the full product
+        with np.errstate(invalid='ignore'):
+            seconds = np.floor(t)
+            micros = np.round((t - seconds) * 1e6)
+        valid = np.isfinite(t) & (np.abs(t) < 2**63 / 1e6)
+        converted = (seconds[valid].astype(np.int64) * 10**6
+                     + micros[valid].astype(np.int64))
+        converted = np.datetime_as_string(converted.astype('datetime64[us]'),
+                                          unit=_JSON_UNITS[precision])
+    else:
+        t = t * PRECISIONS[precision]
+        valid = np.isfinite(t) & (np.abs(t) < 2**63)
+        converted = t[valid].astype(np.int64)
+
+    result = [None] * len(t)
+    for i, value in zip(np.flatnonzero(valid).tolist(), converted.tolist()):
+        result[i] = value
+    return result
+
+
 def _format_field_line(field_key, field_value):
     """Format key-value pair for InfluxDB line protocol."""
     # Strings must be in quotes for line protocol
@@ -34,7 +106,224 @@ def _format_field_line(field_key, field_value):
     return line
 
 
-def format_data(data, feed, protocol):
+_FilterRule = namedtuple('_FilterRule', ['deadband', 'rel_deadband', 'max_silence'])
+
+
+def _parse_filter_rule(rule):
+    """Validate a filter rule dict and convert it to a _FilterRule.
+
+    Args:
+        rule (dict): Filter rule, with optional keys 'deadband',
+            'rel_deadband' and 'max_silence'.
+
+    Raises:
+        ValueError: If the rule contains unknown keys or negative values.
+
+    """
+    if rule is None:
+        rule = {}
+    unknown = set(rule) - set(_FilterRule._fields)
+    if unknown:
+        raise ValueError(f"Unknown filter rule keys: {sorted(unknown)}")
+    values = {}
+    for key in _FilterRule._fields:
+        value = rule.get(key)
+        if value is not None:
+            value = float(value)
+            if value < 0:
+                raise ValueError(f"Filter rule '{key}' must be non-negative.")
+        values[key] = value
+    return _FilterRule(deadband=values['deadband'] or 0.,
+                       rel_deadband=values['rel_deadband'] or 0.,
+                       max_silence=values['max_silence'])
+
+
+def _value_changed(value, last_value, rule):
+    """Check if value differs from last_value by more than the deadband."""
+    numeric = (isinstance(value, Real) and not isinstance(value, bool)
+               and isinstance(last_value, Real) and not isinstance(last_value, bool))
+    if not numeric:
+        return value != last_value
+
+    value_nan = math.isnan(value)
+    last_nan = math.isnan(last_value)
+    if value_nan or last_nan:
+        return value_nan != last_nan
+
+    tolerance = rule.deadband + rule.rel_deadband * abs(last_value)
+    return abs(value - last_value) > tolerance
+
+
+class FieldFilter:
+    """Per-field filter for dropping redundant samples before writing to
+    InfluxDB.
+
+    Fields that match a filter rule are only written when their value changes.
+    For numeric fields a sample is considered unchanged if it lies within
+    ``deadband + rel_deadband * abs(last_value)`` of the last written value.
+    Strings and bools are written only when they change. If ``max_silence`` is
+    set, a sample is always written if the last written sample for that field
+    is at least ``max_silence`` seconds old, acting as a heartbeat. Fields
+    without a matching rule are always written.
+
+    Rules can come from two places. Rules passed to this class (typically from
+    the publisher's ``--filter-config`` file) are matched, in order, against
+    ``<feed address>.<field name>`` and take precedence. Otherwise, the
+    ``influx_filter`` entry in a feed's ``agg_params`` is checked, which maps
+    field names (or glob patterns) to rules.
+
+    Args:
+        rules (list, optional):
+            List of rule dicts, each with a 'pattern' key (glob pattern
+            matched against ``<feed address>.<field name>``) and optional
+            'deadband', 'rel_deadband' and 'max_silence' keys.
+
+    Examples:
+        A rule list that writes setpoints only when they change by more than
+        0.01, with a heartbeat at least every 5 minutes::
+
+            [{'pattern': 'observatory.LSA*.feeds.temperatures.setpoint*',
+              'deadband': 0.01,
+              'max_silence': 300}]
+
+        The equivalent, configured by the Agent on its feed::
+
+            agg_params = {
+                'influx_filter': {
+                    'setpoint*': {'deadband': 0.01, 'max_silence': 300},
+                },
+            }
+
+    """
+
+    def __init__(self, rules=None):
+        self.rules = []
+        for rule in rules or []:
+            rule = dict(rule)
+            pattern = rule.pop('pattern')
+            self.rules.append((pattern, _parse_filter_rule(rule)))
+
+        # (feed address, field) -> _FilterRule or None
+        self._rule_cache = {}
+        # feed address -> session_id of the agent the cache was built for
+        self._sessions = {}
+        # (feed address, field) -> (last written value, last written time)
+        self._last = {}
+
+    @classmethod
+    def from_file(cls, filename):
+        """Create a FieldFilter from a YAML file containing a list of rules.
+
+        Args:
+            filename (str): Path to the YAML file.
+
+        """
+        with open(filename, 'r', encoding="utf-8") as f:
+            rules = yaml.safe_load(f)
+        return cls(rules)
+
+    def _match_rule(self, feed, field):
+        name = f"{feed['address']}.{field}"
+        for pattern, rule in self.rules:
+            if fnmatch.fnmatchcase(name, pattern):
+                return rule
+
+        feed_rules = feed.get('agg_params', {}).get('influx_filter')
+        if not feed_rules:
+            return None
+
+        if field in feed_rules:
+            match = feed_rules[field]
+        else:
+            match = next((v for k, v in feed_rules.items()
+                          if fnmatch.fnmatchcase(field, k)), False)
+            if match is False:
+                return None
+
+        try:
+            return _parse_filter_rule(match)
+        except (ValueError, TypeError, AttributeError) as e:
+            print(f"Warning: Invalid influx_filter for field {name}, "
+                  + f"writing unfiltered: {e}")
+            return None
+
+    def _get_rule(self, feed, field):
+        address = feed['address']
+        session_id = feed.get('session_id')
+        if self._sessions.get(address, session_id) != session_id:
+            # Agent restarted, agg_params may have changed
+            self._rule_cache = {k: v for k, v in self._rule_cache.items()
+                                if k[0] != address}
+        self._sessions[address] = session_id
+
+        key = (address, field)
+        try:
+            return self._rule_cache[key]
+        except KeyError:
+            rule = self._match_rule(feed, field)
+            self._rule_cache[key] = rule
+            return rule
+
+    def filter_fields(self, feed, fields, timestamp):
+        """Filter the fields of a single data point.
+
+        Args:
+            feed (dict):
+                feed from the OCS Feed subscription
+            fields (dict):
+                field name to value mapping for a single point
+            timestamp (float):
+                ctime timestamp of the point
+
+        Returns:
+            dict: The subset of fields that should be written.
+
+        """
+        passed = {}
+        address = feed['address']
+        for field, value in fields.items():
+            rule = self._get_rule(feed, field)
+            if rule is None:
+                passed[field] = value
+                continue
+
+            key = (address, field)
+            last = self._last.get(key)
+            if last is not None:
+                last_value, last_time = last
+                heartbeat = (rule.max_silence is not None
+                             and timestamp - last_time >= rule.max_silence)
+                if not heartbeat and not _value_changed(value, last_value, rule):
+                    continue
+
+            self._last[key] = (value, timestamp)
+            passed[field] = value
+
+        return passed
+
+
+def _format_point(measurement, feed_tag, fields, t_influx, protocol):
+    """Format a single point for InfluxDB in the given protocol."""
+    if protocol == 'line':
+        fields_line = []
+        for mk, mv in fields.items():
+            f_line = _format_field_line(mk, mv)
+            fields_line.append(f_line)
+
+        measurement_line = ','.join(fields_line)
+        return f"{measurement},feed={feed_tag} {measurement_line} {t_influx}"
+
+    return {
+        "measurement": measurement,
+        "time": t_influx,
+        "fields": fields,
+        "tags": {
+            "feed": feed_tag
+        }
+    }
+
+
+def format_data(data, feed, protocol, field_filter=None, precision='ns'):
     """Format the data from an OCS feed into a dict for pushing to InfluxDB.
 
     The scheme here is as follows:
@@ -53,11 +342,21 @@ def format_data(data, feed, protocol):
             used to structure our influxdb query
         protocol (str):
             Protocol for writing data. Either 'line' or 'json'.
+        field_filter (FieldFilter, optional):
+            Filter used to drop redundant samples before formatting. Points
+            with no remaining fields are dropped entirely.
+        precision (str, optional):
+            Timestamp precision, one of 's', 'ms', 'us' or 'ns'. Defaults to
+            'ns'.
 
     Returns:
         list: Data ready to publish to influxdb, in the specified protocol.
 
     """
+    if protocol not in ['line', 'json']:
+        print(f"Protocol '{protocol}' not supported.")
+        return []
+
     measurement = feed['agent_address']
     feed_tag = feed['feed_name']
 
@@ -74,40 +373,250 @@ def format_data(data, feed, protocol):
                 grouped_dict[data_key] = data_value[i]
             grouped_data_points.append(grouped_dict)
 
-        for fields, time_ in zip(grouped_data_points, times):
-            if protocol == 'line':
-                fields_line = []
-                for mk, mv in fields.items():
-                    f_line = _format_field_line(mk, mv)
-                    fields_line.append(f_line)
-
-                measurement_line = ','.join(fields_line)
-                try:
-                    t_line = timestamp2influxtime(time_, protocol='line')
-                except OverflowError:
-                    print(f"Warning: Cannot convert {time_} to an InfluxDB compatible time. "
-                          + "Dropping this data point.")
-                    continue
-                line = f"{measurement},feed={feed_tag} {measurement_line} {t_line}"
-                json_body.append(line)
-            elif protocol == 'json':
-                try:
-                    t_json = timestamp2influxtime(time_, protocol='json')
-                except OverflowError:
-                    print(f"Warning: Cannot convert {time_} to an InfluxDB compatible time. "
-                          + "Dropping this data point.")
+        influx_times = timestamps2influxtimes(times, protocol, precision)
+        for fields, time_, t_influx in zip(grouped_data_points, times, influx_times):
+            if t_influx is None:
+                print(f"Warning: Cannot convert {time_} to an InfluxDB compatible time. "
+                      + "Dropping this data point.")
+                continue
+
+            if field_filter is not None:
+                fields = field_filter.filter_fields(feed, fields, time_)
+                if not fields:
                     continue
-                json_body.append(
-                    {
-                        "measurement": measurement,
-                        "time": t_json,
-                        "fields": fields,
-                        "tags": {
-                            "feed": feed_tag
-                        }
-                    }
-                )
-            else:
-                print(f"Protocol '{protocol}' not supported.")
+
+            json_body.append(
+                _format_point(measurement, feed_tag, fields, t_influx, protocol))
 
     return json_body
+
+
+class PayloadAssembler:
+    """Incrementally assemble formatted points into size-bounded batches.
+
+    For the line protocol, each line is encoded straight into a reusable byte
+    buffer as it is added, and a batch is cut whenever adding a line would
+    exceed ``max_bytes`` or ``max_lines``. Batches are returned as ``bytes``,
+    ready to send. For the JSON protocol, batches are lists of at most
+    ``max_lines`` point dicts.
+
+    Completed batches are handed back as points are added, so a caller that
+    writes them out immediately only ever holds a single batch in memory,
+    regardless of how much data is queued.
+
+    Args:
+        protocol (str, optional):
+            Protocol for writing data. Either 'line' or 'json'.
+        max_lines (int, optional):
+            Maximum number of points per batch.
+        max_bytes (int, optional):
+            Maximum size of a line protocol batch in bytes. A single line
+            larger than this is sent in a batch of its own.
+
+    """
+
+    def __init__(self, protocol='line', max_lines=10000, max_bytes=5000000):
+        self.protocol = protocol
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+        self._buffer = bytearray()
+        self._points = []
+        self._lines = 0
+
+    def __len__(self):
+        return self._lines
+
+    def _cut(self):
+        if self.protocol == 'line':
+            batch = bytes(self._buffer)
+            del self._buffer[:]
+        else:
+            batch = self._points
+            self._points = []
+        self._lines = 0
+        return batch
+
+    def add(self, points):
+        """Add formatted points to the current batch.
+
+        Args:
+            points (list): Points from :func:`format_data`.
+
+        Returns:
+            list: Batches completed while adding the points.
+
+        """
+        batches = []
+        for point in points:
+            if self.protocol == 'line':
+                encoded = point.encode('utf-8')
+                full = (self._lines >= self.max_lines
+                        or len(self._buffer) + len(encoded) + 1 > self.max_bytes)
+                if full and self._lines:
+                    batches.append(self._cut())
+                self._buffer += encoded
+                self._buffer += b'\n'
+            else:
+                if self._lines >= self.max_lines:
+                    batches.append(self._cut())
+                self._points.append(point)
+            self._lines += 1
+        return batches
+
+    def flush(self):
+        """Cut the current batch, if it contains any points.
+
+        Returns:
+            list: A list containing the final batch, or an empty list.
+
+        """
+        if not self._lines:
+            return []
+        return [self._cut()]
+
+
+class WindowAggregator:
+    """Compute windowed statistics of numeric fields as data streams through
+    the publisher, for writing to a downsampled InfluxDB target.
+
+    Windows are aligned to wall-clock boundaries, i.e. a 60 second window
+    always starts at the top of a minute. For each numeric field the min, max,
+    mean and count within a window are computed, and written as the fields
+    ``<field>_min``, ``<field>_max``, ``<field>_mean`` and ``<field>_count`` at
+    the window start time. Only the running statistics of the open windows
+    are kept per field, so memory use does not depend on the sample rate.
+    String and bool fields, and NaN values, are ignored.
+
+    Windows are completed based on the timestamps of the data, not the time
+    it arrives, so data that is delayed, e.g. buffered by an Agent while
+    disconnected, is aggregated the same as data that arrives promptly. A
+    window is completed once a feed has sent a sample timestamped more than
+    ``latency`` seconds after the end of the window. Samples that arrive for
+    an already completed window are dropped, counted in ``dropped_samples``,
+    and a warning is logged.
+
+    Args:
+        window (float):
+            Length of each window in seconds.
+        measurement_suffix (str, optional):
+            Suffix appended to the measurement name of downsampled points.
+        latency (float, optional):
+            Time in seconds, in data time, to wait after the end of a window
+            for out of order samples before completing it. Defaults to 10
+            seconds.
+
+    Attributes:
+        dropped_samples (int):
+            Number of samples dropped because their window was already
+            completed.
+
+    """
+
+    def __init__(self, window, measurement_suffix='_ds', latency=10.):
+        if window <= 0:
+            raise ValueError("Downsampling window must be positive.")
+        self.window = float(window)
+        self.measurement_suffix = measurement_suffix
+        self.latency = latency
+        self.dropped_samples = 0
+
+        # (measurement, feed_tag, field) -> {start: [min, max, sum, count]}
+        self._open = {}
+        # (measurement, feed_tag, field) -> start of last completed window
+        self._closed = {}
+        # (measurement, feed_tag) -> latest sample timestamp
+        self._latest = {}
+        # (measurement, feed_tag, start) -> {field: value}
+        self._completed = {}
+        self._dropped_since_flush = 0
+
+    def _complete(self, key, start, state):
+        measurement, feed_tag, field = key
+        min_, max_, sum_, count = state
+        fields = self._completed.setdefault((measurement, feed_tag, start), {})
+        fields[f'{field}_min'] = min_
+        fields[f'{field}_max'] = max_
+        fields[f'{field}_mean'] = sum_ / count
+        fields[f'{field}_count'] = count
+        self._closed[key] = max(start, self._closed.get(key, start))
+
+    def add(self, data, feed):
+        """Add the data from an OCS feed to the running windows.
+
+        Args:
+            data (dict):
+                data from the OCS Feed subscription
+            feed (dict):
+                feed from the OCS Feed subscription
+
+        """
+        measurement = feed['agent_address'] + self.measurement_suffix
+        feed_tag = feed['feed_name']
+        latest = self._latest.get((measurement, feed_tag))
+
+        for block in data.values():
+            times = block['timestamps']
+            for field, values in block['data'].items():
+                key = (measurement, feed_tag, field)
+                windows = self._open.setdefault(key, {})
+                closed = self._closed.get(key)
+                for t, v in zip(times, values):
+                    if (not isinstance(v, Real) or isinstance(v, bool)
+                            or math.isnan(v) or not math.isfinite(t)):
+                        continue
+                    if latest is None or t > latest:
+                        latest = t
+                    start = math.floor(t / self.window) * self.window
+                    if closed is not None and start <= closed:
+                        self._dropped_since_flush += 1
+                        continue
+                    state = windows.get(start)
+                    if state is None:
+                        windows[start] = [v, v, v, 1]
+                        continue
+                    if v < state[0]:
+                        state[0] = v
+                    if v > state[1]:
+                        state[1] = v
+                    state[2] += v
+                    state[3] += 1
+
+        if latest is not None:
+            self._latest[(measurement, feed_tag)] = latest
+
+    def flush(self, protocol, precision='ns'):
+        """Pop all completed windows, formatted for writing to InfluxDB.
+
+        Args:
+            protocol (str):
+                Protocol for writing data. Either 'line' or 'json'.
+            precision (str, optional):
+                Timestamp precision, one of 's', 'ms', 'us' or 'ns'.
+
+        Returns:
+            list: Data ready to publish to influxdb, in the specified protocol.
+
+        """
+        for key, windows in self._open.items():
+            latest = self._latest.get(key[:2])
+            if latest is None:
+                continue
+            expired = latest - self.window - self.latency
+            for start in sorted(s for s in windows if s <= expired):
+                self._complete(key, start, windows.pop(start))
+
+        if self._dropped_since_flush:
+            LOG.warn("Dropped {n} samples that arrived after their downsampling "
+                     "window was completed.", n=self._dropped_since_flush)
+            self.dropped_samples += self._dropped_since_flush
+            self._dropped_since_flush = 0
+
+        body = []
+        for (measurement, feed_tag, start), fields in sorted(self._completed.items()):
+            t_influx = timestamp2influxtime(start, protocol, precision)
+            body.append(
+                _format_point(measurement, feed_tag, fields, t_influx, protocol))
+        self._completed = {}
+
+        return body
@@ -0,0 +1,1370 @@
+# Read from .g3 file and insert into InfluxDB.
+
+import os
+import queue
+import hashlib
+import datetime
+import sqlite3
+import logging
+import warnings
+import time
+import threading
+import multiprocessing
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
+
+from ocs.common.influxdb_drivers import _format_field_line
+
+try:
+    # dependent on so3g, see the 'so3g' extra
+    import so3g
+    from so3g import hk
+    from so3g.spt3g import core
+    from tqdm import tqdm
+    DEPENDENCIES_AVAILABLE = True
+except ImportError:
+    DEPENDENCIES_AVAILABLE = False
+
+
+def timestamp2influxtime(time):
+    """Convert timestamp for influx.
+
+    Parameters
+    ----------
+    time : float
+        ctime timestamp
+
+    Returns
+    -------
+    str
+        Time formatted for insertion to influxDB
+
+    """
+    t_dt = datetime.datetime.fromtimestamp(time)
+    return t_dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def connect_to_sqlite(path=None, db_file=".g32influx.db"):
+    """Tries to determine OCS_SITE_CONFIG location from environment variables.
+    Uses current directory to store sqliteDB if unset.
+
+    Parameters
+    ----------
+    path : str
+        Path to store db in. If None, OCS_SITE_CONFIG is used. If
+        OCS_SITE_CONFIG is unset, the current directory is used.
+    db_file : str
+        basename for sqlite file
+
+    Returns
+    -------
+    sqlite3.Connection
+        Connection to sqlite3 database
+
+    """
+    if path is None:
+        path = os.environ.get("OCS_SITE_CONFIG", "./")
+    full_path = os.path.join(path, db_file)
+    conn = sqlite3.connect(full_path)
+
+    return conn
+
+
+def _md5sum(path, blocksize=65536):
+    """Compute md5sum of a file.
+
+    References
+    ----------
+    - https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
+
+    Parameters
+    ----------
+    path : str
+        Full path to file for which we want the md5
+    blocksize : int
+        blocksize we want to read the file in chunks of to avoid fitting the
+        whole file into memory. Defaults to 65536
+
+    Returns
+    -------
+    str
+        Hex string representing the md5sum of the file
+
+    """
+    hash_ = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            hash_.update(block)
+    return hash_.hexdigest()
+
+
+# Time in seconds to wait before retrying a failed write, doubled each retry
+RETRY_BACKOFF = 1.
+
+# Queue of encoded batches, shared by the decoding worker processes
+_batch_queue = None
+
+
+def _init_worker(batch_queue, log_level, log_file):
+    """Initialize a decoding worker process with the shared batch queue, and
+    the same logging configuration as the main process.
+
+    """
+    global _batch_queue
+    _batch_queue = batch_queue
+    logging.basicConfig(filename=log_file, level=log_level)
+
+
+def _encode_file(path, batch_size, checkpoints, streaming=False):
+    """Decode a .g3 file in a worker process, and queue its contents for
+    writing in batches of line protocol.
+
+    Batches are queued as (path, sequence number, checkpoints, points) tuples.
+
+    Parameters
+    ----------
+    path : str
+        Full path to the file to decode.
+    batch_size : int
+        Maximum number of points per batch.
+    checkpoints : dict
+        Checkpoints from a previous interrupted run, see SingleFileScanner.
+    streaming : bool
+        Convert the file frame by frame with the StreamingFileScanner.
+
+    Returns
+    -------
+    tuple
+        (path, return value, number of batches queued). The return value is 0
+        if good, 2 if the file could not be read or formatted.
+
+    """
+    n_batches = 0
+    scanner_class = StreamingFileScanner if streaming else SingleFileScanner
+    scanner = scanner_class(path, None, checkpoints=checkpoints)
+    try:
+        scanner.scan_file()
+    except Exception:
+        logging.error("Unable to read %s, likely due to old sog3 format."
+                      % path)
+        return path, 2, n_batches
+
+    try:
+        for batch_checkpoints, payload in scanner.iter_batches(batch_size):
+            _batch_queue.put((path, n_batches, batch_checkpoints, payload))
+            n_batches += 1
+    except ValueError:
+        logging.error("Unable to format payload properly, possibly "
+                      + "trying to process old .g3 file format...")
+        return path, 2, n_batches
+    except RuntimeError:
+        logging.error("Unable to read %s part way through." % path)
+        return path, 2, n_batches
+
+    return path, 0, n_batches
+
+
+class _FileProgress:
+    """Tracks the batches of a single file through the parallel pipeline."""
+
+    def __init__(self):
+        self.expected = None
+        self.written = 0
+        self.rval = 0
+        # Set if a batch could not be written due to transient errors
+        self.incomplete = False
+        # Checkpoints of batches written out of order, by sequence number
+        self.next_batch = 0
+        self.checkpoints = {}
+
+    def checkpoint(self, seq, checkpoints):
+        """Record a batch as written.
+
+        Returns
+        -------
+        dict
+            Checkpoints that can now be saved, i.e. for which all earlier
+            batches have also been written.
+
+        """
+        self.checkpoints[seq] = checkpoints
+        ready = {}
+        while self.next_batch in self.checkpoints:
+            ready.update(self.checkpoints.pop(self.next_batch))
+            self.next_batch += 1
+        return ready
+
+    @property
+    def done(self):
+        return self.expected is not None and self.written >= self.expected
+
+
+def _format_column(key, values):
+    """Format a column of values for a field in line protocol.
+
+    Equivalent to calling _format_field_line() on each value, but with the
+    type checks done once for the whole column.
+
+    Parameters
+    ----------
+    key : str
+        Field name, escaped for line protocol.
+    values : numpy.ndarray
+        Values of the field.
+
+    Returns
+    -------
+    list
+        Formatted ``key=value`` strings. NaN and inf values, which can't be
+        written to InfluxDB, are None.
+
+    """
+    prefix = f"{key}="
+    if values.dtype.kind == 'f':
+        column = [prefix + str(v) for v in values.tolist()]
+        finite = np.isfinite(values)
+        if not finite.all():
+            for i in np.flatnonzero(~finite):
+                column[i] = None
+        return column
+    if values.dtype.kind in 'iu':
+        return [f"{prefix}{v}i" for v in values.tolist()]
+    if values.dtype.kind == 'b':
+        return [prefix + str(v) for v in values.tolist()]
+    return [_format_field_line(key, v) for v in values.tolist()]
+
+
+def _checkpoint_key(fields):
+    """Get the key identifying a timeline in the checkpoints.
+
+    This is the full name, i.e. ``<provider>.<field>``, of the first of the
+    timeline's fields in sorted order, so that checkpoints saved by either
+    scanner are understood by the other.
+
+    Parameters
+    ----------
+    fields : iterable
+        Full names of the fields in the timeline.
+
+    Returns
+    -------
+    str
+        Key identifying the timeline.
+
+    """
+    return min(fields)
+
+
+def _fingerprint(path, blocksize=65536):
+    """Compute a cheap fingerprint of a file, from its metadata and the
+    contents of its first and last blocks.
+
+    Parameters
+    ----------
+    path : str
+        Full path to file for which we want the fingerprint
+    blocksize : int
+        Size of the blocks read from the start and end of the file. Defaults
+        to 65536
+
+    Returns
+    -------
+    tuple
+        (size, mtime, inode, head/tail hash) of the file.
+
+    """
+    stat = os.stat(path)
+    hash_ = hashlib.md5()
+    with open(path, "rb") as f:
+        hash_.update(f.read(blocksize))
+        if stat.st_size > blocksize:
+            f.seek(max(blocksize, stat.st_size - blocksize))
+            hash_.update(f.read(blocksize))
+    return stat.st_size, stat.st_mtime, stat.st_ino, hash_.hexdigest()
+
+
+class DataLoader:
+    """Load data from .g3 file into an InfluxDB instance.
+
+    Parameters
+    ----------
+    target : str
+        File or directory to scan.
+    database : str
+        Database name within InfluxDB to publish the loaded data into.
+    host : str
+        InfluxDB host address
+    port : int
+        InfluxDB port
+    workers : int
+        Number of processes decoding files in parallel. If 1, files are
+        decoded and published one at a time in this process.
+    writers : int
+        Number of threads writing decoded batches to InfluxDB, when decoding
+        in parallel.
+    batch_size : int
+        Number of points to publish per write.
+    retries : int
+        Number of times to retry a write that failed due to transient errors,
+        such as InfluxDB being unavailable, when decoding in parallel.
+    full_hash : bool
+        Compute the md5sum of every file, rather than reusing the cached
+        md5sum of files whose fingerprint is unchanged.
+    streaming : bool
+        Convert files frame by frame with the StreamingFileScanner, rather
+        than loading each file with the SingleFileScanner.
+
+    Attributes
+    ----------
+    target : str
+        File or directory to scan.
+    influxclient : influxdb.InfluxDBClient
+        Connection to the InfluxDB, used to publish data to the database.
+    sqliteconn : sqlite3.Connection
+        Connection to the sqlite3 database
+
+    """
+
+    def __init__(self, target, database, host='localhost', port=8086,
+                 startdate="1970-01-01", enddate="2070-01-01", workers=1,
+                 writers=1, batch_size=100000, retries=3, full_hash=False,
+                 streaming=False):
+        if not DEPENDENCIES_AVAILABLE:
+            raise ImportError("g32influx requires so3g, install it with "
+                              "'pip install ocs[so3g]'.")
+        from ocs.checkdata import _build_file_list
+
+        self.host = host
+        self.port = port
+        self.database = database
+        self.workers = workers
+        self.writers = writers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.full_hash = full_hash
+        self.streaming = streaming
+
+        self.influxclient = InfluxDBClient(host=host, port=port)
+        self._init_influxdb(database)
+
+        self.sqliteconn = connect_to_sqlite()
+        self._init_sqlitedb()
+
+        self.target = os.path.abspath(target)
+        self._file_list = _build_file_list(self.target)
+
+        self.startdate = datetime.datetime.strptime(startdate, "%Y-%m-%d")
+        self.enddate = datetime.datetime.strptime(enddate, "%Y-%m-%d")
+
+        self._file_list = self._reduce_filelist_by_date()
+
+    def _init_influxdb(self, db):
+        """Initializes InfluxDB after connection.
+
+        Gets a list of existing databases within InfluxDB, creates db if it
+        doesn't exist, and switches the client to that db.
+
+        Parameters
+        ----------
+        db : str
+            Name for the database.
+
+        """
+        db_list = self.influxclient.get_list_database()
+        db_names = [x['name'] for x in db_list]
+
+        if 'ocs_feeds' not in db_names:
+            logging.info("ocs_feeds DB doesn't exist, creating DB")
+            self.influxclient.create_database(db)
+
+        self.influxclient.switch_database(db)
+
+    def _init_sqlitedb(self):
+        """Initialize the sqlitedb after connection.
+
+        We call our table 'g3files'. You probably don't need to change this.
+        File fingerprints, used to avoid recomputing the md5sum of files that
+        haven't changed, are cached in the 'fingerprints' table. Progress
+        through files that are partially published is recorded in the
+        'checkpoints' table.
+
+        """
+        c = self.sqliteconn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS g3files (path TEXT UNIQUE, md5sum TEXT, published INTEGER)")
+        c.execute("CREATE TABLE IF NOT EXISTS fingerprints (path TEXT UNIQUE, size INTEGER, "
+                  "mtime REAL, inode INTEGER, headtail TEXT, md5sum TEXT)")
+        c.execute("CREATE TABLE IF NOT EXISTS checkpoints (md5sum TEXT, timeline TEXT, "
+                  "last_time REAL, UNIQUE(md5sum, timeline))")
+
+        self.sqliteconn.commit()
+        c.close()
+
+    def _reduce_filelist_by_date(self):
+        """If the user has passed in optional start and end date parameters,
+        limit the filelist by removing files that fall outside of the given
+        range.
+
+        """
+        new_list = []
+        for f in self._file_list:
+            date_string = os.path.basename(f)
+            dt = None
+            try:
+                dt = datetime.datetime.strptime(date_string,
+                                                "%Y-%m-%d-%H-%M-%S.g3")
+            except ValueError:
+                logging.debug("%Y-%m-%d-%H-%M-%S.g3 was not the "
+                              + "file datestring format")
+
+            # Handle new format
+            if '-' not in date_string and dt is None:
+                try:
+                    ctime = int(date_string.replace('.g3', ''))
+                    dt = datetime.datetime.fromtimestamp(ctime)
+                except ValueError:
+                    logging.error(f"Timestamp in {f} could not be extracted.")
+
+            if dt is None:
+                logging.error(f"Removing {f} from file list: bad filename "
+                              "format.")
+            elif dt > self.startdate and dt < self.enddate:
+                new_list.append(f)
+            else:
+                logging.debug(f"Removing {f} from filelist, "
+                              + "outside of start/end dates.")
+
+        return new_list
+
+    def _lookup_md5sum(self, path, fingerprints, renames):
+        """Get the md5sum of a file, from the fingerprint cache if possible.
+
+        The cached md5sum is used if the file's size, mtime and inode are
+        unchanged. Otherwise the head/tail hash is computed, and the cached
+        md5sum of a file with an identical fingerprint reused, i.e. if the file
+        was renamed. The full md5sum is computed only if no match is found, or
+        if ``full_hash`` is set.
+
+        Parameters
+        ----------
+        path : str
+            Full path to the file.
+        fingerprints : dict
+            Cached fingerprints, mapping path to (size, mtime, inode, head/tail
+            hash, md5sum). Updated with the file's fingerprint.
+        renames : dict
+            Index of the cached fingerprints, mapping (size, mtime, inode,
+            head/tail hash) to path. Updated with the file's fingerprint.
+
+        Returns
+        -------
+        str
+            Hex string representing the md5sum of the file
+
+        """
+        cached = fingerprints.get(path)
+        if not self.full_hash and cached is not None:
+            stat = os.stat(path)
+            if cached[:3] == (stat.st_size, stat.st_mtime, stat.st_ino):
+                return cached[4]
+
+        fingerprint = _fingerprint(path)
+        old_path = renames.get(fingerprint)
+        if not self.full_hash and old_path is not None:
+            md5 = fingerprints.pop(old_path)[4]
+        else:
+            md5 = _md5sum(path)
+
+        if cached is not None:
+            renames.pop(cached[:4], None)
+        fingerprints[path] = fingerprint + (md5, )
+        renames[fingerprint] = path
+        return md5
+
+    def check_filelist_against_sqlite(self):
+        """Compares file list to sqlite database. Insert files if they aren't
+        present. Updates paths if files found have moved since they were last
+        seen, and marks files for publishing again if their contents changed.
+
+        All changes are made in a single transaction.
+
+        """
+        c = self.sqliteconn.cursor()
+
+        c.execute("SELECT path, size, mtime, inode, headtail, md5sum from fingerprints")
+        fingerprints = {row[0]: row[1:] for row in c.fetchall()}
+        renames = {fp[:4]: path for path, fp in fingerprints.items()}
+        c.execute("SELECT path, md5sum from g3files")
+        rows = c.fetchall()
+        paths = {md5: path for path, md5 in rows}
+        md5sums = {path: md5 for path, md5 in rows}
+
+        for f in tqdm(self._file_list, desc="Updating Database"):
+            md5 = self._lookup_md5sum(f, fingerprints, renames)
+            result = paths.get(md5)
+            if result == f:
+                continue
+            if result is None and f in md5sums:
+                logging.info(f"Contents of {f} changed, updating hash to {md5}")
+                c.execute("UPDATE g3files SET md5sum=?, published=0 WHERE path=?",
+                          (md5, f))
+                paths.pop(md5sums[f], None)
+            elif result is None:
+                logging.info(f"No match for {md5}, inserting into SQLiteDB")
+                c.execute("INSERT INTO g3files VALUES (?, ?, 0)", (f, md5))
+            else:
+                logging.info(f"Path changed for hash {md5}, updating path to {f}")
+                if f in md5sums:
+                    # Another file previously at this path was replaced
+                    c.execute("DELETE FROM g3files WHERE path=?", (f, ))
+                    paths.pop(md5sums[f], None)
+                c.execute("UPDATE g3files SET path=? WHERE md5sum=?", (f, md5))
+                del md5sums[result]
+            paths[md5] = f
+            md5sums[f] = md5
+
+        c.execute("DELETE FROM fingerprints")
+        c.executemany("INSERT INTO fingerprints VALUES (?, ?, ?, ?, ?, ?)",
+                      [(path, ) + fp for path, fp in fingerprints.items()])
+        self.sqliteconn.commit()
+        c.close()
+
+    def _load_checkpoints(self, chksum):
+        """Load the checkpoints for a partially published file.
+
+        Parameters
+        ----------
+        chksum : str
+            md5sum of the file.
+
+        Returns
+        -------
+        dict
+            Time of the last sample written for each timeline in the file.
+
+        """
+        c = self.sqliteconn.cursor()
+        c.execute("SELECT timeline, last_time from checkpoints WHERE md5sum=?",
+                  (chksum, ))
+        checkpoints = dict(c.fetchall())
+        c.close()
+        if checkpoints:
+            logging.info(f"Resuming {chksum} from checkpoints")
+        return checkpoints
+
+    def _save_checkpoints(self, chksum, checkpoints):
+        """Record the last sample written for timelines in a file.
+
+        Parameters
+        ----------
+        chksum : str
+            md5sum of the file.
+        checkpoints : dict
+            Time of the last sample written, keyed by the key identifying the
+            timeline within the file.
+
+        """
+        c = self.sqliteconn.cursor()
+        c.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                      [(chksum, key, t) for key, t in checkpoints.items()])
+        self.sqliteconn.commit()
+        c.close()
+
+    def _publish_file(self, filename, chksum):
+        """Publish the contents of a .g3 file to InfluxDB.
+
+        Parameters
+        ----------
+        filename : str
+            Full path to file to publish.
+        chksum : str
+            md5sum of the file, used to record progress.
+
+        Returns
+        -------
+        int
+            Return value from scanner.run()
+
+        """
+        def checkpoint(checkpoints):
+            self._save_checkpoints(chksum, checkpoints)
+
+        scanner_class = StreamingFileScanner if self.streaming else SingleFileScanner
+        try:
+            scanner = scanner_class(filename, self.influxclient,
+                                    checkpoints=self._load_checkpoints(chksum),
+                                    checkpoint_callback=checkpoint)
+            rval = scanner.run(batch_size=self.batch_size)
+        except RuntimeError:
+            logging.error("Unable to process file, skipping.")
+            return 2
+
+        return rval
+
+    def _mark_published(self, chksum, rval):
+        """Record the result of publishing a file in the sqlite database, and
+        clear its checkpoints.
+
+        Parameters
+        ----------
+        chksum : str
+            md5sum of the file.
+        rval : int
+            0 if published successfully, otherwise the error code.
+
+        """
+        c = self.sqliteconn.cursor()
+        c.execute("UPDATE g3files SET published=? WHERE md5sum=?",
+                  (1 if rval == 0 else rval, chksum))
+        c.execute("DELETE FROM checkpoints WHERE md5sum=?", (chksum, ))
+        self.sqliteconn.commit()
+        c.close()
+
+    def publish_all_files_to_influxdb(self):
+        """Publish all files found in target to InfluxDB.
+
+        Will build list of files not already published from sqlite database,
+        scan and publish contents, then mark as published in sqliteDB.
+
+        This has the side-effect that it will publish files previously entered
+        into the database, even if not in the target list for this particular call, say
+        if a previous upload was cancelled. This should probably be addressed in
+        future versions.
+
+        """
+        c = self.sqliteconn.cursor()
+
+        c.execute("SELECT path, md5sum from g3files WHERE published=0")
+        to_publish = c.fetchall()
+        c.close()
+
+        file_list = set(self._file_list)
+        for path, chksum in to_publish:
+            if path not in file_list:
+                logging.debug(f"Unpublished file {path} not in file_list, skipping.")
+        to_publish = [(path, chksum) for path, chksum in to_publish
+                      if path in file_list]
+
+        if self.workers > 1:
+            self._publish_files_parallel(to_publish)
+            return
+
+        for path, chksum in tqdm(to_publish, desc="All Files"):
+            rval = self._publish_file(path, chksum)
+            self._mark_published(chksum, rval)
+
+    def _write_batch(self, client, path, payload):
+        """Write a batch to InfluxDB, retrying transient errors.
+
+        Parameters
+        ----------
+        client : influxdb.InfluxDBClient
+            Connection to the InfluxDB.
+        path : str
+            Full path to the file the batch is from.
+        payload : list
+            Points to write, in line protocol.
+
+        Returns
+        -------
+        int
+            0 if written, 2 if InfluxDB rejected the batch, or None if it
+            could not be written within the retries, e.g. while InfluxDB is
+            down.
+
+        """
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2**(attempt - 1))
+            try:
+                if payload:
+                    client.write_points(payload, batch_size=self.batch_size,
+                                        protocol="line")
+                return 0
+            except InfluxDBClientError as e:
+                logging.error(f"ERROR in {path}")
+                logging.error(f"client error, likely a type error: {e}")
+                return 2
+            except (InfluxDBServerError, RequestException) as e:
+                logging.warning(f"unable to write {path} to InfluxDB, "
+                                f"attempt {attempt + 1}: {e}")
+        logging.error(f"ERROR in {path}")
+        logging.error(f"unable to write to InfluxDB after {self.retries} retries")
+        return None
+
+    def _write_batches(self, batch_queue, results):
+        """Writer thread, writing batches from the decoding workers to InfluxDB.
+
+        The outcome of every batch taken from the queue is reported, even if
+        writing it raised, so the main thread never waits on a lost batch.
+
+        Parameters
+        ----------
+        batch_queue : multiprocessing.Queue
+            Queue of batches from the decoding workers. None signals the
+            thread to exit.
+        results : queue.Queue
+            Queue the outcome of each write is reported to.
+
+        """
+        client = InfluxDBClient(host=self.host, port=self.port,
+                                database=self.database)
+        while True:
+            item = batch_queue.get()
+            if item is None:
+                break
+            path, seq, checkpoints, payload = item
+            try:
+                rval = self._write_batch(client, path, payload)
+            except Exception as e:
+                logging.exception(f"Unexpected error writing {path}: {e}")
+                rval = 2
+            results.put(('written', path, rval, len(payload),
+                         (seq, checkpoints)))
+        client.close()
+
+    def _publish_files_parallel(self, to_publish):
+        """Publish files using a pool of decoding processes and writer threads.
+
+        Files are decoded by ``workers`` processes, which queue encoded
+        batches for ``writers`` threads to write to InfluxDB. A file is marked
+        as published in the sqlite database, from this process only, once all
+        of its batches are written. Since batches may be written out of order,
+        a checkpoint is only saved once all earlier batches of the file have
+        been written. A file with batches that could not be written due to
+        transient errors, or still decoding when a worker process died, is
+        left unpublished, to resume from its checkpoints on the next run.
+
+        Parameters
+        ----------
+        to_publish : list
+            List of (path, md5sum) tuples for the files to publish.
+
+        """
+        if not to_publish:
+            return
+
+        ctx = multiprocessing.get_context('spawn')
+        # Bound the queue so decoding can't get too far ahead of writing
+        batch_queue = ctx.Queue(maxsize=2 * self.writers)
+        results = queue.Queue()
+
+        writers = [threading.Thread(target=self._write_batches,
+                                    args=(batch_queue, results),
+                                    daemon=True)
+                   for i in range(self.writers)]
+        for writer in writers:
+            writer.start()
+
+        def decoded(path):
+            def callback(future):
+                if future.cancelled():
+                    return
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died abruptly, e.g. crashing in so3g, which
+                    # fails every file still decoding. Leave them to resume.
+                    logging.error(f"Decoding {path} failed, worker died: {e}")
+                    result = (path, None, None)
+                except Exception as e:
+                    logging.error(f"Decoding {path} failed: {e}")
+                    result = (path, 2, None)
+                results.put(('decoded',) + result + (None, ))
+            return callback
+
+        root = logging.getLogger()
+        log_file = next((h.baseFilename for h in root.handlers
+                         if isinstance(h, logging.FileHandler)), None)
+        executor = ProcessPoolExecutor(self.workers, mp_context=ctx,
+                                       initializer=_init_worker,
+                                       initargs=(batch_queue, root.level,
+                                                 log_file))
+
+        chksums = dict(to_publish)
+        progress = {path: _FileProgress() for path in chksums}
+        futures = []
+        try:
+            for path, chksum in chksums.items():
+                future = executor.submit(_encode_file, path, self.batch_size,
+                                         self._load_checkpoints(chksum),
+                                         self.streaming)
+                future.add_done_callback(decoded(path))
+                futures.append(future)
+
+            with tqdm(total=len(progress), desc="All Files") as files_bar, \
+                    tqdm(desc="Points", unit="pt") as points_bar:
+                while progress:
+                    kind, path, rval, count, checkpoint = results.get()
+                    file_progress = progress.get(path)
+                    if file_progress is None:
+                        # Already marked as failed
+                        continue
+                    if rval is None:
+                        file_progress.incomplete = True
+                    else:
+                        file_progress.rval = file_progress.rval or rval
+                    if kind == 'decoded':
+                        # Workers crashing part-way through a file leave an
+                        # unknown number of batches in flight, so finish it now
+                        file_progress.expected = file_progress.written \
+                            if count is None else count
+                    else:
+                        file_progress.written += 1
+                        points_bar.update(count)
+                        if rval == 0:
+                            self._save_checkpoints(
+                                chksums[path], file_progress.checkpoint(*checkpoint))
+
+                    if file_progress.done:
+                        if file_progress.incomplete and not file_progress.rval:
+                            logging.warning(f"{path} was not fully written, "
+                                            "resuming on the next run")
+                        else:
+                            self._mark_published(chksums[path], file_progress.rval)
+                        del progress[path]
+                        files_bar.update()
+        except BaseException:
+            # Stop decoding immediately if interrupted. Progress so far is
+            # saved in the checkpoints. The executor has no public way to
+            # stop running tasks, so terminate its workers directly.
+            for future in futures:
+                future.cancel()
+            for process in list(executor._processes.values()):
+                process.terminate()
+            executor.shutdown(wait=False)
+            raise
+
+        executor.shutdown()
+        for writer in writers:
+            batch_queue.put(None)
+        for writer in writers:
+            writer.join()
+
+    def run(self, skip_file_check=False):
+        """Run file check and upload.
+
+        Parameters
+        ----------
+        skip_file_check : bool
+            Skip the file check step, proccessing only files already in the
+            database from a previous scan. Helpful if restarting a run where
+            you know input files haven't changed.
+
+        """
+        if not skip_file_check:
+            self.check_filelist_against_sqlite()
+        self.publish_all_files_to_influxdb()
+
+
+class SingleFileScanner:
+    """Object for scanning and publishing a single .g3 file.
+
+    Since we want to track which files are being uploaded so that an upload can
+    be resumed if interrupted it's perhaps the simplest to upload them
+    individually. While this doesn't take advantage of the nice
+    so3g.hk.HKArchiveScanner functionality of reading multiple files, our time
+    limiting step is actually pushing data into the InfluxDB.
+
+    Parameters
+    ----------
+    path : str
+        Full path to file for scanning
+    db : influxdb.InfluxDBClient
+        Connection to the InfluxDB, used to publish data to the database.
+    checkpoints : dict
+        Time of the last sample already written for each timeline, keyed as
+        given by _checkpoint_key(), from a previous interrupted run. Earlier
+        samples are skipped.
+    checkpoint_callback : callable
+        Function called with the updated checkpoints after each batch is
+        written, to record progress.
+
+    Attributes
+    ----------
+    file : str
+        Full path to file for scanning
+    client : influxdb.InfluxDBClient
+        Connection to the InfluxDB, used to publish data to the database.
+    hkas : so3g.hk.HKArchiveScanner
+        HKArchiveScanner for reading in the data
+    cat :
+        Finalized HKArchiveScanner
+    fields
+        Fields within the file as returned by cat.get_fields()
+    timelines
+        Timelines within the file as returned by cat.get_fields()
+
+    """
+
+    def __init__(self, path, db, checkpoints=None, checkpoint_callback=None):
+        self.path = path
+        self.db = db
+        self.checkpoints = checkpoints or {}
+        self.checkpoint_callback = checkpoint_callback
+
+        self.hkas = hk.HKArchiveScanner()
+        self.cat = None
+
+        self.fields = None
+        self.timelines = None
+
+    def scan_file(self):
+        """Scan the file with the HKArchiveScanner and get the fields
+        for later processing.
+
+        """
+        logging.debug("Scanning %s." % self.path)
+        self.hkas.process_file(self.path)
+        self.cat = self.hkas.finalize()
+        self.fields, self.timelines = self.cat.get_fields()
+
+        keys = {_checkpoint_key(timeline["field"])
+                for timeline in self.timelines.values()}
+        for key in set(self.checkpoints) - keys:
+            logging.warning(f"Dropping checkpoint for unknown timeline {key} "
+                            f"in {self.path}")
+            del self.checkpoints[key]
+
+        return 0
+
+    def format_field(self, field):
+        """Format a given field for publishing to the database.
+
+        Deprecated: formating field by field is significantly slower than doing
+        it by timeline: see `format_timeline()`.
+
+        Parameters
+        ----------
+        field : str
+            Field to publish data from, will query the finalized HKArchive
+
+        Returns
+        -------
+        list
+            List of values formatted for writing to InfluxDB
+
+        """
+        warnings.warn("Formatting by field is deprecated.", DeprecationWarning)
+
+        t, x = self.cat.simple(field)
+        logging.debug("field:", field)
+        agent_address, feed_and_field = field.split(".feeds.")
+        feed_tag, field = feed_and_field.split(".")
+
+        json_body = []
+
+        for _x, _t in zip(x, t):
+            fields = {field: _x}
+            json_body.append(
+                {
+                    "measurement": agent_address,
+                    "time": timestamp2influxtime(_t),
+                    "fields": fields,
+                    "tags": {
+                        "feed": feed_tag
+                    }
+
+                }
+            )
+
+        # print("payload: {}".format(json_body))
+
+        return json_body
+
+    def format_timeline(self, timeline, since=None):
+        """Format a given timeline for publishing to the database.
+
+        Parameters
+        ----------
+        field : str
+            Timeline to publish data from, will query the finalized HKArchive.
+        since : float
+            If given, only format samples after this time.
+
+        Returns
+        -------
+        list
+            List of points, in line protocol, for writing to InfluxDB.
+        """
+        return self._format_timeline(timeline, since)[1]
+
+    def format_batches(self, timeline, batch_size):
+        """Format a given timeline in batches, skipping samples already
+        written according to the checkpoints.
+
+        Parameters
+        ----------
+        timeline : dict
+            Timeline to publish data from, will query the finalized HKArchive.
+        batch_size : int
+            Number of points per batch.
+
+        Returns
+        -------
+        list
+            List of (checkpoints, points) tuples, one per batch, where
+            checkpoints maps the key identifying the timeline to the time of
+            the last point in the batch.
+
+        """
+        key = _checkpoint_key(timeline["field"])
+        t, lines = self._format_timeline(timeline,
+                                         since=self.checkpoints.get(key))
+        return [({key: float(t[min(i + batch_size, len(lines)) - 1])},
+                 lines[i:i + batch_size])
+                for i in range(0, len(lines), batch_size)]
+
+    def iter_batches(self, batch_size):
+        """Iterate over batches of all timelines in the file, see
+        format_batches().
+
+        """
+        for name, timeline in self.timelines.items():
+            yield from self.format_batches(timeline, batch_size)
+
+    def _format_timeline(self, timeline, since=None):
+        """Format a given timeline, returning the sample times along with the
+        points in line protocol.
+
+        """
+        field = timeline["field"]
+
+        # Do some good, ol' fashioned parsing.
+        if ".feeds." not in field[0]:
+            split = field[0].split('.')
+            address = split[:-1]  # drop the channel name
+            agent_address = '.'.join(address)
+            feed_val = None  # feeds not included
+            field_tag = [f.split('.')[-1] for f in field]
+
+        else:
+            s = field[0].split(".feeds.")
+            agent_address = s[0]
+            if " " in agent_address:
+                raise ValueError(f"Space contained in OCS address {s[0]}.")
+            # ff = field[0].split(".feeds.")[1]
+            feed_val = s[1].split(".")[0].replace(" ", "\\ ")
+            field_tag = [f.split(".feeds.")[1].split(".")[1].replace(" ", "\\ ")
+                         for f in field]
+
+        # Get the data. Since all the fields belong to the same timeline, their
+        # timestamps are all the same object, which we can just grab from the
+        # first element of returned array. Then we need to transpose the data
+        # so that we can read it timestamp by timestamp.
+        raw_data = self.cat.simple(field)
+        t = raw_data[0][0]
+        data = np.transpose(np.stack([d[1] for d in raw_data]))
+        # NaN and inf values can't be written to InfluxDB, so are dropped,
+        # along with samples left without any fields, as in format_block()
+        valid = np.transpose(np.stack([np.isfinite(d[1]) if d[1].dtype.kind == 'f'
+                                       else np.ones(len(d[1]), dtype=bool)
+                                       for d in raw_data]))
+        mask = valid.any(axis=1)
+        if since is not None:
+            mask &= t > since
+        t, data, valid = t[mask], data[mask], valid[mask]
+
+        # Create the line output.
+        line = []
+        for _t, _data, _valid in zip(t, data, valid):
+            flist = ",".join(["%s=%s" % (_f, _d)
+                              for _f, _d, _v in zip(field_tag, _data, _valid)
+                              if _v])
+            if feed_val is not None:
+                line.append("%s,feed=%s %s %d\n" %
+                            (agent_address, feed_val, flist, _t * 1e9))
+            else:
+                line.append("%s %s %d\n" %
+                            (agent_address, flist, _t * 1e9))
+
+        return t, line
+
+    def publish_file(self, batch_size=100000):
+        """Publish a files contents to InfluxDB.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of points to publish per write, passed to
+            influxdb.write_points(). Defaults to 100,000, which seems
+            reasonable.
+
+        Returns
+        -------
+        int
+            0 if good, 2 if an excpetion occurred during publishing
+
+        """
+        return_value = 0
+        basename = os.path.basename(self.path)
+
+        for name, timeline in tqdm(self.timelines.items(), desc=f"{basename}"):
+            try:
+                batches = self.format_batches(timeline, batch_size)
+                # payload = self.format_field(field)
+            except ValueError:
+                logging.error("Unable to format payload properly, possibly "
+                              + "trying to process old .g3 file format...")
+                return 2
+            # print(f"publishing {field}...")
+            for checkpoints, payload in batches:
+                try:
+                    self.db.write_points(payload,
+                                         batch_size=batch_size,
+                                         protocol="line")
+                except InfluxDBClientError as e:
+                    logging.error(f"ERROR in {self.path}")
+                    logging.error(f"client error, likely a type error: {e}")
+                    logging.debug(f"payload: {payload}")
+                    return_value = 2
+                    break
+                self.checkpoints.update(checkpoints)
+                if self.checkpoint_callback is not None:
+                    self.checkpoint_callback(checkpoints)
+
+        return return_value
+
+    def run(self, batch_size=100000):
+        try:
+            self.scan_file()
+        except Exception:
+            logging.error("Unable to read %s, likely due to old sog3 format."
+                          % self.path)
+            return 2
+        pub_ret = self.publish_file(batch_size=batch_size)
+
+        return pub_ret
+
+
+class StreamingFileScanner:
+    """Object for converting and publishing a single .g3 file, frame by frame.
+
+    Rather than loading the whole file through the HKArchiveScanner, frames
+    are read one at a time with a G3Reader, and the blocks in each data frame
+    formatted directly to line protocol, column by column. Only one batch is
+    held in memory at a time, so memory use does not grow with the size of
+    the file.
+
+    Parameters
+    ----------
+    path : str
+        Full path to file for scanning
+    db : influxdb.InfluxDBClient
+        Connection to the InfluxDB, used to publish data to the database.
+    checkpoints : dict
+        Time of the last sample already written for each block, keyed as
+        given by _checkpoint_key(), from a previous interrupted run. Earlier
+        samples are skipped.
+    checkpoint_callback : callable
+        Function called with the updated checkpoints after each batch is
+        written, to record progress.
+    max_bytes : int
+        Maximum size of a batch in bytes. Defaults to 5 MB.
+
+    Attributes
+    ----------
+    providers : dict
+        Provider descriptions, i.e. addresses, keyed by provider ID, from the
+        most recent status frame.
+
+    """
+
+    def __init__(self, path, db, checkpoints=None, checkpoint_callback=None,
+                 max_bytes=5000000):
+        self.path = path
+        self.db = db
+        self.checkpoints = checkpoints or {}
+        self.checkpoint_callback = checkpoint_callback
+        self.max_bytes = max_bytes
+
+        self.providers = {}
+        self._reader = None
+        self._translator = hk.HKTranslator()
+
+    def scan_file(self):
+        """Open the file for reading."""
+        logging.debug("Opening %s." % self.path)
+        self._reader = core.G3Reader(self.path)
+
+        return 0
+
+    def iter_frames(self):
+        """Iterate over the Housekeeping frames in the file, translated to the
+        current HK format.
+
+        """
+        while True:
+            frames = self._reader(None)
+            if not frames:
+                return
+            for frame in self._translator(frames[0]):
+                if frame.type == core.G3FrameType.Housekeeping:
+                    yield frame
+
+    @staticmethod
+    def block_key(description, block):
+        """Get the key identifying a block in the checkpoints, see
+        _checkpoint_key().
+
+        """
+        return _checkpoint_key(f"{description}.{name}" for name in block.keys())
+
+    def format_block(self, description, block_name, block):
+        """Format a block from a data frame in line protocol, skipping samples
+        already written according to the checkpoints.
+
+        Parameters
+        ----------
+        description : str
+            Address of the provider the block belongs to.
+        block_name : str
+            Name of the block.
+        block : so3g.spt3g.core.G3TimesampleMap
+            Block to format.
+
+        Returns
+        -------
+        tuple
+            (times, points), where times are the sample times in seconds, as a
+            list, and points the lines to write. Points are None for samples
+            with no valid fields.
+
+        """
+        if ".feeds." in description:
+            agent_address, feed = description.split(".feeds.", 1)
+            if " " in agent_address:
+                raise ValueError(f"Space contained in OCS address {agent_address}.")
+            feed_tag = feed.replace(" ", "\\ ")
+            prefix = f"{agent_address},feed={feed_tag}"
+        else:
+            prefix = description
+
+        ticks = np.asarray(block.times)
+        t = ticks / core.G3Units.s
+        since = self.checkpoints.get(self.block_key(description, block))
+        mask = slice(None) if since is None else t > since
+        t = t[mask]
+        # G3Time is an integer number of ticks, so convert exactly
+        influx_times = (ticks[mask] * int(1e9 / core.G3Units.s)).tolist()
+
+        columns = [_format_column(name.replace(" ", "\\ "),
+                                  np.asarray(block[name])[mask])
+                   for name in block.keys()]
+
+        lines = []
+        for t_influx, fields in zip(influx_times, zip(*columns)):
+            fields = ",".join(f for f in fields if f is not None)
+            if fields:
+                lines.append(f"{prefix} {fields} {t_influx}")
+            else:
+                lines.append(None)
+
+        return t.tolist(), lines
+
+    def iter_batches(self, batch_size):
+        """Iterate over the file in batches of line protocol.
+
+        Batches are limited to ``batch_size`` points and ``max_bytes`` bytes.
+
+        Yields
+        ------
+        tuple
+            (checkpoints, points), where checkpoints maps the key of each block
+            in the batch to the time of its last point in the batch.
+
+        """
+        batch = []
+        size = 0
+        checkpoints = {}
+        keys = set()
+        for frame in self.iter_frames():
+            if frame['hkagg_type'] == so3g.HKFrameType.status:
+                self.providers = {p['prov_id'].value: p['description'].value
+                                  for p in frame['providers']}
+                continue
+            if frame['hkagg_type'] != so3g.HKFrameType.data:
+                continue
+
+            description = self.providers.get(frame['prov_id'])
+            if description is None:
+                logging.warning(f"Unknown provider {frame['prov_id']} in {self.path}")
+                continue
+
+            for block_name, block in zip(frame['block_names'], frame['blocks']):
+                key = self.block_key(description, block)
+                keys.add(key)
+                times, lines = self.format_block(description, block_name, block)
+                for t, line in zip(times, lines):
+                    checkpoints[key] = t
+                    if line is None:
+                        continue
+                    batch.append(line)
+                    size += len(line) + 1
+                    if len(batch) >= batch_size or size >= self.max_bytes:
+                        yield checkpoints, batch
+                        batch = []
+                        size = 0
+                        checkpoints = {}
+
+        for key in set(self.checkpoints) - keys:
+            logging.warning(f"Ignored checkpoint for unknown block {key} "
+                            f"in {self.path}")
+
+        if batch or checkpoints:
+            yield checkpoints, batch
+
+    def publish_file(self, batch_size=100000):
+        """Publish a files contents to InfluxDB.
+
+        Parameters
+        ----------
+        batch_size : int
+            Maximum number of points to publish per write.
+
+        Returns
+        -------
+        int
+            0 if good, 2 if an excpetion occurred during publishing
+
+        """
+        basename = os.path.basename(self.path)
+
+        with tqdm(desc=f"{basename}", unit="pt") as progress:
+            try:
+                for checkpoints, payload in self.iter_batches(batch_size):
+                    try:
+                        if payload:
+                            self.db.write_points(payload,
+                                                 batch_size=batch_size,
+                                                 protocol="line")
+                    except InfluxDBClientError as e:
+                        logging.error(f"ERROR in {self.path}")
+                        logging.error(f"client error, likely a type error: {e}")
+                        return 2
+                    self.checkpoints.update(checkpoints)
+                    if self.checkpoint_callback is not None:
+                        self.checkpoint_callback(checkpoints)
+                    progress.update(len(payload))
+            except ValueError:
+                logging.error("Unable to format payload properly, possibly "
+                              + "trying to process old .g3 file format...")
+                return 2
+
+        return 0
+
+    def run(self, batch_size=100000):
+        try:
+            self.scan_file()
+        except Exception:
+            logging.error("Unable to read %s, likely due to old sog3 format."
+                          % self.path)
+            return 2
+        pub_ret = self.publish_file(batch_size=batch_size)
+
+        return pub_ret
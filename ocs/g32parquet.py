@@ -0,0 +1,319 @@
+# Export data from .g3 files to Parquet files, one per provider, block and day.
+
+import os
+import uuid
+import sqlite3
+import datetime
+import logging
+import numpy as np
+
+try:
+    # dependent on so3g and pyarrow, see the 'so3g' and 'parquet' extras
+    import so3g
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from so3g import hk
+    from so3g.spt3g import core
+    from tqdm import tqdm
+    DEPENDENCIES_AVAILABLE = True
+except ImportError:
+    DEPENDENCIES_AVAILABLE = False
+
+
+# Nanoseconds per day, for partitioning by UTC date
+NS_PER_DAY = 86400 * 10**9
+# Rows per row group, small enough that time range filters skip most of a file
+ROW_GROUP_SIZE = 100000
+
+
+def block_to_table(block, since=None):
+    """Convert a block from a data frame to an Arrow table.
+
+    Timestamps are stored in a 'timestamp' column, as nanoseconds since the
+    epoch in UTC. Numeric and boolean fields keep their type, and string
+    fields are dictionary encoded.
+
+    Parameters
+    ----------
+    block : so3g.spt3g.core.G3TimesampleMap
+        Block to convert.
+    since : int
+        Only samples after this time, in nanoseconds since the epoch, are
+        included. If None, all samples are included.
+
+    Returns
+    -------
+    pyarrow.Table
+        Table with one row per sample.
+
+    """
+    # G3Time is an integer number of ticks, so convert exactly
+    ns = np.asarray(block.times) * int(1e9 / core.G3Units.s)
+    mask = slice(None) if since is None else ns > since
+
+    columns = {'timestamp': pa.array(ns[mask], pa.timestamp('ns', tz='UTC'))}
+    for name in block.keys():
+        values = np.asarray(block[name])
+        if values.dtype.kind in 'biuf':
+            columns[name] = pa.array(values[mask])
+        else:
+            strings = pa.array([str(v) for v in values[mask]], pa.string())
+            columns[name] = strings.dictionary_encode()
+
+    return pa.table(columns)
+
+
+def write_part(path, table):
+    """Write rows sorted by time to a new Parquet file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the Parquet file.
+    table : pyarrow.Table
+        Rows to write.
+
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table.sort_by('timestamp'), path,
+                   row_group_size=ROW_GROUP_SIZE, compression='zstd')
+
+
+class ParquetExporter:
+    """Export data from .g3 files to Parquet files.
+
+    Each block of each provider gets its own directory within the output
+    directory, containing a directory per UTC day, i.e.
+    ``<output>/<provider address>/<block name>/<YYYY-MM-DD>/``. Each flush
+    adds a new part file to each day it has rows for, so existing files are
+    never rewritten.
+
+    Files are exported in order of the ctime in their names. Rows are
+    buffered across files, and written once ``max_rows`` rows are buffered or
+    all files have been read, so there are as few part files as possible.
+
+    Progress is recorded in a sqlite database in the output directory, so
+    that rerunning the exporter only reads new or modified files, and only
+    appends samples not already exported. This allows the file currently being
+    written by the aggregator to be exported, and its new samples appended on
+    the next run. Part files are written under temporary names, recorded in
+    the same transaction as the progress, and only then renamed, so an
+    interrupted run neither loses nor duplicates rows.
+
+    Parameters
+    ----------
+    target : str
+        File or directory to scan.
+    output : str
+        Directory to write Parquet files to.
+    max_rows : int
+        Maximum number of rows buffered before writing to disk.
+
+    Attributes
+    ----------
+    sqliteconn : sqlite3.Connection
+        Connection to the sqlite3 database recording progress.
+
+    """
+
+    def __init__(self, target, output, max_rows=5000000):
+        if not DEPENDENCIES_AVAILABLE:
+            raise ImportError("g32parquet requires so3g and pyarrow, install "
+                              "them with 'pip install ocs[so3g,parquet]'.")
+        from ocs.checkdata import _build_file_list
+
+        self.output = os.path.abspath(output)
+        self.max_rows = max_rows
+
+        os.makedirs(self.output, exist_ok=True)
+        self.sqliteconn = sqlite3.connect(os.path.join(self.output, '.g32parquet.db'))
+        self._init_sqlitedb()
+        self._recover()
+
+        self.target = os.path.abspath(target)
+        self._file_list = sorted(_build_file_list(self.target),
+                                 key=os.path.basename)
+
+        # Buffered tables, keyed by (provider address, block name)
+        self._buffers = {}
+        self._buffered_rows = 0
+        # Exported files and their checkpoints, recorded on the next flush
+        self._pending = []
+
+    def _init_sqlitedb(self):
+        """Initialize the sqlitedb.
+
+        The size and modification time of each exported file are recorded in
+        the 'g3files' table. The time of the last exported sample of each
+        block of each file, in nanoseconds since the epoch, is recorded in the
+        'checkpoints' table. Part files that have been committed but not yet
+        renamed from their temporary names are recorded in the 'parts' table.
+
+        """
+        c = self.sqliteconn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS g3files (path TEXT UNIQUE, size INTEGER, mtime REAL)")
+        c.execute("CREATE TABLE IF NOT EXISTS checkpoints (path TEXT, block TEXT, "
+                  "last_time INTEGER, UNIQUE(path, block))")
+        c.execute("CREATE TABLE IF NOT EXISTS parts (tmp_path TEXT UNIQUE, path TEXT)")
+        self.sqliteconn.commit()
+        c.close()
+
+    def _rename_parts(self):
+        """Rename committed part files to their final names."""
+        c = self.sqliteconn.cursor()
+        for tmp_path, path in c.execute("SELECT tmp_path, path FROM parts").fetchall():
+            if os.path.exists(tmp_path):
+                os.replace(tmp_path, path)
+        c.execute("DELETE FROM parts")
+        self.sqliteconn.commit()
+        c.close()
+
+    def _recover(self):
+        """Finish or discard a flush that was interrupted.
+
+        Part files committed to the database are renamed, and any other
+        temporary files, whose rows were never committed, are deleted.
+
+        """
+        self._rename_parts()
+        for dirpath, _, filenames in os.walk(self.output):
+            for filename in filenames:
+                if filename.endswith('.parquet.tmp'):
+                    logging.warning(f"Removing uncommitted {filename}")
+                    os.remove(os.path.join(dirpath, filename))
+
+    def files_to_export(self):
+        """Find files that are new or have changed since they were exported.
+
+        Returns
+        -------
+        list
+            Paths to the files to export, and their size and modification
+            time, as (path, size, mtime) tuples.
+
+        """
+        c = self.sqliteconn.cursor()
+        exported = {path: (size, mtime) for path, size, mtime
+                    in c.execute("SELECT path, size, mtime FROM g3files")}
+        c.close()
+
+        to_export = []
+        for path in self._file_list:
+            stat = os.stat(path)
+            if exported.get(path) != (stat.st_size, stat.st_mtime):
+                to_export.append((path, stat.st_size, stat.st_mtime))
+
+        return to_export
+
+    def _load_checkpoints(self, path):
+        c = self.sqliteconn.cursor()
+        c.execute("SELECT block, last_time FROM checkpoints WHERE path=?", (path, ))
+        checkpoints = dict(c.fetchall())
+        c.close()
+        return checkpoints
+
+    def read_file(self, path):
+        """Read the samples of a file not yet exported into the buffers.
+
+        Parameters
+        ----------
+        path : str
+            Path to the file.
+
+        Returns
+        -------
+        dict
+            Time of the last sample of each block in the file, in nanoseconds
+            since the epoch, keyed by '<provider address>.<block name>'.
+
+        """
+        checkpoints = self._load_checkpoints(path)
+        reader = core.G3Reader(path)
+        translator = hk.HKTranslator()
+        providers = {}
+        try:
+            while True:
+                frames = reader(None)
+                if not frames:
+                    break
+                for frame in translator(frames[0]):
+                    if frame.type != core.G3FrameType.Housekeeping:
+                        continue
+                    if frame['hkagg_type'] == so3g.HKFrameType.status:
+                        providers = {p['prov_id'].value: p['description'].value
+                                     for p in frame['providers']}
+                        continue
+                    if frame['hkagg_type'] != so3g.HKFrameType.data:
+                        continue
+
+                    address = providers.get(frame['prov_id'])
+                    if address is None:
+                        logging.warning(f"Unknown provider {frame['prov_id']} in {path}")
+                        continue
+
+                    for block_name, block in zip(frame['block_names'], frame['blocks']):
+                        key = f"{address}.{block_name}"
+                        table = block_to_table(block, since=checkpoints.get(key))
+                        if table.num_rows == 0:
+                            continue
+                        self._buffers.setdefault((address, block_name), []).append(table)
+                        self._buffered_rows += table.num_rows
+                        checkpoints[key] = table['timestamp'][-1].value
+        except RuntimeError as e:
+            # The aggregator may still be writing the file, export what was
+            # read and pick up the rest on the next run
+            logging.warning(f"Stopped reading {path}: {e}")
+
+        return checkpoints
+
+    def flush(self):
+        """Write the buffered rows to new part files, and record the files
+        they came from as exported.
+
+        The part files are written under temporary names, and renamed once
+        they and the progress have been committed in one transaction.
+
+        """
+        parts = []
+        for (address, block_name), tables in self._buffers.items():
+            table = pa.concat_tables(tables, promote_options='permissive')
+            ns = table['timestamp'].cast(pa.int64()).to_numpy()
+            days = ns // NS_PER_DAY
+            for day in np.unique(days):
+                date = datetime.datetime.fromtimestamp(int(day) * 86400,
+                                                       tz=datetime.timezone.utc)
+                part = table.filter(pa.array(days == day))
+                first = int(ns[days == day].min())
+                path = os.path.join(self.output, address, block_name,
+                                    f"{date:%Y-%m-%d}",
+                                    f"part-{first}-{uuid.uuid4().hex[:8]}.parquet")
+                logging.debug(f"Writing {path}")
+                write_part(path + '.tmp', part)
+                parts.append((path + '.tmp', path))
+
+        c = self.sqliteconn.cursor()
+        c.executemany("INSERT INTO parts VALUES (?, ?)", parts)
+        for path, size, mtime, checkpoints in self._pending:
+            c.executemany("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                          [(path, key, t) for key, t in checkpoints.items()])
+            c.execute("INSERT OR REPLACE INTO g3files VALUES (?, ?, ?)",
+                      (path, size, mtime))
+        self.sqliteconn.commit()
+        c.close()
+        self._rename_parts()
+
+        self._buffers = {}
+        self._buffered_rows = 0
+        self._pending = []
+
+    def run(self):
+        """Export all new or modified files."""
+        to_export = self.files_to_export()
+        logging.info(f"Exporting {len(to_export)} of {len(self._file_list)} files.")
+
+        for path, size, mtime in tqdm(to_export, desc="All Files"):
+            checkpoints = self.read_file(path)
+            self._pending.append((path, size, mtime, checkpoints))
+            if self._buffered_rows >= self.max_rows:
+                self.flush()
+        self.flush()
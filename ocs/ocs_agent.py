@@ -5,7 +5,7 @@ txaio.use_twisted()
 
 from twisted.application.internet import backoffPolicy
 from twisted.internet import reactor, task, threads
-from twisted.internet.defer import inlineCallbacks, Deferred, DeferredList, FirstError, maybeDeferred
+from twisted.internet.defer import inlineCallbacks, CancelledError, Deferred, DeferredList, FirstError, maybeDeferred
 from twisted.internet.error import ReactorNotRunning
 
 from twisted.python import log
@@ -16,13 +16,18 @@ from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
 from autobahn.twisted.util import sleep as dsleep
 from autobahn.wamp.exception import ApplicationError, TransportLost
 from autobahn.exception import Disconnected
-from .ocs_twisted import in_reactor_context
+from .ocs_twisted import in_reactor_context, ReactorLagMonitor, WorkerPool
 from . import access
 
+import asyncio
+import bisect
+import collections
+import itertools
 import json
 import math
 import time
 import datetime
+import inspect
 import signal
 import socket
 import os
@@ -30,6 +35,13 @@ from ocs import client_t
 from ocs import ocs_feed
 from ocs.base import OpCode
 
+#: Number of worker threads in an Agent's shared thread pool, if not
+#: set with --thread-pool-size or in the host config.
+DEFAULT_THREAD_POOL_SIZE = 10
+
+#: Time in seconds between summaries published to the reactor_lag feed.
+REACTOR_LAG_PUBLISH_INTERVAL = 10.
+
 
 def init_site_agent(args, address=None):
     """
@@ -87,11 +99,25 @@ class OCSAgent(ApplicationSession):
         updates are published (written by the Agent; subscribed by any
         interested Control Tools).
 
+      {agent_address}.feeds.sessions - if site_args.session_feed_interval
+        is set, changes to each Operation's session are published
+        here; see :func:`_publish_session`.
+
+      {agent_address}.feeds.reactor_lag - if site_args.reactor_lag_interval
+        is set, a summary of how late the reactor runs timed calls is
+        published here; see :func:`_publish_reactor_lag`.
+
     """
 
     def __init__(self, config, site_args, address=None, class_name=None):
         ApplicationSession.__init__(self, config)
-        self.log.info("Using OCS version {v}", v=ocs.__version__)
+        # ocs.__version__ would run setuptools_scm, which is slow.
+        try:
+            version = ocs._installed_version()
+        except RuntimeError:
+            # Not installed, e.g. running from a source checkout.
+            version = 'unknown'
+        self.log.info("Using OCS version {v}", v=version)
         self.site_args = site_args
         self.tasks = {}       # by op_name
         self.processes = {}   # by op_name
@@ -106,6 +132,20 @@ class OCSAgent(ApplicationSession):
         self.log = txaio.make_logger()
         self.heartbeat_call = None
         self._heartbeat_on = True
+        self.session_feed_interval = getattr(site_args, 'session_feed_interval', None)
+        self.session_feed_call = None
+        self._session_feed_state = {}    # by op_name, see _publish_session.
+        self._session_feed_pending = set()
+        pool_size = getattr(site_args, 'thread_pool_size', None)
+        self.thread_pool = WorkerPool(pool_size or DEFAULT_THREAD_POOL_SIZE,
+                                      name=address)
+        self.lag_monitor = None
+        self.reactor_lag_call = None
+        self._reactor_lag_stalls = 0
+        lag_interval = getattr(site_args, 'reactor_lag_interval', None)
+        if lag_interval is not None:
+            self.lag_monitor = ReactorLagMonitor(
+                lag_interval, threshold=site_args.reactor_lag_threshold)
         self.agent_session_id = str(time.time())
         self.startup_ops = []  # list of (op_type, op_name, op_params)
         self.startup_subs = []  # list of dicts with params for subscribe call
@@ -177,6 +217,93 @@ class OCSAgent(ApplicationSession):
                 'step': message['step'],
             })
 
+    def _publish_sessions(self):
+        """Publish changes to all sessions, including session.data, to the
+        sessions feed.  This is called every session_feed_interval
+        seconds.
+
+        """
+        for session in self.sessions.values():
+            if session is not None:
+                self._publish_session(session, include_data=True)
+
+    def _session_updated(self, session):
+        """Called by OpSession when a message is added (which includes
+        status changes), to publish the change to the sessions feed
+        without waiting for the next _publish_sessions.  Several
+        updates in a row are published together.
+
+        """
+        if self.session_feed_call is None \
+                or session.op_name in self._session_feed_pending:
+            return
+        self._session_feed_pending.add(session.op_name)
+
+        def _publish():
+            self._session_feed_pending.discard(session.op_name)
+            if self.sessions.get(session.op_name) is session:
+                self._publish_session(session)
+        reactor.callLater(0, _publish)
+
+    def _publish_session(self, session, include_data=False):
+        """Publish changes to a session to the sessions feed.
+
+        The message published is the session encoded with changes
+        since the last message for the same Operation; see
+        :func:`OpSession.encoded`.  The first message for each session
+        contains all of its data and messages.  Unless include_data is
+        True, changes to session.data are left for the next periodic
+        publish, to limit the rate at which data is published.
+
+        """
+        state = self._session_feed_state.get(session.op_name)
+        if state is None or state['session_id'] != session.session_id:
+            state = {'session_id': session.session_id, 'version': 0,
+                     'data_version': 0}
+            self._session_feed_state[session.op_name] = state
+            include_data = True
+        try:
+            version = session.version
+            if version == state['version'] and \
+                    (not include_data or version == state['data_version']):
+                return
+            update = dict(session.encoded(since=state['version']))
+            if include_data:
+                data_update = session.encoded(since=state['data_version'])
+                update['data'] = data_update['data']
+                update['data_removed'] = data_update.get('data_removed', [])
+                state['data_version'] = version
+            else:
+                update['data'] = {}
+                update['data_removed'] = []
+        except ValueError as e:
+            self.log.error('Failed to encode session for {op_name}: {e}',
+                           op_name=session.op_name, e=e)
+            return
+        state['version'] = version
+        self.publish_to_feed('sessions', update)
+
+    def _publish_reactor_lag(self):
+        """Publish a summary of the reactor lag since the previous call to
+        the reactor_lag feed, and log the stack of the reactor thread
+        for any new stalls.
+
+        """
+        stats = self.lag_monitor.window_stats()
+        stalls = list(self.lag_monitor.stalls)
+        count = self.lag_monitor.stall_count
+        new_stalls = stalls[max(len(stalls) - (count - self._reactor_lag_stalls), 0):]
+        self._reactor_lag_stalls = count
+        for stall in new_stalls:
+            self.log.warn('Reactor stalled for {lag:.3f} s in:\n{stack}',
+                          lag=stall['lag'], stack=stall['stack'])
+        stats['stalls'] = len(new_stalls)
+        self.publish_to_feed('reactor_lag', {
+            'block_name': 'reactor_lag',
+            'timestamp': time.time(),
+            'data': stats,
+        })
+
     @inlineCallbacks
     def _stop_all_running_sessions(self):
         """Stops all currently running sessions."""
@@ -278,6 +405,18 @@ class OCSAgent(ApplicationSession):
         self.heartbeat_call = task.LoopingCall(heartbeat)
         self.heartbeat_call.start(1.0)  # Calls the hearbeat every second
 
+        if self.session_feed_interval is not None:
+            self.register_feed("sessions")
+            self._session_feed_state = {}
+            self.session_feed_call = task.LoopingCall(self._publish_sessions)
+            self.session_feed_call.start(self.session_feed_interval)
+
+        if self.lag_monitor is not None:
+            self.register_feed("reactor_lag")
+            self.lag_monitor.start()
+            self.reactor_lag_call = task.LoopingCall(self._publish_reactor_lag)
+            self.reactor_lag_call.start(REACTOR_LAG_PUBLISH_INTERVAL, now=False)
+
         # Remove old subscriptions
         self._unsubscribe_all()
 
@@ -321,6 +460,10 @@ class OCSAgent(ApplicationSession):
                 self.heartbeat_call.stop()
             else:
                 self.log.warn('heartbeat was not running')
+        if self.session_feed_call is not None and self.session_feed_call.running:
+            self.session_feed_call.stop()
+        if self.reactor_lag_call is not None and self.reactor_lag_call.running:
+            self.reactor_lag_call.stop()
 
         # Normal shutdown
         if details.reason == "wamp.close.normal":
@@ -393,7 +536,8 @@ class OCSAgent(ApplicationSession):
             'processes': list(self.processes.keys())
         }
 
-    def _ops_handler(self, action, op_name, params=None, timeout=None, password=None):
+    def _ops_handler(self, action, op_name, params=None, timeout=None, password=None,
+                     since=None):
         if action == 'start':
             return self.start(op_name, params=params, password=password)
         if action == 'stop':
@@ -401,11 +545,69 @@ class OCSAgent(ApplicationSession):
         if action == 'abort':
             return self.abort(op_name, params=params, password=password)
         if action == 'wait':
-            return self.wait(op_name, timeout=timeout, password=password)
+            return self.wait(op_name, timeout=timeout, password=password,
+                             since=since)
         if action == 'status':
-            return self.status(op_name, password=password)
+            return self.status(op_name, password=password, since=since)
         return (ocs.ERROR, 'No implementation for "%s"' % op_name, {})
 
+    @inlineCallbacks
+    def _batch_handler(self, requests, concurrent=False, password=None):
+        """Run several requests on the .ops interface, and return all the
+        replies at once.  This is reached through the management
+        handler, with ``q='batch'``.
+
+        Args:
+            requests (list): Requests to run.  Each is a list
+                ``(action, op_name)``, ``(action, op_name, params)``
+                or ``(action, op_name, params, kwargs)``, where kwargs
+                is a dict of additional arguments to the action, such
+                as 'timeout' or 'since' for 'wait'.
+            concurrent (bool): If False, the requests are run in
+                order, each one after the previous has returned (so a
+                'wait' holds up the requests after it).  If True, all
+                requests are issued at once.
+            password (str): Password used for requests that don't
+                pass their own in kwargs.
+
+        Returns:
+            list: A (status, message, session) reply for each request,
+            in the order of the requests.  A request that is invalid,
+            or crashes, gets an ocs.ERROR reply and does not affect
+            the others.
+
+        """
+        def _run(request):
+            d = maybeDeferred(self._run_batch_request, request, password)
+            d.addErrback(self._handle_batch_error, request)
+            return d
+
+        if concurrent:
+            results = yield DeferredList([_run(r) for r in requests])
+            return [reply for _, reply in results]
+
+        replies = []
+        for request in requests:
+            replies.append((yield _run(request)))
+        return replies
+
+    def _run_batch_request(self, request, password):
+        if not 2 <= len(request) <= 4:
+            return (ocs.ERROR, 'Invalid batch request %s; expected '
+                    '(action, op_name[, params[, kwargs]]).' % (request, ), {})
+        action, op_name = request[:2]
+        params = request[2] if len(request) > 2 else None
+        kwargs = dict(request[3]) if len(request) > 3 else {}
+        if password is not None:
+            kwargs.setdefault('password', password)
+        return self._ops_handler(action, op_name, params=params, **kwargs)
+
+    def _handle_batch_error(self, failure, request):
+        self.log.error('Batch request {request} crashed: {err}',
+                       request=request, err=failure.value)
+        return (ocs.ERROR, 'CRASH: during batch request %s: %s'
+                % (request, failure.value), {})
+
     def _gather_sessions(self, parent):
         """Gather the session data for self.tasks or self.sessions, for return
         through the management_handler.
@@ -445,7 +647,8 @@ class OCSAgent(ApplicationSession):
         ----------
         q : string
           One of 'get_api', 'get_tasks', 'get_processes', 'get_feeds',
-          'get_agent_class'.
+          'get_agent_class', 'batch'.  For 'batch', the kwargs are
+          passed to :func:`_batch_handler`.
 
         Returns
         -------
@@ -469,6 +672,22 @@ class OCSAgent(ApplicationSession):
             update count. If this isn't present (i.e. in older ocs),
             passing "password" argument to API calls will likely
             produce an error.
+          - 'session_versions': if present and True, the "wait" and
+            "status" API calls accept a "since" argument, to request
+            only the changes to the session since a version; see
+            :func:`OpSession.encoded`.
+          - 'session_feed': if present and True, changes to sessions
+            are published to the "sessions" feed.
+          - 'reactor_lag': if present and not None, the histogram of
+            reactor lag and recent stalls; see
+            :func:`ocs.ocs_twisted.ReactorLagMonitor.stats`.
+          - 'thread_pools': if present, usage of the thread pools
+            running blocking operations, with the 'shared' pool and
+            'dedicated' pools by op_name; see
+            :func:`ocs.ocs_twisted.WorkerPool.stats`.
+          - 'batch': if present and True, several requests on the
+            .ops interface can be made in one call, with q='batch';
+            see :func:`_batch_handler`.
 
           Passing get_X will, for some values of X, return only that
           subset of the full API; treat that as deprecated.
@@ -483,6 +702,12 @@ class OCSAgent(ApplicationSession):
                 'processes': self._gather_sessions(self.processes),
                 'tasks': self._gather_sessions(self.tasks),
                 'access_control': self.access_data,
+                'session_versions': True,
+                'session_feed': self.session_feed_interval is not None,
+                'thread_pools': self._thread_pool_stats(),
+                'batch': True,
+                'reactor_lag': (self.lag_monitor.stats()
+                                if self.lag_monitor is not None else None),
             }
         if q == 'get_tasks':
             return self._gather_sessions(self.tasks)
@@ -492,10 +717,12 @@ class OCSAgent(ApplicationSession):
             return [(k, v.encoded()) for k, v in self.feeds.items()]
         if q == 'get_agent_class':
             return self.class_name
+        if q == 'batch':
+            return self._batch_handler(**kwargs)
 
     def register_task(self, name, func, aborter=None, blocking=True,
                       aborter_blocking=None, startup=False,
-                      min_privs=0):
+                      min_privs=0, dedicated_thread=False):
         """Register a Task for this agent.
 
         Args:
@@ -506,7 +733,9 @@ class OCSAgent(ApplicationSession):
                 handle the "abort" operation of the Task (optional).
             blocking (bool): Indicates that ``func`` should be
                launched in a worker thread, rather than running in the
-               main reactor thread.
+               main reactor thread.  Ignored if ``func`` is a
+               coroutine function (``async def``), which is run as an
+               asyncio Task; see Notes.
             aborter_blocking(bool or None): Indicates that ``aborter``
                should be run in a worker thread, rather than running
                in the main reactor thread.  Defaults to value of
@@ -520,6 +749,10 @@ class OCSAgent(ApplicationSession):
                 function.
             min_privs (int): Minimum privilege level required to start
                 or abort this operation (1, 2, 3).  See Access Control.
+            dedicated_thread (bool): If True, and ``blocking``, the
+                Task runs in a thread of its own, rather than in the
+                Agent's shared thread pool, so it never waits for other
+                Operations to finish.
 
         Notes:
 
@@ -530,17 +763,27 @@ class OCSAgent(ApplicationSession):
             (Passing params to the aborter might not be supported in
             the client library so don't count on that being useful.)
 
+            If func is a coroutine function, it is run as an asyncio
+            Task, which requires the asyncio reactor; see
+            :func:`ocs.ocs_twisted.install_asyncio_reactor`.  If no
+            aborter is given, aborting the Task cancels it.  The
+            aborter may also be a coroutine function.
+
         """
+        if inspect.iscoroutinefunction(func):
+            _require_asyncio_reactor(name)
         self.tasks[name] = AgentTask(
             func, blocking=blocking, aborter=aborter,
             aborter_blocking=aborter_blocking,
-            min_privs=min_privs)
+            min_privs=min_privs,
+            pool=self._get_op_pool(name, dedicated_thread))
         self.sessions[name] = None
         if startup is not False:
             self.startup_ops.append(('task', name, startup))
 
     def register_process(self, name, start_func, stop_func, blocking=True,
-                         stopper_blocking=None, startup=False, min_privs=0):
+                         stopper_blocking=None, startup=False, min_privs=0,
+                         dedicated_thread=False):
         """Register a Process for this agent.
 
         Args:
@@ -551,7 +794,9 @@ class OCSAgent(ApplicationSession):
                 handle the "stop" operation of the Process.
             blocking (bool): Indicates that ``start_func`` should be
                 launched in a worker thread, rather than running in
-                the reactor.
+                the reactor.  Ignored if ``start_func`` is a coroutine
+                function (``async def``), which is run as an asyncio
+                Task; see Notes.
             stopper_blocking (bool or None): Indicates that
                 ``stop_func`` should be launched in a worker thread,
                 rather than running in the reactor.  Defaults to the
@@ -565,6 +810,10 @@ class OCSAgent(ApplicationSession):
                 function.
             min_privs (int): Minimum privilege level required to start
                 or stop this operation (1, 2, 3).  See Access Control.
+            dedicated_thread (bool): If True, and ``blocking``, the
+                Process runs in a thread of its own, rather than in the
+                Agent's shared thread pool, so it never waits for other
+                Operations to finish.
 
         Notes:
             The functions start_func and stop_func will be called with
@@ -574,15 +823,45 @@ class OCSAgent(ApplicationSession):
             (Passing params to the stop_func might not be supported in
             the client library so don't count on that being useful.)
 
+            If start_func is a coroutine function, it is run as an
+            asyncio Task, which requires the asyncio reactor; see
+            :func:`ocs.ocs_twisted.install_asyncio_reactor`.  If
+            stop_func is None, stopping the Process cancels it.  The
+            stop_func may also be a coroutine function.
+
         """
+        if inspect.iscoroutinefunction(start_func):
+            _require_asyncio_reactor(name)
         self.processes[name] = AgentProcess(
             start_func, stop_func, blocking=blocking,
             stopper_blocking=stopper_blocking,
-            min_privs=min_privs)
+            min_privs=min_privs,
+            pool=self._get_op_pool(name, dedicated_thread))
         self.sessions[name] = None
         if startup is not False:
             self.startup_ops.append(('process', name, startup))
 
+    def _get_op_pool(self, name, dedicated_thread):
+        """Get the WorkerPool that runs the blocking Operation called
+        name.
+
+        """
+        if dedicated_thread:
+            return WorkerPool(1, name=f'{self.agent_address}.{name}')
+        return self.thread_pool
+
+    def _thread_pool_stats(self):
+        """Stats of the shared and dedicated thread pools; see
+        :func:`ocs.ocs_twisted.WorkerPool.stats`.
+
+        """
+        ops = list(self.tasks.items()) + list(self.processes.items())
+        return {
+            'shared': self.thread_pool.stats(),
+            'dedicated': {name: op.pool.stats() for name, op in ops
+                          if op.blocking and op.pool is not self.thread_pool},
+        }
+
     @inlineCallbacks
     def call_op(self, agent_address, op_name, action, params=None, timeout=None):
         """
@@ -822,10 +1101,9 @@ class OCSAgent(ApplicationSession):
                         {})
 
             # Pre-process params?
-            if hasattr(op.launcher, '_ocs_prescreen'):
+            if op.param_validator is not None:
                 try:
-                    handler = ParamHandler(params)
-                    params = handler.batch(op.launcher._ocs_prescreen)
+                    params = op.param_validator(params)
                 except ParamError as err:
                     self.log.error("Caught ParamError during start call: {err}", err=err)
                     return (ocs.ERROR, err.msg, {})
@@ -851,13 +1129,16 @@ class OCSAgent(ApplicationSession):
             return (ocs.ERROR, 'No task or process called "%s"' % op_name, {})
 
     @inlineCallbacks
-    def wait(self, op_name, timeout=None, password=None):
+    def wait(self, op_name, timeout=None, password=None, since=None):
         """Wait for the specified Operation to become idle, or for timeout
         seconds to elapse.  If timeout==None, the timeout is disabled
         and the function will not return until the Operation
         terminates.  If timeout<=0, then the function will return
         immediately.
 
+        If since is not None, the session returned only contains the
+        changes since that version; see :func:`OpSession.encoded`.
+
         Returns (status, message, session).
 
         Possible values for status:
@@ -911,10 +1192,10 @@ class OCSAgent(ApplicationSession):
         if done:
             success_str = {True: 'SUCCEEDED'}.get(session.success, 'FAILED')
             return (ocs.OK, f'Operation "{op_name}" is currently not running '
-                    + f'({success_str}).', session.encoded())
+                    + f'({success_str}).', session.encoded(since))
         else:
             return (ocs.TIMEOUT, 'Operation "%s" still running; wait timed out.' % op_name,
-                    session.encoded())
+                    session.encoded(since))
 
     def _stop_helper(self, stop_type, op_name, params, password):
         """Common stopper/aborter code for Process stop and Task
@@ -979,7 +1260,14 @@ class OCSAgent(ApplicationSession):
             print(f'Error calling stopper for "{op_name}"; args:',
                   args, kw)
 
-        if stopper_blocking:
+        if stopper is None and op.coroutine:
+            # Cancel the asyncio Task, at whatever it is awaiting.
+            session.set_status('stopping')
+            op.cancel()
+        elif inspect.iscoroutinefunction(stopper):
+            d2 = Deferred.fromFuture(asyncio.ensure_future(stopper(session, params)))
+            d2.addCallback(_callback).addErrback(_errback)
+        elif stopper_blocking:
             # Launch the code in a thread.
             d2 = threads.deferToThread(stopper, session, params)
             d2.addCallback(_callback).addErrback(_errback)
@@ -1038,12 +1326,14 @@ class OCSAgent(ApplicationSession):
         """
         return self._stop_helper('abort', op_name, params, password)
 
-    def status(self, op_name, params=None, password=None):
+    def status(self, op_name, params=None, password=None, since=None):
         """
         Get an Operation's session data.
 
         Returns (status, message, session).  When there is no session
-        data available, an empty dictionary is returned instead.
+        data available, an empty dictionary is returned instead.  If
+        since is not None, the session only contains the changes since
+        that version; see :func:`OpSession.encoded`.
 
         Possible values for status:
 
@@ -1056,48 +1346,106 @@ class OCSAgent(ApplicationSession):
             if session is None:
                 return (ocs.OK, 'No session active.', {})
             else:
-                return (ocs.OK, 'Session active.', session.encoded())
+                return (ocs.OK, 'Session active.', session.encoded(since))
         else:
             return (ocs.ERROR, 'No task or process called "%s"' % op_name, {})
 
 
+def _require_asyncio_reactor(op_name):
+    """Raise RuntimeError unless the reactor supports running
+    coroutine Operations.
+
+    """
+    from twisted.internet.asyncioreactor import AsyncioSelectorReactor
+    if not isinstance(reactor, AsyncioSelectorReactor):
+        raise RuntimeError(
+            f'Operation {op_name} is a coroutine function, which needs the '
+            'asyncio reactor. Call ocs.ocs_twisted.install_asyncio_reactor() '
+            'before importing ocs.ocs_agent.')
+
+
+def _compile_launcher_params(launcher):
+    """Compile the @param instructions of an Operation start function,
+    returning None if it has none.
+
+    """
+    instructions = getattr(launcher, '_ocs_prescreen', None)
+    if instructions is None:
+        return None
+    return compile_params(instructions)
+
+
 class AgentOp:
+    #: Result of a coroutine Operation that is cancelled.
+    cancelled_result = (False, 'Operation cancelled.')
+
     def launch_deferred(self, session, params):
         """Launch the operation using the launcher function, either in
-        a worker thread (self.blocking) or in the reactor (not
-        self.blocking).  Return a Deferred.  Prior to executing the
-        operation code, set session state to "running".
+        a worker thread (self.blocking), as an asyncio Task
+        (self.coroutine), or in the reactor.  Return a Deferred.
+        Prior to executing the operation code, set session state to
+        "running".
 
         """
         def _running_wrapper(session, params):
             session.set_status('running')
             return self.launcher(session, params)
 
-        if self.blocking:
+        if self.coroutine:
+            return task.deferLater(reactor, 0, self._launch_coroutine,
+                                   session, params)
+        elif self.blocking:
             # Launch, soon, in a blockable worker thread.
-            return threads.deferToThread(_running_wrapper, session, params)
+            if self.pool is None:
+                return threads.deferToThread(_running_wrapper, session, params)
+            return self.pool.defer(session.op_name, _running_wrapper,
+                                   session, params)
         else:
             # Launch, soon, in the main reactor thread.
             return task.deferLater(reactor, 0, _running_wrapper, session, params)
 
+    def _launch_coroutine(self, session, params):
+        session.set_status('running')
+        self._future = asyncio.ensure_future(self.launcher(session, params))
+        d = Deferred.fromFuture(self._future)
+        d.addErrback(self._handle_cancelled)
+        return d
+
+    def _handle_cancelled(self, failure):
+        failure.trap(asyncio.CancelledError, CancelledError)
+        return self.cancelled_result
+
+    def cancel(self):
+        """Cancel the asyncio Task running a coroutine Operation."""
+        if self._future is not None:
+            self._future.cancel()
+
 
 class AgentTask(AgentOp):
+    cancelled_result = (False, 'Task aborted.')
+
     def __init__(self, launcher, blocking=None, aborter=None,
-                 aborter_blocking=None, min_privs=1):
+                 aborter_blocking=None, min_privs=1, pool=None):
         self.launcher = launcher
+        self.coroutine = inspect.iscoroutinefunction(launcher)
+        if self.coroutine:
+            blocking = False
+        self._future = None
         self.blocking = blocking
+        self.pool = pool
         self.aborter = aborter
         if aborter_blocking is None:
             aborter_blocking = blocking
         self.aborter_blocking = aborter_blocking
         self.docstring = launcher.__doc__
+        self.param_validator = _compile_launcher_params(launcher)
         self.min_privs = access.CredLevel(max(1, min_privs))
 
     def encoded(self):
         """Dict of static info for API self-description."""
         return {
             'blocking': self.blocking,
-            'abortable': (self.aborter is not None),
+            'abortable': (self.aborter is not None or self.coroutine),
             'docstring': self.docstring,
             'op_type': 'task',
             'min_privs': self.min_privs.value,
@@ -1105,15 +1453,23 @@ class AgentTask(AgentOp):
 
 
 class AgentProcess(AgentOp):
+    cancelled_result = (True, 'Process stopped.')
+
     def __init__(self, launcher, stopper, blocking=None, stopper_blocking=None,
-                 min_privs=0):
+                 min_privs=0, pool=None):
         self.launcher = launcher
         self.stopper = stopper
+        self.coroutine = inspect.iscoroutinefunction(launcher)
+        if self.coroutine:
+            blocking = False
+        self._future = None
         self.blocking = blocking
+        self.pool = pool
         if stopper_blocking is None:
             stopper_blocking = blocking
         self.stopper_blocking = stopper_blocking
         self.docstring = launcher.__doc__
+        self.param_validator = _compile_launcher_params(launcher)
         self.min_privs = access.CredLevel(max(1, min_privs))
 
     def encoded(self):
@@ -1141,6 +1497,195 @@ class AgentProcess(AgentOp):
 SESSION_STATUS_CODES = [None, 'starting', 'running', 'stopping', 'done']
 
 
+def _fingerprint_default(obj):
+    if hasattr(obj, 'dtype'):
+        # numpy arrays and scalars.
+        return obj.tolist()
+    raise TypeError(f'Cannot fingerprint {type(obj)}')
+
+
+def _data_fingerprint(data):
+    """Serialize session data to a string that changes whenever the
+    output of _json_safe(data) might, or return None if that isn't
+    possible.
+
+    """
+    try:
+        return json.dumps(data, default=_fingerprint_default)
+    except (TypeError, ValueError):
+        return None
+
+
+def _json_safe(data, check_ok=False):
+    """Convert data so it can be serialized and decoded on
+    the other end.  This includes:
+
+    - Converting numpy arrays and scalars to generic lists and
+      Python basic types.
+
+    - Converting NaN to None (although crossbar handles
+      NaN/inf, web browsers may fail to deserialize the
+      invalid JSON this requires).
+
+    In the case of inf/-inf, a ValueError is raised.
+
+    """
+    if check_ok:
+        output = _json_safe(data)
+        json.dumps(output, allow_nan=False)
+        return output
+    if isinstance(data, dict):
+        return {k: _json_safe(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_json_safe(x) for x in data]
+    if hasattr(data, 'dtype'):
+        # numpy arrays and scalars.
+        return _json_safe(data.tolist())
+    if isinstance(data, (str, int, bool)):
+        return data
+    if isinstance(data, float):
+        if math.isnan(data):
+            return None
+        if not math.isfinite(data):
+            raise ValueError('Session.data cannot store inf/-inf; '
+                             'please convert to NaN.')
+    # This could still be something weird but json.dumps will
+    # probably reject it!
+    return data
+
+
+#: Source of OpSession versions.  Versions are shared by all sessions,
+#: so that a version from one session is older than every change to
+#: any later session.  They start from the time in microseconds, so
+#: that they also keep increasing when the Agent is restarted, unlike
+#: session ids.
+_session_versions = itertools.count(int(time.time() * 1e6))
+
+
+class MessageBuffer:
+    """Bounded, time-ordered buffer of (timestamp, message) tuples, for the
+    OpSession message log.
+
+    Messages are stored in a ring buffer, so that the oldest message is
+    discarded in constant time once the buffer is full.  Messages
+    older than ``max_age`` are discarded as new messages are added, or
+    when :meth:`expire` is called, but the most recent ``min_messages``
+    are always kept.
+
+    The buffer supports ``len()``, iteration from oldest to newest, and
+    indexing.  Messages are assumed to be added in time order.
+
+    Args:
+        max_messages (int): Maximum number of messages to keep, even
+            if they have not expired.
+        min_messages (int): Number of messages to keep, even if they
+            have expired.
+        max_age (float): Time in seconds after which messages can be
+            discarded.
+
+    """
+
+    def __init__(self, max_messages=10000, min_messages=5, max_age=3600):
+        self.max_messages = max_messages
+        self.min_messages = min_messages
+        self.max_age = max_age
+        # The list is used as a ring, with _start pointing at the
+        # oldest message.  Its size doubles as needed, up to
+        # max_messages.
+        self._buffer = []
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _index(self, i):
+        return (self._start + i) % len(self._buffer)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError('MessageBuffer index out of range')
+        return self._buffer[self._index(i)]
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._buffer[self._index(i)]
+
+    def __repr__(self):
+        return 'MessageBuffer(%r)' % list(self)
+
+    def _pop_oldest(self):
+        self._buffer[self._start] = None
+        self._start = (self._start + 1) % len(self._buffer)
+        self._count -= 1
+
+    def _grow(self):
+        size = min(max(2 * len(self._buffer), 16), self.max_messages)
+        self._buffer = list(self) + [None] * (size - self._count)
+        self._start = 0
+
+    def append(self, message):
+        """Add a (timestamp, text) tuple to the buffer, discarding the
+        oldest message if the buffer is full, and any expired
+        messages.
+
+        """
+        if self._count == self.max_messages:
+            self._pop_oldest()
+        if self._count == len(self._buffer):
+            self._grow()
+        self._buffer[self._index(self._count)] = message
+        self._count += 1
+        self.expire(message[0])
+
+    def expire(self, now=None):
+        """Discard messages older than ``max_age``, keeping at least
+        ``min_messages``.
+
+        Args:
+            now (float): Current time, as a unix timestamp.  Defaults
+                to time.time().
+
+        """
+        if now is None:
+            now = time.time()
+        cutoff = now - self.max_age
+        while self._count > self.min_messages and self[0][0] < cutoff:
+            self._pop_oldest()
+
+    def since(self, timestamp):
+        """Get the messages added after a time.
+
+        Args:
+            timestamp (float): Unix timestamp.
+
+        Returns:
+            list: The (timestamp, text) tuples of messages with
+            timestamps greater than ``timestamp``, oldest first.
+
+        """
+        keys = _IndexedTimestamps(self)
+        first = bisect.bisect_right(keys, timestamp)
+        return [self[i] for i in range(first, self._count)]
+
+
+class _IndexedTimestamps:
+    """Sequence view of the timestamps in a MessageBuffer, for bisect."""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, i):
+        return self.messages[i][0]
+
+
 class OpSession:
     """When a caller requests that an Operation (Process or Task) is
     started, an OpSession object is created and is associated with
@@ -1156,9 +1701,14 @@ class OpSession:
 
     Control Clients are given a copy of the latest session information
     in each response from the Operation API.  The format of that
-    information is described in ``.encoded()``.
+    information is described in ``.encoded()``.  The encoded session
+    is cached, and carries a version that increases whenever the
+    encoded content changes, so that clients may request only what
+    changed since a version they have already seen.
 
-    The message buffer is purged periodically.
+    The message buffer (see :class:`MessageBuffer`) is bounded in size,
+    and old messages are discarded as new ones are added, and
+    periodically.
 
     """
 
@@ -1167,7 +1717,7 @@ class OpSession:
         # Note that some data members are used internally, while others are
         # communicated over WAMP to Agent control clients.
 
-        self.messages = []  # entries are time-ordered (timestamp, text).
+        self.messages = None  # MessageBuffer, see below.
         self.data = {}      # Operation-specific data structures.
         self.degraded = False
         self.session_id = session_id
@@ -1179,9 +1729,6 @@ class OpSession:
         self.status = None
         self.cred_level = cred_level
 
-        # This has to be the last call since it depends on init...
-        self.set_status(status, timestamp=self.start_time)
-
         # Set up the log message purge.
         self.purge_policy = {
             'min_age_s': 3600,     # Time in seconds after which
@@ -1193,25 +1740,61 @@ class OpSession:
         }
         if purge_policy is not None:
             self.purge_policy.update(purge_policy)
+        self.messages = MessageBuffer(
+            max_messages=self.purge_policy['max_messages'],
+            min_messages=self.purge_policy['min_messages'],
+            max_age=self.purge_policy['min_age_s'])
+
+        # State of the cached encoding, see _refresh().
+        self._messages_added = 0
+        self._data_fingerprint = None
+        self._encoded = None
+        self._first_version = None
+        self._encoded_messages_added = 0
+        self._data_versions = {}
+        self._removed_versions = {}
+        self._message_versions = collections.deque()
+
+        # This has to be the last call since it depends on init...
+        self.set_status(status, timestamp=self.start_time)
+
         self.purge_log()
 
+    @property
+    def version(self):
+        """The version of the encoded session.  This increases whenever
+        the encoded session changes."""
+        self._refresh()
+        return self._encoded['version']
+
     def purge_log(self):
-        cutoff = time.time() - self.purge_policy['min_age_s']
-        while ((len(self.messages) > self.purge_policy['max_messages'])
-               or ((len(self.messages) > self.purge_policy['min_messages'])
-               and self.messages[0][0] < cutoff)):
-            self.messages.pop(0)
+        # The message count is limited, and old messages discarded, as
+        # messages are added.  This catches messages that expire while
+        # the Operation is quiet.
+        self.messages.expire()
         # Set this purger to be called again in the future, at some
         # cadence based on the minimum message age.
         next_purge_time = max(self.purge_policy['min_age_s'] / 5, 600)
         self.purger = task.deferLater(reactor, next_purge_time, self.purge_log)
 
-    def encoded(self):
+    def encoded(self, since=None):
         """Encode the session data in a dict.  This is the data structure that
         is returned to Control Clients using the Operation API, as the
         "session" information.  Note the returned object is a dict
         with entries described below.
 
+        The encoding is cached until the session changes, and the
+        returned dict is shared between callers, so must not be
+        modified.
+
+        Parameters
+        ----------
+        since : int or None
+          If not None, a version previously returned in the
+          ``version`` entry.  Only the ``data`` entries and messages
+          that have changed since that version are returned; see
+          Notes.
+
         Returns
         -------
         session_id : int
@@ -1256,6 +1839,10 @@ class OpSession:
           A buffer of messages posted by the Operation.  Each element
           of the list is a tuple, (timestamp, message) where timestamp
           is a unix timestamp and message is a string.
+        version : int
+          The version of this encoding.  Versions increase whenever
+          any of the entries above change, and are unique across all
+          sessions in the Agent.
 
         Notes
         -----
@@ -1268,55 +1855,93 @@ class OpSession:
         Please see developer documentation (:ref:`session_data`) for
         advice on structuring your Agent session data.
 
+        When ``since`` is passed, ``data`` contains only the top-level
+        keys whose values changed after that version, and
+        ``messages`` only the messages added after that version.  An
+        additional ``data_removed`` entry lists keys removed from
+        ``data``, and ``since`` echoes the requested version.  All
+        other entries are as above.  Such a delta can be applied to a
+        previous encoding with :func:`ocs.ocs_client.merge_session`.
+
+        If ``since`` is not a version of this session, i.e. it is from
+        an earlier session or from before the Agent was restarted, the
+        full encoding is returned instead.
+
+        """
+        self._refresh()
+        if since is None or \
+                not self._first_version <= since <= self._encoded['version']:
+            return self._encoded
+
+        delta = {k: v for k, v in self._encoded.items()
+                 if k not in ['data', 'messages']}
+        delta['since'] = since
+        delta['data'] = {k: self._encoded['data'][k]
+                         for k, v in self._data_versions.items() if v > since}
+        delta['data_removed'] = [k for k, v in self._removed_versions.items()
+                                 if v > since]
+        first = bisect.bisect_right(self._message_versions, since)
+        delta['messages'] = self.messages[first:]
+        return delta
+
+    def _refresh(self):
+        """Update the cached encoding, if anything has changed since it
+        was last updated, and assign it a new version.
+
+        The header fields and message count are cheap to check on each
+        call.  Agent code may modify ``data`` in place at any time, so
+        it is fingerprinted with json.dumps, which is much faster than
+        _json_safe, and only encoded again if the fingerprint changed.
+
         """
-        def json_safe(data, check_ok=False):
-            """Convert data so it can be serialized and decoded on
-            the other end.  This includes:
-
-            - Converting numpy arrays and scalars to generic lists and
-              Python basic types.
-
-            - Converting NaN to None (although crossbar handles
-              NaN/inf, web browsers may fail to deserialize the
-              invalid JSON this requires).
-
-            In the case of inf/-inf, a ValueError is raised.
-
-            """
-            if check_ok:
-                output = json_safe(data)
-                json.dumps(output, allow_nan=False)
-                return output
-            if isinstance(data, dict):
-                return {k: json_safe(v) for k, v in data.items()}
-            if isinstance(data, (list, tuple)):
-                return [json_safe(x) for x in data]
-            if hasattr(data, 'dtype'):
-                # numpy arrays and scalars.
-                return json_safe(data.tolist())
-            if isinstance(data, (str, int, bool)):
-                return data
-            if isinstance(data, float):
-                if math.isnan(data):
-                    return None
-                if not math.isfinite(data):
-                    raise ValueError('Session.data cannot store inf/-inf; '
-                                     'please convert to NaN.')
-            # This could still be something weird but json.dumps will
-            # probably reject it!
-            return data
-
-        return {'session_id': self.session_id,
-                'op_name': self.op_name,
-                'op_code': self.op_code.value,
-                'cred_level': self.cred_level,
-                'status': self.status,
-                'degraded': self.degraded,
-                'success': self.success,
-                'start_time': self.start_time,
-                'end_time': self.end_time,
-                'data': json_safe(self.data, True),
-                'messages': self.messages}
+        header = {'session_id': self.session_id,
+                  'op_name': self.op_name,
+                  'op_code': self.op_code.value,
+                  'cred_level': self.cred_level,
+                  'status': self.status,
+                  'degraded': self.degraded,
+                  'success': self.success,
+                  'start_time': self.start_time,
+                  'end_time': self.end_time}
+        encoded = self._encoded or {}
+        changed = any(encoded.get(k) != v for k, v in header.items())
+
+        data = encoded.get('data', {})
+        changed_keys = []
+        removed_keys = []
+        fingerprint = _data_fingerprint(self.data)
+        if fingerprint is None or fingerprint != self._data_fingerprint:
+            data = _json_safe(self.data, True)
+            self._data_fingerprint = fingerprint
+            old_data = encoded.get('data', {})
+            changed_keys = [k for k, v in data.items()
+                            if k not in old_data or old_data[k] != v]
+            removed_keys = [k for k in old_data if k not in data]
+
+        new_messages = self._messages_added - self._encoded_messages_added
+
+        if self._encoded is not None and not (changed or changed_keys
+                                              or removed_keys or new_messages):
+            return
+
+        version = next(_session_versions)
+        if self._first_version is None:
+            self._first_version = version
+        for k in changed_keys:
+            self._data_versions[k] = version
+            self._removed_versions.pop(k, None)
+        for k in removed_keys:
+            self._data_versions.pop(k, None)
+            self._removed_versions[k] = version
+        # Versions of the messages are kept aligned with the end of
+        # the message buffer.
+        self._message_versions.extend([version] * min(new_messages, len(self.messages)))
+        while len(self._message_versions) > len(self.messages):
+            self._message_versions.popleft()
+        self._encoded_messages_added = self._messages_added
+
+        self._encoded = dict(header, version=version, data=data,
+                             messages=list(self.messages))
 
     @property
     def op_code(self):
@@ -1340,12 +1965,15 @@ class OpSession:
         else:
             return OpCode.FAILED
 
-    def set_status(self, status, timestamp=None):
+    def set_status(self, status, timestamp=None, wait=True):
         """Update the OpSession status and possibly post a message about it.
 
         Args:
             status (string): New value for status (see below).
             timestamp (float): timestamp for the operation.
+            wait (bool): If called from a worker thread, block until
+                the new status has been applied in the reactor.  Pass
+                False to schedule the change and return immediately.
 
         The possible values for status are:
 
@@ -1369,16 +1997,26 @@ class OpSession:
         the status of an OpSession to move from stopping to running.
 
         If this function is called from a worker thread, it will be
-        scheduled to run in the reactor, and will block until that is
-        complete.
+        scheduled to run in the reactor.  By default it blocks until the
+        change has been applied.  With wait=False it returns
+        immediately, so session.status may not change right away.
+        Changes scheduled from a worker thread are applied in order,
+        along with messages from add_message.  A scheduled change that
+        would move the status backward, because the status has moved on
+        in the meantime (e.g. the Operation was stopped before it was
+        marked as running), is ignored.
 
         """
         if timestamp is None:
             timestamp = time.time()
         if not in_reactor_context():
-            return threads.blockingCallFromThread(reactor,
-                                                  self.set_status, status,
-                                                  timestamp=timestamp)
+            if wait:
+                return threads.blockingCallFromThread(reactor,
+                                                      self.set_status, status,
+                                                      timestamp=timestamp)
+            SESSION_STATUS_CODES.index(status)  # raise now if invalid.
+            reactor.callFromThread(self._set_status_scheduled, status, timestamp)
+            return
         # Sanity check the status value.
         from_index = SESSION_STATUS_CODES.index(self.status)  # current status valid?
         to_index = SESSION_STATUS_CODES.index(status)        # new status valid?
@@ -1397,6 +2035,15 @@ class OpSession:
             self.app.log.error('setting session status to "{s}" failed. '
                                + 'transport lost or disconnected', s=status)
 
+    def _set_status_scheduled(self, status, timestamp):
+        """Apply a status change scheduled by set_status from a worker
+        thread, unless the status has since moved past it.
+
+        """
+        if SESSION_STATUS_CODES.index(status) < SESSION_STATUS_CODES.index(self.status):
+            return
+        self.set_status(status, timestamp=timestamp)
+
     def add_message(self, message, timestamp=None):
         """Add a log message to the OpSession messages buffer.
 
@@ -1413,6 +2060,8 @@ class OpSession:
             return reactor.callFromThread(self.add_message, message,
                                           timestamp=timestamp)
         self.messages.append((timestamp, message))
+        self._messages_added += 1
+        self.app._session_updated(self)
         # Make the app log this message, too.  The op_name and
         # session_id are an important provenance prefix.
         self.app.log.info('%s:%i %s' % (self.op_name, self.session_id, message))
@@ -1562,35 +2211,10 @@ class ParamHandler:
 
         """
         self._checked.add(key)
-        value = self._params.get(key, None)
-        is_unset = value is None and \
-            (treat_none_as_missing or key not in self._params)
-        if is_unset:
-            if isinstance(default, ParamError):
-                raise ParamError(f"Param '{key}' is required and must not be None")
-            value = default
-        if value is not None:
-            if cast is not None:
-                try:
-                    value = cast(value)
-                except BaseException:
-                    raise ParamError(f"Param '{key}'={value} could not be cast to {cast}.")
-            if type is not None:
-                # Free cast from int to float.
-                if type is float and isinstance(value, int):
-                    value = float(value)
-                # Fix type after json conversion
-                if type is tuple and isinstance(value, list) and cast in [tuple, None]:
-                    value = tuple(value)
-                if not isinstance(value, type):
-                    raise ParamError(f"Param '{key}'={value} is not of required type ({type})")
-            if choices is not None:
-                if value not in choices:
-                    raise ParamError(f"Param '{key}'={value} is not in allowed set ({choices})")
-            if check is not None:
-                if not check(value):
-                    raise ParamError(f"Param '{key}' failed validity check (see docs?).")
-        return value
+        get = _compile_param(key, default=default, check=check, cast=cast,
+                             type=type, choices=choices,
+                             treat_none_as_missing=treat_none_as_missing)
+        return get(self._params)
 
     def batch(self, instructions, check_for_strays=True):
         """
@@ -1620,6 +2244,109 @@ class ParamHandler:
             raise ParamError(f"params included unexpected values: {weird_args}")
 
 
+def _compile_param(key, default=ParamError(''), check=None, cast=None,
+                   type=None, choices=None, treat_none_as_missing=True):
+    """Build a function that extracts one param from a params dict, as
+    described in :meth:`ParamHandler.get`, which is implemented with
+    it.  Only the steps that are needed are included, so the function
+    can be built once and reused, as in :func:`compile_params`.
+
+    """
+    required = isinstance(default, ParamError)
+    fix_tuple = type is tuple and cast in [tuple, None]
+    steps = []
+
+    if cast is not None:
+        def _cast(value):
+            try:
+                return cast(value)
+            except BaseException:
+                raise ParamError(f"Param '{key}'={value} could not be cast to {cast}.")
+        steps.append(_cast)
+
+    if type is not None:
+        def _type(value):
+            # Free cast from int to float.
+            if type is float and isinstance(value, int):
+                value = float(value)
+            # Fix type after json conversion
+            if fix_tuple and isinstance(value, list):
+                value = tuple(value)
+            if not isinstance(value, type):
+                raise ParamError(f"Param '{key}'={value} is not of required type ({type})")
+            return value
+        steps.append(_type)
+
+    if choices is not None:
+        def _choices(value):
+            if value not in choices:
+                raise ParamError(f"Param '{key}'={value} is not in allowed set ({choices})")
+            return value
+        steps.append(_choices)
+
+    if check is not None:
+        def _check(value):
+            if not check(value):
+                raise ParamError(f"Param '{key}' failed validity check (see docs?).")
+            return value
+        steps.append(_check)
+
+    def _get(params):
+        value = params.get(key, None)
+        if value is None and (treat_none_as_missing or key not in params):
+            if required:
+                raise ParamError(f"Param '{key}' is required and must not be None")
+            value = default
+        if value is not None:
+            for step in steps:
+                value = step(value)
+        return value
+    return _get
+
+
+def compile_params(instructions, check_for_strays=True):
+    """Compile a list of @param instructions into a single validator.
+
+    The validator takes the params dict passed by the client, and
+    returns the processed params, or raises ParamError, just like
+    :meth:`ParamHandler.batch`.  The instructions are only parsed
+    once, so this is used by OCSAgent to check params on each start
+    request without the overhead of building a ParamHandler.
+
+    Args:
+        instructions (list): (key, kwargs) pairs, as stored in the
+            ``_ocs_prescreen`` attribute by the @param decorator.
+        check_for_strays (bool): If True, params not described by the
+            instructions cause a ParamError.
+
+    Returns:
+        callable: The validator, with signature ``validator(params)``.
+
+    """
+    getters = []
+    for key, kw in instructions:
+        if key == '_':
+            pass
+        elif key == '_no_check_strays':
+            check_for_strays = False
+        else:
+            getters.append((key, _compile_param(key, **kw)))
+    known = {key for key, _ in getters}
+
+    def validator(params):
+        if params is None:
+            params = {}
+        output = {}
+        for key, get in getters:
+            output[key] = get(params)
+        if check_for_strays:
+            weird_args = [k for k in params.keys() if k not in known]
+            if len(weird_args):
+                raise ParamError(f"params included unexpected values: {weird_args}")
+        return output
+    return validator
+
+
 def param(key, **kwargs):
     """Decorator for Agent operation functions to assist with checking
     params prior to actually trying to execute the code.  Example::
@@ -1636,6 +2363,8 @@ def param(key, **kwargs):
     outermost (listed first).  This is because the current
     implementation caches data in the decorated function (or
     generator) directly, and additional decorators will conceal that.
+    The cached instructions are compiled into a single validator (see
+    :func:`compile_params`) when the Operation is registered.
 
     See :class:`ocs.ocs_agent.ParamHandler` for more details.  Note the
     signature for @param is the same as for :func:`ParamHandler.get`.
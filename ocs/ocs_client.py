@@ -1,4 +1,6 @@
 import collections
+import queue
+import threading
 import time
 
 import ocs
@@ -8,7 +10,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def _get_op(op_type, name, encoded, client, password):
+def _get_op(op_type, name, encoded, client, password, session_versions=False):
     """Factory for generating matched operations. This will make sure
     op.start's docstring is the docstring of the operation.
 
@@ -21,6 +23,8 @@ def _get_op(op_type, name, encoded, client, password):
             requests for operation actions.
         password (str): Client-supplied password, or None to not use a
             password.
+        session_versions (bool): Whether the agent supports requesting
+            session changes since a version.
 
     """
     # It's important to not pass password='', if the agent doesn't
@@ -29,18 +33,31 @@ def _get_op(op_type, name, encoded, client, password):
     if password is not None and password != '':
         feature_kw['password'] = password
 
+    def _since_kw(since):
+        # Older agents reject the since argument; they always return the
+        # full session, which merge_session also accepts.
+        if since is None or not session_versions:
+            return feature_kw
+        return dict(feature_kw, since=since)
+
     class MatchedOp:
         def start(self, **kwargs):
             return OCSReply(*client.request('start', name, params=kwargs,
                                             **feature_kw))
 
-        def wait(self, timeout=None):
+        def wait(self, timeout=None, since=None):
+            """Wait for the operation to finish.  If since is passed, only
+            the changes to the session since that version are
+            returned; see :func:`merge_session`."""
             return OCSReply(*client.request('wait', name, timeout=timeout,
-                                            **feature_kw))
+                                            **_since_kw(since)))
 
-        def status(self):
+        def status(self, since=None):
+            """Get the operation's session.  If since is passed, only the
+            changes to the session since that version are returned;
+            see :func:`merge_session`."""
             return OCSReply(*client.request('status', name,
-                                            **feature_kw))
+                                            **_since_kw(since)))
 
     class MatchedTask(MatchedOp):
         def abort(self):
@@ -139,17 +156,306 @@ class OCSClient:
                            'agent instance, but it does not support passwords.')
             self._password = None
 
+        session_versions = bool(self._api.get('session_versions'))
+
         for name, _, encoded in self._api['tasks']:
             setattr(self, _opname_to_attr(name),
-                    _get_op('task', name, encoded, self._client, self._password))
+                    _get_op('task', name, encoded, self._client, self._password,
+                            session_versions))
 
         for name, _, encoded in self._api['processes']:
             setattr(self, _opname_to_attr(name),
-                    _get_op('process', name, encoded, self._client, self._password))
+                    _get_op('process', name, encoded, self._client, self._password,
+                            session_versions))
 
     def __repr__(self):
         return f"OCSClient('{self.instance_id}')"
 
+    def batch(self, requests, concurrent=False):
+        """Issue several requests to the Agent's operations in one call.
+
+        Example:
+            Start two Tasks at once, then wait for both::
+
+                >>> client = OCSClient('fake-data-1')
+                >>> client.batch([('start', 'delay_task', {'delay': 1}),
+                ...               ('start', 'set_heartbeat', {'heartbeat': True})],
+                ...              concurrent=True)
+                >>> client.batch([('wait', 'delay_task', None, {'timeout': 10}),
+                ...               ('wait', 'set_heartbeat')])
+
+        Args:
+            requests (list): Requests, each of the form (action,
+                op_name), (action, op_name, params) or (action,
+                op_name, params, kwargs), where action is one of
+                'start', 'stop', 'abort', 'wait' or 'status', and
+                kwargs holds other arguments to the action, such as
+                'timeout' for 'wait'.
+            concurrent (bool): If True, the Agent issues all requests
+                at once, rather than in order.
+
+        Returns:
+            list: An OCSReply for each request, in order.
+
+        Notes:
+            Agents from older versions of ocs don't support batches.
+            For those, the requests are issued one at a time, in
+            order, regardless of ``concurrent``.
+
+        """
+        feature_kw = {}
+        if self._password not in [None, '']:
+            feature_kw['password'] = self._password
+
+        if self._api.get('batch'):
+            replies = self._client.batch([list(r) for r in requests],
+                                         concurrent=concurrent, **feature_kw)
+            return [OCSReply(*reply) for reply in replies]
+
+        replies = []
+        for request in requests:
+            action, op_name = request[:2]
+            params = request[2] if len(request) > 2 else None
+            kwargs = dict(feature_kw, **(request[3] if len(request) > 3 else {}))
+            replies.append(OCSReply(*self._client.request(
+                action, op_name, params=params, **kwargs)))
+        return replies
+
+    def watch(self, ops=None, timeout=10.):
+        """Follow the sessions of the Agent's operations as they change,
+        through the Agent's sessions feed, rather than by polling.
+
+        The Agent must be run with ``--session-feed-interval``.
+
+        Example:
+            Print each update to the ``acq`` Process::
+
+                >>> client = OCSClient('fake-data-1')
+                >>> with client.watch(['acq']) as watcher:
+                ...     for op_name, reply in watcher.updates():
+                ...         print(reply)
+
+        Args:
+            ops (list of str): Names of the operations to watch.
+                Defaults to all operations.
+            timeout (float): Time in seconds to wait to connect to the
+                WAMP router.
+
+        Returns:
+            SessionWatcher: The watcher, which is already subscribed.
+
+        """
+        if not self._api.get('session_feed'):
+            raise RuntimeError(f'Agent {self.instance_id} does not publish a '
+                               'sessions feed; run it with --session-feed-interval.')
+        if ops is None:
+            ops = [name for name, _, _ in self._api['tasks'] + self._api['processes']]
+        return SessionWatcher(self, ops, timeout=timeout)
+
+
+# Thread running the twisted reactor, for SessionWatcher.
+_reactor_thread = None
+
+
+def _start_reactor():
+    """Run the twisted reactor in a background thread, if it isn't already
+    running, and return it.
+
+    """
+    global _reactor_thread
+    from twisted.internet import reactor
+    from twisted.python import threadable
+    if threadable.isInIOThread() and reactor.running:
+        raise RuntimeError('SessionWatcher blocks, so cannot be used in the '
+                           'reactor thread; subscribe to the sessions feed instead.')
+    if _reactor_thread is None and not reactor.running:
+        _reactor_thread = threading.Thread(
+            target=reactor.run, kwargs={'installSignalHandlers': False},
+            name='ocs-client-reactor', daemon=True)
+        _reactor_thread.start()
+    return reactor
+
+
+class SessionWatcher:
+    """Follows the sessions of an Agent's operations, through the
+    Agent's sessions feed.
+
+    Updates are received in a background thread, which runs the
+    twisted reactor, and merged into a local copy of each session,
+    seeded from a ``status`` request to each operation.  Use
+    :func:`OCSClient.watch` to create one.
+
+    Args:
+        client (OCSClient): Client for the Agent.
+        ops (list of str): Names of the operations to watch.
+        timeout (float): Time in seconds to wait to connect to the
+            WAMP router.
+
+    Attributes:
+        sessions (dict): The latest session of each watched operation,
+            by operation name.
+
+    """
+
+    def __init__(self, client, ops, timeout=10.):
+        self.ops = list(ops)
+        self.sessions = {}
+        self._updates = queue.Queue()
+        self._lock = threading.Lock()
+        self._joined = threading.Event()
+        self._wamp_session = None
+        self._closed = False
+
+        self._subscribe(client._client, timeout)
+
+        # Seed the sessions once subscribed, so that no updates are
+        # missed.  Updates older than the seeds are discarded.
+        for op_name in self.ops:
+            reply = getattr(client, _opname_to_attr(op_name)).status()
+            if reply.session:
+                with self._lock:
+                    self._merge(op_name, reply.session)
+
+    def _subscribe(self, control_client, timeout):
+        from autobahn.twisted.wamp import ApplicationRunner, ApplicationSession
+        from twisted.internet import threads
+        from twisted.internet.defer import inlineCallbacks
+
+        watcher = self
+        topic = control_client.agent_addr + '.feeds.sessions'
+
+        class _Subscriber(ApplicationSession):
+            @inlineCallbacks
+            def onJoin(self, details):
+                yield self.subscribe(watcher._on_event, topic)
+                watcher._wamp_session = self
+                watcher._joined.set()
+
+            def onDisconnect(self):
+                watcher._closed = True
+                watcher._updates.put(None)
+
+        reactor = _start_reactor()
+        runner = ApplicationRunner(control_client.wamp_server, control_client.realm)
+        threads.blockingCallFromThread(reactor, runner.run, _Subscriber,
+                                       start_reactor=False)
+        if not self._joined.wait(timeout):
+            self.close()
+            raise RuntimeError(f'Timed out subscribing to {topic}.')
+
+    def _merge(self, op_name, update):
+        current = self.sessions.get(op_name)
+        if current is not None and current['session_id'] == update['session_id']:
+            version = current.get('version', 0)
+            # The agent may publish changes to data separately from, and
+            # with the same version as, messages added at the same time,
+            # so only updates with older versions can be dropped outright.
+            if update['version'] < version:
+                return None
+            if 'since' in update and update['since'] < version:
+                # The update overlaps the session we have, so drop the
+                # messages we already have.
+                messages = [list(m) for m in update['messages']]
+                if current['messages'] and list(current['messages'][-1]) in messages:
+                    last = messages.index(list(current['messages'][-1]))
+                    update = dict(update, messages=update['messages'][last + 1:])
+        merged = merge_session(current, update)
+        if merged == current:
+            return None
+        self.sessions[op_name] = merged
+        return merged
+
+    def _on_event(self, message, feed=None):
+        op_name = message.get('op_name')
+        if op_name not in self.ops:
+            return
+        with self._lock:
+            session = self._merge(op_name, message)
+        if session is not None:
+            self._updates.put((op_name, OCSReply(ocs.OK, 'Session updated.', session)))
+
+    def get(self, op_name):
+        """Get the latest session of an operation, as an OCSReply."""
+        with self._lock:
+            session = self.sessions.get(op_name, {})
+        return OCSReply(ocs.OK, 'Session active.' if session else 'No session active.',
+                        session)
+
+    def updates(self, timeout=None):
+        """Iterate over updates to the sessions, as they are received.
+
+        Args:
+            timeout (float): If not None, stop iterating if no update
+                is received for this many seconds.
+
+        Yields:
+            tuple: (op_name, OCSReply) for each update.
+
+        """
+        while not self._closed or not self._updates.empty():
+            try:
+                update = self._updates.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if update is None:
+                return
+            yield update
+
+    def close(self):
+        """Unsubscribe and disconnect from the WAMP router."""
+        self._closed = True
+        self._updates.put(None)
+        if self._wamp_session is not None:
+            from twisted.internet import reactor
+            reactor.callFromThread(self._wamp_session.leave)
+            self._wamp_session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def merge_session(session, update):
+    """Apply a session returned for a request with ``since`` to a
+    previously received session.
+
+    Polling clients can keep a full copy of an operation's session
+    while only transferring what changed::
+
+        >>> session = client.acq.status().session
+        >>> update = client.acq.status(since=session['version']).session
+        >>> session = merge_session(session, update)
+
+    Args:
+        session (dict): Previously received session, or None.
+        update (dict): Session returned by a request with ``since``.
+            This may also be a full session, e.g. from an agent that
+            doesn't support ``since``.
+
+    Returns:
+        dict: The updated session.  ``session`` is not modified.
+        New messages are appended to the previous ones, so the merged
+        session may hold messages that the agent has since discarded.
+
+    """
+    if 'since' not in update or not session \
+            or session.get('session_id') != update.get('session_id'):
+        # A full session, or one from a new run of the operation, in
+        # which case the update includes all of its data and messages.
+        return {k: v for k, v in update.items()
+                if k not in ['since', 'data_removed']}
+
+    merged = dict(update)
+    merged.pop('since')
+    merged.pop('data_removed')
+    merged['data'] = {k: v for k, v in session['data'].items()
+                      if k not in update['data_removed']}
+    merged['data'].update(update['data'])
+    merged['messages'] = list(session['messages']) + list(update['messages'])
+    return merged
+
 
 def _humanized_time(t):
     if abs(t) < 1.:
@@ -178,7 +484,7 @@ class OCSReply(collections.namedtuple('_OCSReply',
         # presence and bail out to a full dump if anything is weird.
         try:
             handled = ['op_name', 'session_id', 'status', 'start_time',
-                       'end_time', 'messages', 'success']
+                       'end_time', 'messages', 'success', 'version']
 
             s = self.session
             run_str = 'status={status}'.format(**s)
@@ -87,6 +87,10 @@ class Feed:
                 **exclude_influx** (bool):
                     If True, the InfluxPublisher will not write the feed to
                     Influx.
+                **influx_filter** (dict):
+                    Maps field names (or glob patterns) to filter rules used
+                    by the InfluxPublisher to drop redundant samples. See
+                    :class:`ocs.common.influxdb_drivers.FieldFilter`.
 
         buffer_time (int, optional):
             Specifies time that messages should be buffered in seconds.
@@ -1,8 +1,16 @@
+import asyncio
+import bisect
+import collections
+import itertools
+import sys
 import threading
+import traceback
 from contextlib import contextmanager
 import time
 from autobahn.twisted.util import sleep as dsleep
+from twisted.internet import threads
 from twisted.internet.defer import inlineCallbacks
+from twisted.python.threadpool import ThreadPool
 
 
 class TimeoutLock:
@@ -135,6 +143,308 @@ def in_reactor_context():
                        'current_thread.name="%s"' % t.name)
 
 
+def install_asyncio_reactor():
+    """
+    Install twisted's asyncio reactor, which is needed to register
+    Operations that are coroutine functions (``async def``).  This must
+    be called before the reactor is first imported, which importing
+    :mod:`ocs.ocs_agent` does, so call it at the top of the Agent
+    module::
+
+        from ocs.ocs_twisted import install_asyncio_reactor
+        install_asyncio_reactor()
+
+        from ocs import ocs_agent, site_config
+
+    Does nothing if the asyncio reactor is already installed.
+    """
+    from twisted.internet import asyncioreactor
+    if 'twisted.internet.reactor' in sys.modules:
+        from twisted.internet import reactor
+        if isinstance(reactor, asyncioreactor.AsyncioSelectorReactor):
+            return
+        raise RuntimeError('A reactor other than the asyncio reactor has '
+                           'already been installed.')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+
+
+class WorkerPool:
+    """
+    A pool of worker threads for running blocking Operations, which keeps
+    track of how busy it is.
+
+    The threads are started when the first job is submitted, and stopped
+    when the reactor shuts down.  Thread names start with "PoolThread",
+    so that :func:`in_reactor_context` recognizes them.
+
+    Args:
+        size (int):
+            Maximum number of threads; jobs submitted while all threads
+            are busy wait in a queue.
+        name (str):
+            Name of the pool, used in the thread names.
+
+    Attributes:
+        jobs_started (int):
+            Number of jobs that have started running.
+        jobs_completed (int):
+            Number of jobs that have finished running.
+    """
+
+    def __init__(self, size=10, name=None):
+        self.size = size
+        self.name = name
+        self.pool = None
+        self.jobs_started = 0
+        self.jobs_completed = 0
+        self._total_wait = 0.
+        self._max_wait = 0.
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._queued = {}   # job id -> (name, submit time)
+        self._running = {}  # job id -> (name, start time)
+
+    def start(self):
+        """Start the thread pool, if it isn't running yet."""
+        from twisted.internet import reactor
+        if self.pool is not None:
+            return
+        self.pool = ThreadPool(minthreads=0, maxthreads=self.size, name=self.name)
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        """Stop the thread pool, waiting for running jobs to finish."""
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    def defer(self, name, func, *args, **kwargs):
+        """
+        Run ``func(*args, **kwargs)`` in a worker thread.  Must be called
+        from the reactor.
+
+        Args:
+            name (str):
+                Name of the job, e.g. the Operation name, reported in
+                :func:`stats`.
+
+        Returns:
+            Deferred that fires with the result of func.
+        """
+        self.start()
+        job_id = next(self._job_ids)
+        with self._lock:
+            self._queued[job_id] = (name, time.time())
+
+        def _run():
+            with self._lock:
+                _, submit_time = self._queued.pop(job_id)
+                now = time.time()
+                self._running[job_id] = (name, now)
+                self.jobs_started += 1
+                self._total_wait += now - submit_time
+                self._max_wait = max(self._max_wait, now - submit_time)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    del self._running[job_id]
+                    self.jobs_completed += 1
+
+        from twisted.internet import reactor
+        return threads.deferToThreadPool(reactor, self.pool, _run)
+
+    def stats(self):
+        """
+        Summarize the state of the pool.
+
+        Returns:
+            dict: With entries:
+
+            - 'size': maximum number of threads.
+            - 'busy': number of jobs running.
+            - 'utilization': fraction of the threads that are busy.
+            - 'queued': number of jobs waiting for a thread.
+            - 'jobs_started', 'jobs_completed': job counts.
+            - 'mean_queue_wait', 'max_queue_wait': time in seconds
+              that started jobs waited for a thread.
+            - 'oldest_queued': time in seconds that the job at the
+              front of the queue has been waiting, or None.
+            - 'longest_running': dict with the 'name' of the job
+              that has been running the longest and its 'elapsed'
+              time in seconds, or None.
+        """
+        now = time.time()
+        with self._lock:
+            submitted = [t for _, t in self._queued.values()]
+            longest = min(self._running.values(), key=lambda job: job[1],
+                          default=None)
+            return {
+                'size': self.size,
+                'busy': len(self._running),
+                'utilization': len(self._running) / self.size,
+                'queued': len(self._queued),
+                'jobs_started': self.jobs_started,
+                'jobs_completed': self.jobs_completed,
+                'mean_queue_wait': (self._total_wait / self.jobs_started
+                                    if self.jobs_started else 0.),
+                'max_queue_wait': self._max_wait,
+                'oldest_queued': now - min(submitted) if submitted else None,
+                'longest_running': (None if longest is None else
+                                    {'name': longest[0],
+                                     'elapsed': now - longest[1]}),
+            }
+
+
+class ReactorLagMonitor:
+    """
+    Measures how late the reactor runs timed calls, to detect code that
+    blocks the reactor.
+
+    A call is scheduled every ``interval`` seconds, and the delay between
+    when it was due and when it ran is recorded in a histogram.  A
+    watchdog thread checks that these calls keep running; if none has
+    run for ``threshold`` seconds, it captures the stack of the reactor
+    thread, which shows the code that is blocking it.
+
+    Must be started and stopped from the reactor.
+
+    Args:
+        interval (float):
+            Time in seconds between timed calls.
+        threshold (float):
+            Lag in seconds above which the reactor is considered
+            stalled, and its stack is captured.
+        max_stalls (int):
+            Number of recent stalls to keep.
+
+    Attributes:
+        stall_count (int):
+            Number of stalls detected.
+        stalls (deque):
+            The most recent stalls, as dicts with the 'time' (unix time)
+            at which the stall was detected, the 'lag' in seconds (the
+            full lag, once the reactor has recovered) and the 'stack' of
+            the reactor thread, as a string.
+    """
+
+    #: Upper edges of the histogram bins, in seconds.
+    BIN_EDGES = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5.]
+
+    def __init__(self, interval=0.01, threshold=0.1, max_stalls=10):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = collections.deque(maxlen=max_stalls)
+        self.stall_count = 0
+        self._counts = [0] * (len(self.BIN_EDGES) + 1)
+        self._window = []   # lags since the last call to window_stats
+        self._max_lag = 0.
+        self._lock = threading.Lock()
+        self._call = None
+        self._due = None
+        self._last_tick = None
+        self._reactor_thread_id = None
+        self._watchdog = None
+        self._stall = None  # stall in progress, if any
+        self._stop = None
+
+    @property
+    def running(self):
+        return self._call is not None
+
+    def start(self):
+        """Start measuring."""
+        from twisted.internet import reactor
+        if self.running:
+            return
+        self._reactor_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._schedule(reactor)
+        self._stop = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch, args=(self._stop,),
+                                          daemon=True, name='ocs-lag-watchdog')
+        self._watchdog.start()
+
+    def stop(self):
+        """Stop measuring."""
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self._stop is not None:
+            self._stop.set()
+
+    def _schedule(self, reactor):
+        self._due = time.monotonic() + self.interval
+        self._call = reactor.callLater(self.interval, self._tick, reactor)
+
+    def _tick(self, reactor):
+        now = time.monotonic()
+        lag = max(now - self._due, 0.)
+        with self._lock:
+            self._last_tick = now
+            self._counts[bisect.bisect_left(self.BIN_EDGES, lag)] += 1
+            self._window.append(lag)
+            self._max_lag = max(self._max_lag, lag)
+            if self._stall is not None:
+                self._stall['lag'] = lag
+                self._stall = None
+        self._schedule(reactor)
+
+    def _watch(self, stop):
+        while not stop.wait(self.threshold / 4):
+            with self._lock:
+                lag = time.monotonic() - self._last_tick - self.interval
+                if lag < self.threshold or self._stall is not None:
+                    continue
+                frame = sys._current_frames().get(self._reactor_thread_id)
+                self._stall = {
+                    'time': time.time(),
+                    'lag': lag,
+                    'stack': ''.join(traceback.format_stack(frame)) if frame else '',
+                }
+                self.stalls.append(self._stall)
+                self.stall_count += 1
+
+    def window_stats(self):
+        """
+        Summarize the lag since the previous call.
+
+        Returns:
+            dict: The 'count' of timed calls, and their 'mean_lag' and
+            'max_lag' in seconds.
+        """
+        with self._lock:
+            window, self._window = self._window, []
+        return {
+            'count': len(window),
+            'mean_lag': sum(window) / len(window) if window else 0.,
+            'max_lag': max(window, default=0.),
+        }
+
+    def stats(self):
+        """
+        Summarize the lag since the monitor was created.
+
+        Returns:
+            dict: With entries 'interval' and 'threshold'; 'histogram',
+            a list of [upper bin edge in seconds, count] pairs, the last
+            bin having an edge of None; 'max_lag' in seconds; and
+            'stalls', a list of the most recent stalls.
+        """
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'threshold': self.threshold,
+                'histogram': [[edge, count] for edge, count
+                              in zip(self.BIN_EDGES + [None], self._counts)],
+                'max_lag': self._max_lag,
+                'stalls': [dict(stall) for stall in self.stalls],
+            }
+
+
 class Pacemaker:
     """
     The Pacemaker is a class to help Agents maintain a regular sampling rate
@@ -71,6 +71,7 @@ class HostConfig:
         self.log_dir = None
         self.working_dir = os.getcwd()
         self.crossbar_timeout = None
+        self.thread_pool_size = None
 
     @classmethod
     def from_dict(cls, data, parent=None, name=None):
@@ -98,6 +99,11 @@ class HostConfig:
             Path at which to write log files.  Relative paths will be
             interpreted relative to the "working directory"; see
             --working-dir command line option.
+
+        ``thread-pool-size`` (optional)
+            Number of worker threads each Agent on this host uses to
+            run blocking Operations; see --thread-pool-size command
+            line option.
         """
         self = cls(name=name)
         self.parent = parent
@@ -106,6 +112,7 @@ class HostConfig:
         self.crossbar = CrossbarConfig.from_dict(data.get('crossbar'))
         self.log_dir = data.get('log-dir', None)
         self.crossbar_timeout = data.get('crossbar_timeout', 10)
+        self.thread_pool_size = data.get('thread-pool-size', None)
         return self
 
 
@@ -433,6 +440,24 @@ def add_arguments(parser=None):
     ``--access-policy=...``:
         Override the default Access Control policy.
 
+    ``--session-feed-interval=...``:
+        Publish changes to Operation sessions on the Agent's
+        ``sessions`` feed, sending session.data changes at most once
+        per this many seconds.  Disabled by default.
+
+    ``--thread-pool-size=...``:
+        Number of worker threads used to run blocking Operations.
+        Overrides the host default.
+
+    ``--reactor-lag-interval=...``:
+        Measure how late the reactor runs a call scheduled every this
+        many seconds, and publish a summary on the Agent's
+        ``reactor_lag`` feed.  Disabled by default.
+
+    ``--reactor-lag-threshold=...``:
+        Lag in seconds above which the reactor is considered stalled,
+        and the code blocking it is logged.  Defaults to 0.1.
+
     """
     if parser is None:
         parser = argparse.ArgumentParser()
@@ -460,6 +485,19 @@ def add_arguments(parser=None):
                        "that the Agent will try to reconnect to the crossbar server before "
                        "shutting down. Note this is set per Agent in an instance's arguments list.")
     group.add_argument('--access-policy', help="Override Access Control policy.")
+    group.add_argument('--session-feed-interval', type=float, help="Publish changes to "
+                       "Operation sessions on the Agent's sessions feed, sending session.data "
+                       "changes at most once per this many seconds. Disabled by default.")
+    group.add_argument('--thread-pool-size', type=int, help="Number of worker threads "
+                       "used to run blocking Operations. Overrides the host default; "
+                       "defaults to 10 if neither is set.")
+    group.add_argument('--reactor-lag-interval', type=float, help="Measure how late "
+                       "the reactor runs a call scheduled every this many seconds, and "
+                       "publish a summary on the Agent's reactor_lag feed. Disabled by "
+                       "default.")
+    group.add_argument('--reactor-lag-threshold', type=float, default=0.1, help="Lag in "
+                       "seconds above which the reactor is considered stalled, and the "
+                       "code blocking it is logged.")
     return parser
 
 
@@ -590,6 +628,8 @@ def add_site_attributes(args, site, host=None):
         args.log_dir = host.log_dir
     if (args.crossbar_timeout is None) and (host is not None):
         args.crossbar_timeout = host.crossbar_timeout
+    if (args.thread_pool_size is None) and (host is not None):
+        args.thread_pool_size = host.thread_pool_size
     if args.site_file is None:
         args.site_file = site.source_file
 
@@ -644,7 +684,8 @@ def get_control_client(instance_id, site=None, args=None, start=True,
         client = client_http.ControlClient(
             full_addr,
             url=site.hub.data['wamp_http'],
-            realm=site.hub.data['wamp_realm'])
+            realm=site.hub.data['wamp_realm'],
+            wamp_server=site.hub.data.get('wamp_server'))
     else:
         raise ValueError('Unknown client_type request: %s' % client_type)
     return client
@@ -1,13 +1,18 @@
 import os
+import gzip
+import json
 import time
+import random
 import pytest
 import signal
 import subprocess
 import coverage.data
 import urllib.request
 
-from threading import Timer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, Timer
 from urllib.error import URLError
+from urllib.parse import parse_qs, urlparse
 
 from ocs.ocs_client import OCSClient
 
@@ -222,3 +227,281 @@ def check_crossbar_connection(port=18001, interval=5, max_attempts=6):
 
     assert code == 200
     print("Crossbar server online.")
+
+
+class _InfluxDBRequestHandler(BaseHTTPRequestHandler):
+    """Request handler for :class:`FakeInfluxDB`."""
+
+    # Keep-alive, like a real InfluxDB
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _respond(self, code, body=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('X-Influxdb-Version', self.server.influxdb.version)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        influxdb = self.server.influxdb
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self._read_body()
+
+        if influxdb.in_outage():
+            # Drop the connection without a response, as if the server were
+            # unreachable
+            self.close_connection = True
+            return
+
+        if url.path in ('/ping', '/health'):
+            self._respond(204 if url.path == '/ping' else 200,
+                          None if url.path == '/ping' else {'status': 'pass'})
+            return
+
+        time.sleep(influxdb.latency)
+
+        if url.path in ('/write', '/api/v2/write') and influxdb.inject_error():
+            self._respond(influxdb.error_code, {'error': 'injected error',
+                                                'code': 'internal error',
+                                                'message': 'injected error'})
+            return
+
+        if url.path == '/write':
+            target = params.get('db')
+            if params.get('rp'):
+                target = f"{target}.{params['rp']}"
+            influxdb.record_write(target, body)
+            self._respond(204)
+        elif url.path == '/api/v2/write':
+            influxdb.record_write(params.get('bucket'), body)
+            self._respond(204)
+        elif url.path == '/query':
+            if not params.get('q') and body:
+                params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+            self._respond(200, influxdb.query(params.get('q', '')))
+        elif url.path == '/api/v2/buckets' and self.command == 'GET':
+            self._respond(200, influxdb.get_buckets(params.get('name')))
+        elif url.path == '/api/v2/orgs':
+            self._respond(200, {'orgs': [{'id': '0000000000000001',
+                                          'name': params.get('org', 'ocs')}]})
+        elif url.path == '/api/v2/buckets' and self.command == 'POST':
+            self._respond(201, influxdb.create_bucket(json.loads(body)['name']))
+        elif url.path == '/_stats':
+            self._respond(200, influxdb.stats())
+        else:
+            self._respond(404, {'error': f'unknown path {url.path}'})
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class FakeInfluxDB:
+    """Lightweight, in-process stand-in for an InfluxDB server.
+
+    Implements enough of the InfluxDB v1 (``/write``, ``/query``, ``/ping``)
+    and v2 (``/api/v2/write``, ``/api/v2/buckets``, ``/api/v2/orgs``,
+    ``/health``) HTTP APIs for both InfluxDB Publisher Agents to run against
+    it, with configurable latency, error injection and outage windows. Written
+    lines are counted and optionally stored, keyed by database (or
+    ``<database>.<retention policy>``) or bucket. The counters are also available as JSON at the
+    non-standard ``/_stats`` endpoint.
+
+    Parameters:
+        host (str): Host to bind to. Defaults to localhost.
+        port (int): Port to bind to. Defaults to 0, picking a free port.
+        latency (float): Delay in seconds added to each write and query.
+        error_rate (float): Fraction of write requests that fail with
+            ``error_code``.
+        error_code (int): HTTP status code returned for injected errors.
+        outages (list): List of (start, stop) tuples, in seconds relative to
+            when the server was started, during which connections are dropped
+            without a response.
+        store_lines (bool): If True, keep all written lines in ``lines``.
+            Disable for long running benchmarks.
+        seed (int): Seed for the error injection random number generator.
+
+    Attributes:
+        url (str): Base URL of the running server.
+        databases (set): Names of existing v1 databases.
+        buckets (set): Names of existing v2 buckets.
+        lines (dict): Written lines, keyed by database or bucket.
+        outage (bool): Set to True to manually start an outage.
+
+    Examples:
+        Run a v1 publisher against the stand-in::
+
+            with FakeInfluxDB(latency=0.05) as influxdb:
+                publisher = Publisher('localhost', 'ocs_feeds', queue,
+                                      port=influxdb.port)
+                ...
+                print(influxdb.lines['ocs_feeds'])
+
+    """
+
+    version = '1.8.10'
+
+    def __init__(self, host='localhost', port=0, latency=0., error_rate=0.,
+                 error_code=500, outages=None, store_lines=True, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.outages = outages or []
+        self.store_lines = store_lines
+        self.outage = False
+
+        self.databases = set()
+        self.buckets = set()
+        self.lines = {}
+
+        self._rng = random.Random(seed)
+        self._lock = Lock()
+        self._counts = {'write_requests': 0,
+                        'failed_requests': 0,
+                        'lines': 0,
+                        'bytes': 0}
+        self._start_time = None
+        self._thread = None
+
+        self._server = ThreadingHTTPServer((host, port), _InfluxDBRequestHandler)
+        self._server.daemon_threads = True
+        self._server.influxdb = self
+        self.host = host
+        self.port = self._server.server_address[1]
+        self.url = f"http://{host}:{self.port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start serving in a background thread."""
+        self._start_time = time.time()
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serve in the calling thread, i.e. when run in a subprocess."""
+        self._start_time = time.time()
+        self._server.serve_forever()
+
+    def stop(self):
+        """Shutdown the server."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def in_outage(self):
+        """Check if the server is currently simulating an outage."""
+        if self.outage:
+            return True
+        elapsed = time.time() - self._start_time
+        return any(start <= elapsed < stop for start, stop in self.outages)
+
+    def inject_error(self):
+        with self._lock:
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self._counts['failed_requests'] += 1
+        return failed
+
+    def record_write(self, target, body):
+        lines = [line for line in body.decode('utf-8').split('\n') if line]
+        with self._lock:
+            self._counts['write_requests'] += 1
+            self._counts['lines'] += len(lines)
+            self._counts['bytes'] += len(body)
+            if self.store_lines:
+                self.lines.setdefault(target, []).extend(lines)
+
+    def stats(self):
+        """Return a copy of the request counters.
+
+        Returns:
+            dict: Counts of 'write_requests', 'failed_requests', 'lines' and
+            'bytes' received.
+
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def query(self, q):
+        """Handle a v1 query, supporting database and retention policy
+        management statements. Other statements return empty results.
+
+        """
+        results = []
+        statements = [x.strip() for x in q.split(';') if x.strip()]
+        for i, statement in enumerate(statements):
+            words = statement.replace('"', '').split()
+            upper = [w.upper() for w in words]
+            result = {'statement_id': i}
+            if upper[:2] == ['SHOW', 'DATABASES']:
+                if self.databases:
+                    result['series'] = [{'name': 'databases',
+                                         'columns': ['name'],
+                                         'values': [[x] for x in sorted(self.databases)]}]
+            elif upper[:2] == ['CREATE', 'DATABASE']:
+                self.databases.add(words[2])
+            elif upper[:2] == ['DROP', 'DATABASE']:
+                self.databases.discard(words[2])
+                self.lines.pop(words[2], None)
+            elif upper[:3] == ['CREATE', 'RETENTION', 'POLICY']:
+                pass
+            results.append(result)
+        return {'results': results}
+
+    def _bucket(self, name):
+        return {'id': f'{abs(hash(name)):016x}',
+                'orgID': '0000000000000001',
+                'type': 'user',
+                'name': name,
+                'retentionRules': []}
+
+    def get_buckets(self, name=None):
+        names = sorted(self.buckets) if name is None else \
+            [x for x in self.buckets if x == name]
+        return {'buckets': [self._bucket(x) for x in names]}
+
+    def create_bucket(self, name):
+        self.buckets.add(name)
+        return self._bucket(name)
+
+
+def create_influxdb_fixture(databases=('ocs_feeds',), buckets=('ocs_feeds',),
+                            **kwargs):
+    """Create a pytest fixture that provides a running :class:`FakeInfluxDB`.
+
+    Parameters:
+        databases (tuple): v1 databases that exist at startup.
+        buckets (tuple): v2 buckets that exist at startup.
+        **kwargs: Passed to :class:`FakeInfluxDB`.
+
+    """
+    @pytest.fixture()
+    def influxdb():
+        server = FakeInfluxDB(**kwargs)
+        server.databases.update(databases)
+        server.buckets.update(buckets)
+        server.start()
+        yield server
+        server.stop()
+
+    return influxdb
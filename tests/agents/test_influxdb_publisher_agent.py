@@ -17,6 +17,11 @@ args.port = 8086
 args.database = 'ocs_feeds'
 args.protocol = 'line'
 args.gzip = False
+args.extra_backends = []
+args.max_queued_batches = 300
+args.precision = 'ns'
+args.filter_config = None
+args.downsample_window = None
 
 agent = create_agent_fixture(InfluxDBAgent, {'args': args})
 
@@ -50,6 +55,25 @@ class TestRecord:
 
         assert res[0] is True
 
+    @mock.patch('ocs.agents.influxdb_publisher.drivers.InfluxDBClient',
+                mock.MagicMock())
+    def test_influxdb_publisher_record_downsample(self, agent):
+        agent.args.downsample_window = 60
+        agent.args.downsample_measurement_suffix = '_1m'
+        agent.args.downsample_retention_policy = 'downsampled'
+        agent.aggregate = True
+
+        session = create_session('record')
+
+        data = generate_data_for_queue()
+        agent._enqueue_incoming_data(data)
+
+        params = {'test_mode': True}
+        res = agent.record(session, params)
+        agent.args.downsample_window = None
+
+        assert res[0] is True
+
 
 def test_influxdb_publisher_enqueue_data_no_aggregate(agent, tmpdir):
     agent.aggregate = False
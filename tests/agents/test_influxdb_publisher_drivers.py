@@ -1,6 +1,24 @@
+import queue
+import time
+
+from ocs.agents.influxdb_publisher.drivers import (Backend, Publisher,
+                                                   _InfluxDBClientArgs,
+                                                   parse_backend_url)
+from ocs.agents.influxdb_publisher_v2.drivers import Publisher as PublisherV2
+from ocs.agents.influxdb_publisher_v2.drivers import (WRITE_OPTION_PRESETS,
+                                                      make_write_options)
 from ocs.common.influxdb_drivers import _format_field_line
+from ocs.testing import create_influxdb_fixture
 
 import pytest
+from requests.exceptions import ChunkedEncodingError, ReadTimeout
+
+from agents.util import generate_data_for_queue
+
+influxdb = create_influxdb_fixture()
+influxdb_remote = create_influxdb_fixture()
+influxdb_slow = create_influxdb_fixture(latency=0.1, error_rate=1.)
+influxdb_failing = create_influxdb_fixture(error_rate=1.)
 
 
 @pytest.mark.parametrize("key,value,result", [('fieldname', False, 'fieldname=False'),
@@ -11,3 +29,328 @@ def test_publisher_format_field_line(key, value, result):
     f_line = _format_field_line(key, value)
 
     assert f_line == result
+
+
+@pytest.mark.parametrize("protocol", ['line', 'json'])
+def test_publisher_write(influxdb, protocol):
+    incoming_data = queue.Queue()
+    publisher = Publisher('localhost', 'new_db', incoming_data,
+                          port=influxdb.port, protocol=protocol)
+
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert publisher.flush(timeout=5)
+    publisher.close()
+
+    assert publisher.connected
+    assert 'new_db' in influxdb.databases
+    lines = influxdb.lines['new_db']
+    assert len(lines) == 2
+    assert lines[0].startswith('observatory.test-agent1,feed=test_feed ')
+
+
+def test_publisher_write_batches(influxdb):
+    incoming_data = queue.Queue()
+    publisher = Publisher('localhost', 'ocs_feeds', incoming_data,
+                          port=influxdb.port, batch_size=3)
+
+    for i in range(3):
+        incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    publisher.close()
+
+    assert influxdb.stats()['write_requests'] == 2
+    assert len(influxdb.lines['ocs_feeds']) == 6
+
+
+def test_publisher_write_precision(influxdb):
+    incoming_data = queue.Queue()
+    publisher = Publisher('localhost', 'ocs_feeds', incoming_data,
+                          port=influxdb.port, precision='s')
+
+    data, feed = generate_data_for_queue()
+    incoming_data.put((data, feed))
+    publisher.run()
+    publisher.close()
+
+    t = int(data['temps']['timestamps'][0])
+    assert influxdb.lines['ocs_feeds'][0].endswith(f' {t}')
+
+
+def test_publisher_outage(influxdb):
+    incoming_data = queue.Queue()
+    publisher = Publisher('localhost', 'ocs_feeds', incoming_data,
+                          port=influxdb.port, retry_interval=0.05)
+
+    influxdb.outage = True
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert not publisher.flush(timeout=0.5)
+    assert not publisher.connected
+
+    # Batch queued during the outage is retried
+    influxdb.outage = False
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert publisher.flush(timeout=5)
+    publisher.close()
+
+    assert publisher.connected
+    assert len(influxdb.lines['ocs_feeds']) == 4
+
+
+def test_publisher_injected_error(influxdb_slow):
+    incoming_data = queue.Queue()
+    publisher = Publisher('localhost', 'ocs_feeds', incoming_data,
+                          port=influxdb_slow.port, retry_interval=0.05)
+
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert not publisher.flush(timeout=0.5)
+    publisher.close(timeout=1)
+
+    assert not publisher.connected
+    assert influxdb_slow.stats()['failed_requests'] >= 1
+    status = publisher.backend_status()[f'localhost:{influxdb_slow.port}/ocs_feeds']
+    assert status['last_error'].startswith('Server error')
+
+
+def test_publisher_unexpected_errors(influxdb):
+    """Test that unexpected errors, e.g. timeouts, are retried rather than
+    ending the writer thread."""
+    incoming_data = queue.Queue()
+    publisher = Publisher('localhost', 'ocs_feeds', incoming_data,
+                          port=influxdb.port, retry_interval=0.05)
+    backend = publisher.backends[0]
+    assert publisher.flush(timeout=5)
+    errors = [ReadTimeout('timed out'), ChunkedEncodingError('cut short')]
+    write = backend.client.write
+
+    def _write(*args, **kwargs):
+        if errors:
+            raise errors.pop(0)
+        return write(*args, **kwargs)
+    backend.client.write = _write
+
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert publisher.flush(timeout=5)
+    assert backend.status()['last_error'].startswith('Unexpected error')
+    assert backend.alive
+    assert publisher.connected
+    publisher.close()
+
+    assert len(influxdb.lines['ocs_feeds']) == 2
+
+
+def test_publisher_setup_error(influxdb):
+    """Test that errors creating the database are retried."""
+    client_args = _InfluxDBClientArgs(host='localhost', port=influxdb.port,
+                                      username='root', password='root',
+                                      ssl=False, verify_ssl=False, gzip=False)
+    backend = Backend(client_args, 'new_db', retry_interval=0.05)
+    create_database = backend.client.create_database
+    errors = [ReadTimeout('timed out')]
+
+    def _create_database(db):
+        if errors:
+            raise errors.pop(0)
+        return create_database(db)
+    backend.client.create_database = _create_database
+
+    assert not backend.alive
+    backend.start()
+    backend.put(b'test value=1i 1')
+    assert backend.flush(timeout=5)
+    assert backend.status()['last_error'].startswith('Failed to create database')
+    backend.stop()
+
+    assert influxdb.lines['new_db'] == ['test value=1i 1']
+
+
+def test_publisher_retry_backoff(influxdb_failing):
+    """Test that batches arriving while writes fail don't cut the backoff
+    between retries short."""
+    incoming_data = queue.Queue()
+    publisher = Publisher('localhost', 'ocs_feeds', incoming_data,
+                          port=influxdb_failing.port, retry_interval=0.1)
+    backend = publisher.backends[0]
+    attempts = []
+    write = backend._write
+
+    def _write(*args):
+        attempts.append(time.monotonic())
+        return write(*args)
+    backend._write = _write
+
+    end = time.monotonic() + 1.4
+    while time.monotonic() < end:
+        incoming_data.put(generate_data_for_queue())
+        publisher.run()
+        time.sleep(0.02)
+    publisher.close(timeout=1)
+
+    # Retries at about 0, 0.1, 0.3, 0.7 s
+    assert 3 <= len(attempts) <= 5
+    gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+    for i, gap in enumerate(gaps):
+        assert gap >= 0.9 * 0.1 * 2**i
+
+
+def test_publisher_extra_backend(influxdb, influxdb_remote):
+    incoming_data = queue.Queue()
+    remote = parse_backend_url(f'http://localhost:{influxdb_remote.port}/remote_db')
+    publisher = Publisher('localhost', 'ocs_feeds', incoming_data,
+                          port=influxdb.port, extra_backends=[remote],
+                          retry_interval=0.05)
+
+    # An unreachable remote does not hold up the local backend
+    influxdb_remote.outage = True
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert publisher.backends[0].flush(timeout=5)
+    assert len(influxdb.lines['ocs_feeds']) == 2
+    assert not publisher.backends[1].flush(timeout=0.5)
+    assert not publisher.connected
+
+    influxdb_remote.outage = False
+    assert publisher.flush(timeout=5)
+    publisher.close()
+    assert publisher.connected
+    assert len(influxdb_remote.lines['remote_db']) == 2
+
+
+def test_publisher_start_unreachable(influxdb):
+    incoming_data = queue.Queue()
+    influxdb.outage = True
+    publisher = Publisher('localhost', 'new_db', incoming_data,
+                          port=influxdb.port, retry_interval=0.05)
+
+    # Data is queued while InfluxDB is unreachable
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert not publisher.flush(timeout=0.5)
+    assert not publisher.connected
+    assert 'new_db' not in influxdb.databases
+
+    # Database is created, and queued data written, once reachable
+    influxdb.outage = False
+    assert publisher.flush(timeout=5)
+    publisher.close()
+    assert publisher.connected
+    assert len(influxdb.lines['new_db']) == 2
+
+
+def test_parse_backend_url():
+    assert parse_backend_url('https://influx.example.org/ocs_feeds') == \
+        {'host': 'influx.example.org', 'port': 8086, 'database': 'ocs_feeds',
+         'ssl': True, 'verify_ssl': True}
+    with pytest.raises(ValueError):
+        parse_backend_url('http://localhost:8086')
+
+
+def test_publisher_v2_write(influxdb, monkeypatch):
+    monkeypatch.setenv('INFLUXDB_V2_URL', influxdb.url)
+    monkeypatch.setenv('INFLUXDB_V2_ORG', 'ocs')
+    monkeypatch.setenv('INFLUXDB_V2_BUCKET', 'ocs_feeds')
+    monkeypatch.setenv('INFLUXDB_V2_TOKEN', 'token')
+
+    incoming_data = queue.Queue()
+    publisher = PublisherV2(incoming_data)
+
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+
+    # Writes are batched in a background thread
+    publisher.close()
+    timeout = time.time() + 5
+    while 'ocs_feeds' not in influxdb.lines and time.time() < timeout:
+        time.sleep(0.1)
+
+    assert publisher.connection.connected
+    assert len(influxdb.lines['ocs_feeds']) == 2
+    assert publisher.callback.stats()['successes'] == 1
+
+
+def test_publisher_v2_retry_stats(influxdb_slow, monkeypatch):
+    monkeypatch.setenv('INFLUXDB_V2_URL', influxdb_slow.url)
+    monkeypatch.setenv('INFLUXDB_V2_ORG', 'ocs')
+    monkeypatch.setenv('INFLUXDB_V2_BUCKET', 'ocs_feeds')
+    monkeypatch.setenv('INFLUXDB_V2_TOKEN', 'token')
+
+    write_options = make_write_options('low-latency', retry_interval=50,
+                                       max_retries=1, max_retry_delay=100)
+    incoming_data = queue.Queue()
+    publisher = PublisherV2(incoming_data, write_options=write_options)
+
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    publisher.close()
+
+    stats = publisher.callback.stats()
+    assert stats['retries'] >= 1
+    assert stats['errors'] == 1
+    assert stats['last_error'] is not None
+    assert not publisher.connection.connected
+
+
+def test_publisher_v2_start_unreachable(influxdb, monkeypatch):
+    monkeypatch.setenv('INFLUXDB_V2_URL', influxdb.url)
+    monkeypatch.setenv('INFLUXDB_V2_ORG', 'ocs')
+    monkeypatch.setenv('INFLUXDB_V2_BUCKET', 'new_bucket')
+    monkeypatch.setenv('INFLUXDB_V2_TOKEN', 'token')
+
+    incoming_data = queue.Queue()
+    influxdb.outage = True
+    publisher = PublisherV2(incoming_data, setup_retry_interval=0.05)
+
+    # Batches are held while InfluxDB is unreachable
+    incoming_data.put(generate_data_for_queue())
+    publisher.run()
+    assert publisher.pending_batches == 1
+    assert not publisher.ready
+    assert not publisher.connection.connected
+
+    # Bucket is created once reachable, and held batches written
+    influxdb.outage = False
+    timeout = time.time() + 5
+    while not publisher.ready and time.time() < timeout:
+        time.sleep(0.05)
+    assert 'new_bucket' in influxdb.buckets
+    publisher.run()
+    assert publisher.pending_batches == 0
+    publisher.close()
+    assert len(influxdb.lines['new_bucket']) == 2
+
+
+def test_publisher_v2_setup_error(influxdb, monkeypatch):
+    """Test that unexpected errors during setup are retried."""
+    monkeypatch.setenv('INFLUXDB_V2_URL', influxdb.url)
+    monkeypatch.setenv('INFLUXDB_V2_ORG', 'ocs')
+    monkeypatch.setenv('INFLUXDB_V2_BUCKET', 'new_bucket')
+    monkeypatch.setenv('INFLUXDB_V2_TOKEN', 'token')
+    errors = [ReadTimeout('timed out')]
+    setup = PublisherV2._setup
+
+    def _setup(self):
+        if errors:
+            raise errors.pop(0)
+        return setup(self)
+    monkeypatch.setattr(PublisherV2, '_setup', _setup)
+
+    incoming_data = queue.Queue()
+    publisher = PublisherV2(incoming_data, setup_retry_interval=0.05)
+    timeout = time.time() + 5
+    while not publisher.ready and time.time() < timeout:
+        time.sleep(0.05)
+    assert publisher.ready
+    assert 'new_bucket' in influxdb.buckets
+    publisher.close()
+
+
+def test_make_write_options():
+    options = make_write_options('bulk', batch_size=100, max_retries=None)
+    assert options['batch_size'] == 100
+    assert options['max_retries'] == WRITE_OPTION_PRESETS['bulk']['max_retries']
+    with pytest.raises(ValueError):
+        make_write_options(batch_sise=100)
@@ -16,6 +16,8 @@ def create_agent_fixture(agent_class, agent_kwargs={}, site_args={}):
         _site_args = mock.MagicMock()
         _site_args.log_dir = '/tmp/'
         _site_args.access_policy = None
+        _site_args.thread_pool_size = None
+        _site_args.reactor_lag_interval = None
         for k, v in site_args.items():
             setattr(_site_args, k, v)
 
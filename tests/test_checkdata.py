@@ -1,5 +1,136 @@
+import os
+
+import pytest
+
+from util import write_hk_file
+
 try:
     # dependent on so3g
-    from ocs.checkdata import DataChecker  # noqa: F401
+    from ocs import checkdata
+    from so3g.spt3g import core
+    from ocs.checkdata import DataChecker, latest_values, summarize_file
 except ModuleNotFoundError as e:
     print(f"Unable to import: {e}")
+
+
+def test_summarize_file(tmp_path):
+    path = str(tmp_path / 'data.g3')
+    write_hk_file(path, 1.7e9)
+
+    summary = summarize_file(path)
+    assert summary == {
+        'observatory.fake-agent.feeds.temps.temp': (1.7e9 + 9, 9.0),
+        'observatory.fake-agent.feeds.temps.count': (1.7e9 + 9, 9),
+    }
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_data_checker(tmp_path, workers):
+    os.mkdir(tmp_path / 'data')
+    write_hk_file(str(tmp_path / 'data' / '1.g3'), 1.7e9)
+    write_hk_file(str(tmp_path / 'data' / '2.g3'), 1.7e9 + 100)
+    cache = str(tmp_path / 'cache' / 'checkdata.db')
+
+    checker = DataChecker(str(tmp_path / 'data'), workers=workers, cache=cache)
+    checker.run()
+    feed = checker.instances['fake-agent']['temps']
+    assert feed['t_last'] == 1.7e9 + 109
+    assert feed['fields']['temp']['v_last'] == 9.0
+    assert os.path.exists(cache)
+
+    # Cached summaries are used in place of unchanged files
+    checker = DataChecker(str(tmp_path / 'data'), cache=cache)
+    summary_cache = checker._open_cache()
+    path = checker._file_list[0]
+    summary_cache.put(path, {}, os.path.getsize(path))
+    summary_cache.close()
+    checker.scan_files()
+    assert len(checker.summaries) == 2
+    assert {} in checker.summaries.values()
+
+
+def test_data_checker_default_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    write_hk_file(str(tmp_path / '1.g3'), 1.7e9)
+
+    # The cache is opt-in
+    DataChecker(str(tmp_path)).scan_files()
+    assert not os.path.exists(tmp_path / 'cache')
+
+    DataChecker(str(tmp_path), cache=True).scan_files()
+    assert os.path.exists(tmp_path / 'cache' / 'ocs' / 'checkdata.db')
+
+
+def test_data_checker_appended_file(tmp_path, monkeypatch):
+    """Files that grew since they were cached are read from where the cached
+    summary left off."""
+    full = str(tmp_path / 'full.g3')
+    write_hk_file(full, 1.7e9, frames=3)
+    with open(full, 'rb') as f:
+        content = f.read()
+    # Truncate after the second data frame, as if the file was still being
+    # written
+    reader = core.G3Reader(full)
+    for _ in range(4):
+        reader(None)
+    partial = reader.tell()
+
+    os.mkdir(tmp_path / 'data')
+    path = str(tmp_path / 'data' / '1.g3')
+    with open(path, 'wb') as f:
+        f.write(content[:partial])
+    cache = str(tmp_path / 'checkdata.db')
+    checker = DataChecker(str(tmp_path / 'data'), cache=cache)
+    checker.scan_files()
+    assert checker.fields['observatory.fake-agent.feeds.temps.count'] == (1.7e9 + 19, 19)
+
+    with open(path, 'ab') as f:
+        f.write(content[partial:])
+    starts = []
+    _read_last_samples = checkdata._read_last_samples
+
+    def _read_and_record(path, summary, start=0, providers=None):
+        starts.append(start)
+        return _read_last_samples(path, summary, start, providers)
+    monkeypatch.setattr(checkdata, '_read_last_samples', _read_and_record)
+
+    checker = DataChecker(str(tmp_path / 'data'), cache=cache)
+    checker.scan_files()
+    assert starts == [partial]
+    assert checker.fields['observatory.fake-agent.feeds.temps.count'] == (1.7e9 + 29, 29)
+    assert checker.fields['observatory.fake-agent.feeds.temps.temp'] == (1.7e9 + 29, 29.)
+
+    # Now unchanged, so read from the cache
+    checker = DataChecker(str(tmp_path / 'data'), cache=cache)
+    checker.scan_files()
+    assert starts == [partial]
+    assert checker.fields['observatory.fake-agent.feeds.temps.count'] == (1.7e9 + 29, 29)
+
+
+def test_latest_values(tmp_path, monkeypatch):
+    write_hk_file(str(tmp_path / '1700000000.g3'), 1.7e9, feed='old')
+    write_hk_file(str(tmp_path / '1700000100.g3'), 1.7e9 + 100)
+    write_hk_file(str(tmp_path / '1700000200.g3'), 1.7e9 + 200)
+    # The newest file is still being written
+    with open(tmp_path / '1700000300.g3', 'wb') as f:
+        f.write(b'partial')
+
+    read = []
+    _read_last_samples = checkdata._read_last_samples
+
+    def _read_and_record(path, summary):
+        read.append(os.path.basename(path))
+        _read_last_samples(path, summary)
+    monkeypatch.setattr(checkdata, '_read_last_samples', _read_and_record)
+
+    latest = latest_values(str(tmp_path), ['observatory.fake-agent.feeds.temps.temp'])
+    assert latest == {'observatory.fake-agent.feeds.temps.temp': (1.7e9 + 209, 9.0)}
+    assert read == ['1700000300.g3', '1700000200.g3']
+
+    read.clear()
+    latest = latest_values(str(tmp_path), ['observatory.fake-agent.feeds.temps.count',
+                                           'observatory.fake-agent.feeds.old.count',
+                                           'observatory.fake-agent.feeds.missing.count'])
+    assert latest == {'observatory.fake-agent.feeds.temps.count': (1.7e9 + 209, 9),
+                      'observatory.fake-agent.feeds.old.count': (1.7e9 + 9, 9)}
+    assert len(read) == 4
@@ -0,0 +1,279 @@
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+from ocs.testing import create_influxdb_fixture
+from util import write_hk_file
+
+try:
+    # dependent on so3g
+    from ocs import g32influx
+    from ocs.g32influx import (DataLoader, SingleFileScanner,
+                               StreamingFileScanner, _FileProgress,
+                               _format_column)
+except ModuleNotFoundError as e:
+    print(f"Unable to import: {e}")
+
+influxdb = create_influxdb_fixture()
+
+T0 = 1.7e9
+N = 10
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Directory with two HK files, and the sqlite database in tmp_path."""
+    monkeypatch.setenv('OCS_SITE_CONFIG', str(tmp_path))
+    data = tmp_path / 'data'
+    data.mkdir()
+    write_hk_file(str(data / '1700000000.g3'), T0)
+    write_hk_file(str(data / '1700000100.g3'), T0 + 100)
+    return data
+
+
+def _crashing_encode_file(path, *args):
+    """Kill the decoding worker on the first file, as a segfault would."""
+    if path.endswith('1700000000.g3'):
+        os._exit(1)
+    return g32influx._encode_file(path, *args)
+
+
+def make_loader(data_dir, influxdb, **kwargs):
+    return DataLoader(str(data_dir), 'ocs_feeds', port=influxdb.port, **kwargs)
+
+
+def published(loader):
+    c = loader.sqliteconn.cursor()
+    c.execute("SELECT path, published from g3files")
+    result = {os.path.basename(path): pub for path, pub in c.fetchall()}
+    c.close()
+    return result
+
+
+def test_format_column():
+    assert _format_column('x', np.array([1.5, np.nan, np.inf])) == \
+        ['x=1.5', None, None]
+    assert _format_column('x', np.array([1, -2])) == ['x=1i', 'x=-2i']
+    assert _format_column('x', np.array([True, False])) == ['x=True', 'x=False']
+    assert _format_column('x', np.array(['a b'])) == ['x="a b"']
+
+
+def test_file_progress_out_of_order():
+    progress = _FileProgress()
+    assert progress.checkpoint(1, {'a': 2.}) == {}
+    assert progress.checkpoint(2, {'b': 3.}) == {}
+    assert progress.checkpoint(0, {'a': 1.}) == {'a': 2., 'b': 3.}
+    assert progress.checkpoint(3, {'a': 4.}) == {'a': 4.}
+
+    assert not progress.done
+    progress.expected = 4
+    progress.written = 4
+    assert progress.done
+
+
+def test_format_batches(data_dir):
+    path = str(data_dir / '1700000000.g3')
+    scanner = SingleFileScanner(path, None)
+    scanner.scan_file()
+    timeline, = scanner.timelines.values()
+    key = 'observatory.fake-agent.feeds.temps.count'
+
+    batches = scanner.format_batches(timeline, 4)
+    assert [len(points) for _, points in batches] == [4, 4, 2]
+    assert [checkpoints for checkpoints, _ in batches] == \
+        [{key: T0 + 3}, {key: T0 + 7}, {key: T0 + 9}]
+
+    scanner = SingleFileScanner(path, None, checkpoints={key: T0 + 7})
+    scanner.scan_file()
+    timeline, = scanner.timelines.values()
+    (checkpoints, points), = scanner.format_batches(timeline, 4)
+    assert checkpoints == {key: T0 + 9}
+    assert len(points) == 2
+
+
+def test_streaming_file_scanner(data_dir):
+    path = str(data_dir / '1700000000.g3')
+    key = 'observatory.fake-agent.feeds.temps.count'
+
+    scanner = StreamingFileScanner(path, None)
+    scanner.scan_file()
+    batches = list(scanner.iter_batches(4))
+    assert [len(points) for _, points in batches] == [4, 4, 2]
+    assert batches[-1][0] == {key: T0 + 9}
+    assert batches[0][1][1] == \
+        'observatory.fake-agent,feed=temps count=1i,temp=1.0 ' \
+        f'{int(T0 + 1) * 10**9}'
+
+    # Batches are also limited in size
+    line_size = len(batches[0][1][0]) + 1
+    scanner = StreamingFileScanner(path, None, max_bytes=3 * line_size)
+    scanner.scan_file()
+    assert [len(points) for _, points in scanner.iter_batches(100)] == \
+        [3, 3, 3, 1]
+
+    # Resume from checkpoints saved by either scanner
+    scanner = StreamingFileScanner(path, None, checkpoints={key: T0 + 7})
+    scanner.scan_file()
+    (checkpoints, points), = scanner.iter_batches(100)
+    assert checkpoints == {key: T0 + 9}
+    assert len(points) == 2
+
+
+def test_scanners_drop_nan(tmp_path):
+    path = str(tmp_path / 'nan.g3')
+    write_hk_file(path, T0, temps=[np.nan, 1., np.inf] + [3.] * (N - 3))
+
+    def fields_by_time(lines):
+        fields = {}
+        for line in lines:
+            assert 'nan' not in line and 'inf' not in line
+            _, flist, t = line.strip().rsplit(' ', 2)
+            fields[int(t)] = {f.split('=')[0] for f in flist.split(',')}
+        return fields
+
+    results = []
+    for scanner_class in [SingleFileScanner, StreamingFileScanner]:
+        scanner = scanner_class(path, None)
+        scanner.scan_file()
+        lines = [line for _, points in scanner.iter_batches(100)
+                 for line in points]
+        results.append(fields_by_time(lines))
+
+    single, streaming = results
+    assert single == streaming
+    assert len(single) == N
+    assert single[int(T0) * 10**9] == {'count'}
+    assert single[int(T0 + 1) * 10**9] == {'count', 'temp'}
+    assert single[int(T0 + 2) * 10**9] == {'count'}
+
+
+def test_mismatched_checkpoints_dropped(data_dir):
+    path = str(data_dir / '1700000000.g3')
+    scanner = SingleFileScanner(path, None, checkpoints={'old.key': T0 + 7})
+    scanner.scan_file()
+    assert scanner.checkpoints == {}
+
+
+def test_lookup_md5sum(data_dir, influxdb, monkeypatch):
+    path = str(data_dir / '1700000000.g3')
+    loader = make_loader(data_dir, influxdb)
+    md5 = g32influx._md5sum(path)
+
+    calls = []
+
+    def _md5sum(path):
+        calls.append(path)
+        return md5
+
+    monkeypatch.setattr(g32influx, '_md5sum', _md5sum)
+    fingerprints, renames = {}, {}
+    assert loader._lookup_md5sum(path, fingerprints, renames) == md5
+    assert len(calls) == 1
+
+    # Unchanged files use the cached md5sum
+    assert loader._lookup_md5sum(path, fingerprints, renames) == md5
+    assert len(calls) == 1
+
+    # Renamed files use the md5sum of the matching fingerprint
+    new_path = str(data_dir / '1700000050.g3')
+    os.rename(path, new_path)
+    assert loader._lookup_md5sum(new_path, fingerprints, renames) == md5
+    assert len(calls) == 1
+    assert list(fingerprints) == [new_path]
+
+    loader.full_hash = True
+    assert loader._lookup_md5sum(new_path, fingerprints, renames) == md5
+    assert len(calls) == 2
+
+
+def test_check_filelist_single_transaction(data_dir, influxdb):
+    loader = make_loader(data_dir, influxdb)
+    statements = []
+    loader.sqliteconn.set_trace_callback(statements.append)
+    loader.check_filelist_against_sqlite()
+    assert statements.count('COMMIT') == 1
+    assert published(loader) == {'1700000000.g3': 0, '1700000100.g3': 0}
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_publish(data_dir, influxdb, workers, streaming):
+    loader = make_loader(data_dir, influxdb, workers=workers, writers=2,
+                         batch_size=3, streaming=streaming)
+    loader.run()
+
+    lines = influxdb.lines['ocs_feeds']
+    assert len(lines) == 2 * N
+    assert len(set(lines)) == 2 * N
+    assert published(loader) == {'1700000000.g3': 1, '1700000100.g3': 1}
+
+    # Published files aren't written again
+    make_loader(data_dir, influxdb, workers=workers).run()
+    assert len(influxdb.lines['ocs_feeds']) == 2 * N
+
+
+def test_rename_detected(data_dir, influxdb):
+    make_loader(data_dir, influxdb).run()
+    os.rename(data_dir / '1700000000.g3', data_dir / '1700000050.g3')
+
+    loader = make_loader(data_dir, influxdb)
+    loader.run()
+    assert published(loader) == {'1700000050.g3': 1, '1700000100.g3': 1}
+    assert len(influxdb.lines['ocs_feeds']) == 2 * N
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_resume(data_dir, influxdb, monkeypatch, streaming):
+    loader = make_loader(data_dir, influxdb, batch_size=3, streaming=streaming)
+    save_checkpoints = loader._save_checkpoints
+
+    def interrupt(chksum, checkpoints):
+        save_checkpoints(chksum, checkpoints)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(loader, '_save_checkpoints', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        loader.run()
+    assert len(influxdb.lines['ocs_feeds']) == 3
+    conn = sqlite3.connect(str(data_dir.parent / '.g32influx.db'))
+    assert conn.execute("SELECT COUNT(*) from checkpoints").fetchone() == (1, )
+
+    loader = make_loader(data_dir, influxdb, batch_size=3, streaming=streaming)
+    loader.run(skip_file_check=True)
+    lines = influxdb.lines['ocs_feeds']
+    assert len(lines) == 2 * N
+    assert len(set(lines)) == 2 * N
+    # Checkpoints are cleared once files are published
+    assert conn.execute("SELECT COUNT(*) from checkpoints").fetchone() == (0, )
+    conn.close()
+
+
+def test_resume_after_outage(data_dir, influxdb):
+    loader = make_loader(data_dir, influxdb, workers=2, retries=0)
+    influxdb.outage = True
+    loader.run()
+    # Files that couldn't be written are left to resume
+    assert published(loader) == {'1700000000.g3': 0, '1700000100.g3': 0}
+
+    influxdb.outage = False
+    loader = make_loader(data_dir, influxdb, workers=2)
+    loader.run()
+    assert published(loader) == {'1700000000.g3': 1, '1700000100.g3': 1}
+    assert len(influxdb.lines['ocs_feeds']) == 2 * N
+
+
+def test_worker_died(data_dir, influxdb, monkeypatch):
+    loader = make_loader(data_dir, influxdb, workers=2)
+    encode_file = g32influx._encode_file
+    monkeypatch.setattr(g32influx, '_encode_file', _crashing_encode_file)
+    loader.run()
+    # Files that were decoding when the worker died are left to resume
+    assert published(loader)['1700000000.g3'] == 0
+
+    monkeypatch.setattr(g32influx, '_encode_file', encode_file)
+    loader = make_loader(data_dir, influxdb, workers=2)
+    loader.run()
+    assert published(loader) == {'1700000000.g3': 1, '1700000100.g3': 1}
+    assert len(set(influxdb.lines['ocs_feeds'])) == 2 * N
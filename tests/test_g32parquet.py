@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from util import write_hk_file
+
+try:
+    # dependent on so3g and pyarrow
+    import pyarrow.dataset as ds
+    from ocs.g32parquet import ParquetExporter
+except ModuleNotFoundError as e:
+    print(f"Unable to import: {e}")
+
+T0 = 1.7e9
+BLOCK = os.path.join('observatory.fake-agent.feeds.temps', 'temps')
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    write_hk_file(str(data / '1700000000.g3'), T0)
+    write_hk_file(str(data / '1700000100.g3'), T0 + 100)
+    return data
+
+
+def read_output(output):
+    return ds.dataset(str(output / BLOCK)).to_table().sort_by('timestamp')
+
+
+def list_files(output):
+    return sorted(os.path.relpath(os.path.join(root, f), output)
+                  for root, _, files in os.walk(output) for f in files
+                  if not f.startswith('.g32parquet.db'))
+
+
+def assert_unique(table, n):
+    times = table['timestamp'].to_pylist()
+    assert len(times) == n
+    assert len(set(times)) == n
+
+
+def test_export(data_dir, tmp_path):
+    output = tmp_path / 'out'
+    ParquetExporter(str(data_dir), str(output)).run()
+
+    files = list_files(output)
+    assert len(files) == 1
+    assert files[0].startswith(os.path.join(BLOCK, '2023-11-14', 'part-'))
+    table = read_output(output)
+    assert_unique(table, 20)
+    assert sorted(table.column_names) == ['count', 'temp', 'timestamp']
+    assert table['count'].to_pylist()[:3] == [0, 1, 2]
+
+
+def test_export_incremental(data_dir, tmp_path):
+    output = tmp_path / 'out'
+    ParquetExporter(str(data_dir), str(output), max_rows=5).run()
+    files = list_files(output)
+    assert len(files) == 2
+
+    # Nothing new to export
+    ParquetExporter(str(data_dir), str(output)).run()
+    assert list_files(output) == files
+
+    # New files are added as new parts, without rewriting the old ones
+    write_hk_file(str(data_dir / '1700000200.g3'), T0 + 200)
+    ParquetExporter(str(data_dir), str(output)).run()
+    assert set(files) < set(list_files(output))
+    assert_unique(read_output(output), 30)
+
+
+def test_export_growing_file(tmp_path):
+    """Samples added to a file after it was exported are appended."""
+    data = tmp_path / 'data'
+    data.mkdir()
+    output = tmp_path / 'out'
+    path = str(data / '1700000000.g3')
+    write_hk_file(path, T0, n=5)
+    ParquetExporter(str(data), str(output)).run()
+    assert_unique(read_output(output), 5)
+
+    write_hk_file(path, T0, n=10)
+    ParquetExporter(str(data), str(output)).run()
+    assert_unique(read_output(output), 10)
+
+
+def test_recover_committed_parts(data_dir, tmp_path):
+    """Parts committed before an interruption are renamed on the next run."""
+    output = tmp_path / 'out'
+    exporter = ParquetExporter(str(data_dir), str(output))
+
+    def interrupt():
+        raise KeyboardInterrupt
+    exporter._rename_parts = interrupt
+    with pytest.raises(KeyboardInterrupt):
+        exporter.run()
+    exporter.sqliteconn.close()
+    assert all(f.endswith('.parquet.tmp') for f in list_files(output))
+
+    ParquetExporter(str(data_dir), str(output)).run()
+    assert all(f.endswith('.parquet') for f in list_files(output))
+    assert_unique(read_output(output), 20)
+
+
+def test_recover_uncommitted_parts(data_dir, tmp_path):
+    """Parts written, but not committed, before an interruption are removed,
+    and their rows exported again."""
+    output = tmp_path / 'out'
+    exporter = ParquetExporter(str(data_dir), str(output))
+    conn = exporter.sqliteconn
+
+    class InterruptedConnection:
+        def cursor(self):
+            return conn.cursor()
+
+        def commit(self):
+            raise KeyboardInterrupt
+    exporter.sqliteconn = InterruptedConnection()
+    with pytest.raises(KeyboardInterrupt):
+        exporter.run()
+    conn.close()
+    assert all(f.endswith('.parquet.tmp') for f in list_files(output))
+
+    ParquetExporter(str(data_dir), str(output)).run()
+    files = list_files(output)
+    assert len(files) == 1 and files[0].endswith('.parquet')
+    assert_unique(read_output(output), 20)
@@ -3,7 +3,10 @@ import os
 import pytest
 
 from ocs.agents.influxdb_publisher.drivers import _get_credentials
-from ocs.common.influxdb_drivers import format_data, timestamp2influxtime
+from ocs.common.influxdb_drivers import (FieldFilter, PayloadAssembler,
+                                         WindowAggregator, format_data,
+                                         timestamp2influxtime,
+                                         timestamps2influxtimes)
 
 
 @pytest.mark.parametrize("t,protocol,expected",
@@ -14,6 +17,20 @@ def test_timestamp2influxtime(t, protocol, expected):
     assert timestamp2influxtime(t, protocol) == expected
 
 
+@pytest.mark.parametrize("precision,line,json",
+                         [('s', 1615389657, '2021-03-10T15:20:57'),
+                          ('ms', 1615389657290, '2021-03-10T15:20:57.290'),
+                          ('us', 1615389657290489, '2021-03-10T15:20:57.290489'),
+                          ('ns', 1615389657290489344, '2021-03-10T15:20:57.290489')])
+def test_timestamp2influxtime_precision(precision, line, json):
+    """Test scalar and vectorized conversion agree for each precision."""
+    t = 1615389657.2904894
+    assert timestamp2influxtime(t, 'line', precision) == line
+    assert timestamp2influxtime(t, 'json', precision) == json
+    assert timestamps2influxtimes([t, 1e1000], 'line', precision) == [line, None]
+    assert timestamps2influxtimes([t, 1e1000], 'json', precision) == [json, None]
+
+
 def test_format_data():
     """Test passing int, float, string to InfluxDB line protocol."""
 
@@ -49,6 +66,164 @@ def test_format_data_inf_time():
     assert format_data(data, feed, 'json') == []
 
 
+def _filter_feed(influx_filter=None):
+    feed = {'agent_address': 'test_address',
+            'feed_name': 'test_feed',
+            'address': 'test_address.feeds.test_feed',
+            'session_id': '1',
+            'agg_params': {}}
+    if influx_filter is not None:
+        feed['agg_params']['influx_filter'] = influx_filter
+    return feed
+
+
+def test_field_filter_deadband():
+    """Test absolute deadband and unfiltered fields."""
+    field_filter = FieldFilter([{'pattern': '*.feeds.test_feed.key1',
+                                 'deadband': 0.5}])
+    feed = _filter_feed()
+
+    values = [1.0, 1.2, 1.6, 1.7, 0.9]
+    written = []
+    for i, v in enumerate(values):
+        fields = field_filter.filter_fields(feed, {'key1': v, 'key2': v}, i)
+        # key2 has no rule, so always passes
+        assert fields['key2'] == v
+        if 'key1' in fields:
+            written.append(fields['key1'])
+
+    assert written == [1.0, 1.6, 0.9]
+
+
+def test_field_filter_rel_deadband_and_heartbeat():
+    """Test relative deadband and max_silence via agg_params."""
+    feed = _filter_feed({'key*': {'rel_deadband': 0.1, 'max_silence': 10}})
+    field_filter = FieldFilter()
+
+    assert field_filter.filter_fields(feed, {'key1': 100.}, 0) == {'key1': 100.}
+    assert field_filter.filter_fields(feed, {'key1': 105.}, 1) == {}
+    assert field_filter.filter_fields(feed, {'key1': 111.}, 2) == {'key1': 111.}
+    assert field_filter.filter_fields(feed, {'key1': 111.}, 5) == {}
+    # heartbeat
+    assert field_filter.filter_fields(feed, {'key1': 111.}, 12) == {'key1': 111.}
+
+
+def test_field_filter_change_only():
+    """Test strings and bools are only written on change."""
+    feed = _filter_feed({'state': {}, 'relay': {}})
+    field_filter = FieldFilter()
+
+    points = [('on', True), ('on', True), ('off', True), ('off', False)]
+    written = [field_filter.filter_fields(feed, {'state': s, 'relay': r}, i)
+               for i, (s, r) in enumerate(points)]
+
+    assert written == [{'state': 'on', 'relay': True},
+                       {},
+                       {'state': 'off'},
+                       {'relay': False}]
+
+
+def test_format_data_field_filter():
+    """Test points with all fields filtered out are dropped."""
+    feed = _filter_feed({'key1': {'deadband': 1}})
+    data = {'test': {'block_name': 'test',
+                     'timestamps': [1615394417.0, 1615394418.0, 1615394419.0],
+                     'data': {'key1': [1.0, 1.5, 2.5]},
+                     }
+            }
+
+    lines = format_data(data, feed, 'line', field_filter=FieldFilter())
+    assert lines == ['test_address,feed=test_feed key1=1.0 1615394417000000000',
+                     'test_address,feed=test_feed key1=2.5 1615394419000000000']
+
+
+def test_field_filter_from_file(tmp_path):
+    config = tmp_path / "filter.yaml"
+    config.write_text("- pattern: '*.setpoint'\n"
+                      "  deadband: 0.1\n"
+                      "  max_silence: 60\n", encoding="utf-8")
+    field_filter = FieldFilter.from_file(str(config))
+    assert field_filter.rules[0][0] == '*.setpoint'
+    assert field_filter.rules[0][1].deadband == 0.1
+
+    with pytest.raises(ValueError):
+        FieldFilter([{'pattern': '*', 'deadbnd': 0.1}])
+
+
+def test_window_aggregator():
+    """Test windows are aligned, and completed by the data timestamps."""
+    feed = _filter_feed()
+    data = {'test': {'block_name': 'test',
+                     'timestamps': [1615394400.5, 1615394430.0, 1615394459.9,
+                                    1615394460.1],
+                     'data': {'key1': [1.0, 3.0, 2.0, 10.0],
+                              'key2': ['a', 'b', 'c', 'd']},
+                     }
+            }
+
+    aggregator = WindowAggregator(60, measurement_suffix='_1m')
+    aggregator.add(data, feed)
+
+    # Not completed until the data is past the window by the latency
+    assert aggregator.flush('line') == []
+
+    # Out of order samples within the latency are still included
+    def _sample(t, v):
+        return {'test': {'block_name': 'test', 'timestamps': [t],
+                         'data': {'key1': [v]}}}
+    aggregator.add(_sample(1615394455.0, 4.0), feed)
+    aggregator.add(_sample(1615394470.5, 6.0), feed)
+    lines = aggregator.flush('line')
+    assert lines == ['test_address_1m,feed=test_feed key1_min=1.0,key1_max=4.0,'
+                     + 'key1_mean=2.5,key1_count=4i 1615394400000000000']
+
+    # Delayed data completes windows the same way, regardless of when it
+    # arrives
+    aggregator.add(_sample(1615394520.0, 7.0), feed)
+    aggregator.add(_sample(1615394531.0, 8.0), feed)
+    points = aggregator.flush('json')
+    assert len(points) == 1
+    assert points[0]['measurement'] == 'test_address_1m'
+    assert points[0]['fields'] == {'key1_min': 6.0, 'key1_max': 10.0,
+                                   'key1_mean': 8.0, 'key1_count': 2}
+
+    # Late data for a completed window is dropped, and counted
+    aggregator.add(_sample(1615394470.0, 5.0), feed)
+    assert aggregator.flush('line') == []
+    assert aggregator.dropped_samples == 1
+
+
+def test_window_aggregator_default_suffix():
+    """Test downsampled data goes to its own measurement by default."""
+    aggregator = WindowAggregator(60)
+    aggregator.add({'test': {'block_name': 'test',
+                             'timestamps': [0.0, 100.0],
+                             'data': {'key1': [1.0, 2.0]}}}, _filter_feed())
+    assert aggregator.flush('line')[0].startswith('test_address_ds,')
+
+
+def test_payload_assembler_line():
+    """Test line protocol batches are cut on line count and size."""
+    assembler = PayloadAssembler('line', max_lines=3, max_bytes=20)
+
+    assert assembler.add(['a 1', 'b 2']) == []
+    assert len(assembler) == 2
+    assert assembler.add(['c 3', 'd 4']) == [b'a 1\nb 2\nc 3\n']
+    # 'd 4' is 4 bytes encoded, next line would push the batch over 20
+    assert assembler.add(['e' * 16]) == [b'd 4\n']
+    assert assembler.flush() == [b'e' * 16 + b'\n']
+    assert assembler.flush() == []
+
+
+def test_payload_assembler_json():
+    """Test JSON protocol batches are cut on point count."""
+    assembler = PayloadAssembler('json', max_lines=2)
+    points = [{'n': i} for i in range(5)]
+
+    batches = assembler.add(points) + assembler.flush()
+    assert batches == [[{'n': 0}, {'n': 1}], [{'n': 2}, {'n': 3}], [{'n': 4}]]
+
+
 def test__get_credentials(tmp_path):
     # Defaults
     assert _get_credentials() == ('root', 'root')
@@ -1,18 +1,22 @@
 import ocs
 from ocs.ocs_agent import (
     OCSAgent, AgentTask, AgentProcess,
-    ParamError, ParamHandler, param,
-    OpSession
+    ParamError, ParamHandler, param, compile_params,
+    OpSession, MessageBuffer
 )
 from ocs.base import OpCode
+from ocs.ocs_client import OCSReply, SessionWatcher
 
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import pytest
 import pytest_twisted
 
+import asyncio
 import json
 import math
+import threading
+import time
 import numpy as np
 
 
@@ -59,10 +63,30 @@ def mock_agent():
     mock_site_args.working_dir = "./"
     mock_site_args.log_dir = "./"
     mock_site_args.access_policy = None
+    mock_site_args.thread_pool_size = None
+    mock_site_args.reactor_lag_interval = None
     a = OCSAgent(mock_config, mock_site_args, address='test.address')
     return a
 
 
+@patch('ocs._installed_version', MagicMock(side_effect=RuntimeError))
+def test_agent_version_unknown():
+    """Agents still start without ocs/_version.py, logging an unknown
+    version.
+
+    """
+    mock_site_args = MagicMock()
+    mock_site_args.working_dir = "./"
+    mock_site_args.log_dir = "./"
+    mock_site_args.access_policy = None
+    mock_site_args.thread_pool_size = None
+    mock_site_args.reactor_lag_interval = None
+    log = MagicMock()
+    with patch('txaio.make_logger', return_value=log):
+        OCSAgent(MagicMock(), mock_site_args, address='test.address')
+    log.info.assert_any_call("Using OCS version {v}", v='unknown')
+
+
 # Registration
 def test_register_task(mock_agent):
     """Registered tasks should show up in the Agent tasks and sessions
@@ -160,6 +184,84 @@ def test_register_process_w_startup_dict(mock_agent):
     assert mock_agent.startup_ops == [('process', 'test_process', {'arg1': 12})]
 
 
+def test_register_dedicated_thread(mock_agent):
+    mock_agent.register_task('test_task', tfunc)
+    mock_agent.register_process('test_process', tfunc, tfunc,
+                                dedicated_thread=True)
+    assert mock_agent.tasks['test_task'].pool is mock_agent.thread_pool
+    pool = mock_agent.processes['test_process'].pool
+    assert pool is not mock_agent.thread_pool
+    assert pool.size == 1
+
+    stats = mock_agent._management_handler('get_api')['thread_pools']
+    assert stats['shared']['size'] == 10
+    assert list(stats['dedicated']) == ['test_process']
+
+
+async def tfunc_coroutine(session, params):
+    """Test coroutine Operation."""
+    await asyncio.sleep(10)
+    return True, 'Task completed successfully'
+
+
+def test_register_coroutine_needs_asyncio_reactor(mock_agent):
+    with pytest.raises(RuntimeError):
+        mock_agent.register_task('test_task', tfunc_coroutine)
+
+
+def test_register_process_no_stopper(mock_agent):
+    """Test that plain Processes can still be registered without a
+    stopper, as before coroutine support."""
+    mock_agent.register_process('test_process', tfunc, None)
+    assert mock_agent.processes['test_process'].stopper is None
+
+
+def test_coroutine_op_cancel():
+    """Test that cancelling a coroutine Operation gives a result."""
+    op = AgentProcess(tfunc_coroutine, None)
+    assert op.coroutine and not op.blocking
+    session = create_session('test_process')
+    results = []
+
+    async def run():
+        d = op._launch_coroutine(session, {})
+        d.addCallback(results.append)
+        await asyncio.sleep(0)
+        op.cancel()
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run())
+    loop.close()
+    assert session.status == 'running'
+    assert results == [AgentProcess.cancelled_result]
+
+
+def test_publish_reactor_lag():
+    mock_site_args = MagicMock()
+    mock_site_args.working_dir = "./"
+    mock_site_args.log_dir = "./"
+    mock_site_args.access_policy = None
+    mock_site_args.thread_pool_size = None
+    mock_site_args.reactor_lag_interval = 0.01
+    mock_site_args.reactor_lag_threshold = 0.1
+    agent = OCSAgent(MagicMock(), mock_site_args, address='test.address')
+    agent.publish_to_feed = MagicMock()
+
+    monitor = agent.lag_monitor
+    monitor.stalls.append({'time': time.time(), 'lag': 0.5, 'stack': 'here'})
+    monitor.stall_count += 1
+    agent._publish_reactor_lag()
+    message = agent.publish_to_feed.call_args[0][1]
+    assert message['data']['stalls'] == 1
+    assert message['data']['count'] == 0
+
+    agent._publish_reactor_lag()
+    message = agent.publish_to_feed.call_args[0][1]
+    assert message['data']['stalls'] == 0
+
+
 # Start
 def test_start_task(mock_agent):
     """Test a typical task that is blocking and already not running."""
@@ -281,6 +383,17 @@ def test_start_task_none_params(mock_agent):
     assert res[0] == ocs.OK
 
 
+def test_start_task_invalid_params(mock_agent):
+    """Test that params are checked by the compiled validator, before the
+    task is launched."""
+    mock_agent.register_task('test_task', tfunc_param_dec)
+    assert mock_agent.tasks['test_task'].param_validator is not None
+    res = mock_agent.start('test_task', params={'test': 2, 'b': 2})
+    assert res[0] == ocs.ERROR
+    assert res[1] == "params included unexpected values: ['b']"
+    assert mock_agent.sessions['test_task'] is None
+
+
 # Wait
 @pytest_twisted.inlineCallbacks
 def test_wait(mock_agent):
@@ -511,6 +624,282 @@ def test_session_data_bad(key, value):
         session.encoded()
 
 
+def test_message_buffer_max_messages():
+    """Test that the message count is limited on every append."""
+    messages = MessageBuffer(max_messages=100, min_messages=5, max_age=3600)
+    t0 = 1e9
+    for i in range(250):
+        messages.append((t0 + i, f'msg {i}'))
+        assert len(messages) == min(i + 1, 100)
+
+    assert list(messages) == [(t0 + i, f'msg {i}') for i in range(150, 250)]
+    assert messages[0] == (t0 + 150, 'msg 150')
+    assert messages[-1] == (t0 + 249, 'msg 249')
+    assert messages[-2:] == [(t0 + 248, 'msg 248'), (t0 + 249, 'msg 249')]
+    with pytest.raises(IndexError):
+        messages[100]
+
+
+def test_message_buffer_max_age():
+    """Test that old messages are discarded, keeping min_messages."""
+    messages = MessageBuffer(max_messages=100, min_messages=5, max_age=10)
+    t0 = 1e9
+    for i in range(50):
+        messages.append((t0 + i, f'msg {i}'))
+    assert [t for t, _ in messages] == [t0 + i for i in range(39, 50)]
+
+    messages.expire(now=t0 + 1000)
+    assert [t for t, _ in messages] == [t0 + i for i in range(45, 50)]
+
+    # Appending after wrapping around the ring keeps the order
+    for i in range(1000, 1030):
+        messages.append((t0 + i, f'msg {i}'))
+    assert [t for t, _ in messages] == [t0 + i for i in range(1019, 1030)]
+
+
+def test_message_buffer_since():
+    messages = MessageBuffer(max_messages=20)
+    t0 = time.time()
+    for i in range(30):
+        messages.append((t0 + i, f'msg {i}'))
+
+    assert messages.since(t0 + 25) == [(t0 + i, f'msg {i}') for i in range(26, 30)]
+    assert messages.since(t0 + 25.5) == [(t0 + i, f'msg {i}') for i in range(26, 30)]
+    assert messages.since(t0 + 100) == []
+    assert messages.since(0) == list(messages)
+
+
+def test_session_messages_encoded():
+    session = create_session('test_messages')
+    session.add_message('hello')
+
+    encoded = session.encoded()
+    assert isinstance(encoded['messages'], list)
+    assert encoded['messages'][-1][1] == 'hello'
+    json.dumps(encoded['messages'])
+
+
+def test_session_versions():
+    """Test that the version only changes when the encoded session does."""
+    session = create_session('test_versions')
+    session.data = {'a': 1, 'b': [1, 2]}
+    encoded = session.encoded()
+    version = encoded['version']
+    assert session.encoded() is encoded
+
+    # Reading data, or writing the same values, doesn't change the version
+    assert session.data['a'] == 1
+    session.data['b'] = [1, 2]
+    assert session.version == version
+
+    session.data['a'] = 2
+    assert session.version > version
+    session.degraded = True
+    assert session.encoded()['version'] > session.encoded(since=version)['since']
+
+
+def test_session_data_not_reencoded():
+    """Test that data is only encoded again when it actually changes,
+    including changes made through a reference held by the Agent."""
+    session = create_session('test_reencode')
+    data = {'a': 1, 'b': np.array([1., 2.])}
+    session.data = data
+    version = session.version
+
+    with patch('ocs.ocs_agent._json_safe', wraps=ocs.ocs_agent._json_safe) as json_safe:
+        session.data.update({'a': 1})
+        assert session.version == version
+        session.encoded(since=version)
+        json_safe.assert_not_called()
+
+        data['b'][0] = 5.
+        assert session.version > version
+        assert session.encoded()['data']['b'] == [5., 2.]
+        # One top-level call; the others are its recursion
+        assert [c.args[1:] for c in json_safe.call_args_list].count((True,)) == 1
+
+
+def test_session_delta():
+    session = create_session('test_delta')
+    session.data = {'a': 1, 'b': 2, 'c': 3}
+    session.add_message('first')
+    version = session.version
+
+    session.data['a'] = 10
+    del session.data['c']
+    session.add_message('second')
+
+    delta = session.encoded(since=version)
+    assert delta['since'] == version
+    assert delta['version'] == session.version
+    assert delta['data'] == {'a': 10}
+    assert delta['data_removed'] == ['c']
+    assert [m[1] for m in delta['messages']] == ['second']
+    assert delta['status'] == session.status
+
+    # Nothing has changed since the latest version
+    delta = session.encoded(since=session.version)
+    assert delta['data'] == {}
+    assert delta['data_removed'] == []
+    assert delta['messages'] == []
+
+    # Versions that aren't from this session, e.g. from before the
+    # Agent restarted, get the full encoding
+    for since in [0, session.version + 100]:
+        assert session.encoded(since=since) == session.encoded()
+
+
+def test_publish_session(mock_agent):
+    mock_agent.publish_to_feed = MagicMock()
+    session = create_session('test_feed')
+    session.data = {'a': 1}
+    session.add_message('first')
+
+    # The first message for a session includes everything
+    mock_agent._publish_session(session)
+    update = mock_agent.publish_to_feed.call_args[0][1]
+    assert update['data'] == {'a': 1}
+    assert update['messages'][-1][1] == 'first'
+
+    # Data changes wait for include_data, messages do not
+    session.data['a'] = 2
+    session.add_message('second')
+    mock_agent._publish_session(session)
+    update = mock_agent.publish_to_feed.call_args[0][1]
+    assert update['data'] == {}
+    assert [m[1] for m in update['messages']] == ['second']
+
+    mock_agent._publish_session(session, include_data=True)
+    update = mock_agent.publish_to_feed.call_args[0][1]
+    assert update['data'] == {'a': 2}
+    assert update['messages'] == []
+
+    # Nothing is published if nothing changed
+    mock_agent.publish_to_feed.reset_mock()
+    mock_agent._publish_session(session, include_data=True)
+    mock_agent.publish_to_feed.assert_not_called()
+
+    # A new session starts over
+    new_session = create_session('test_feed')
+    new_session.session_id = 2
+    new_session.data = {'b': 1}
+    mock_agent._publish_session(new_session)
+    update = mock_agent.publish_to_feed.call_args[0][1]
+    assert update['session_id'] == 2
+    assert update['data'] == {'b': 1}
+    assert 'since' not in update
+
+
+@patch.object(SessionWatcher, '_subscribe', MagicMock())
+def test_publish_session_to_watcher(mock_agent):
+    """A message and a data change in the same tick reach a watcher."""
+    session = create_session('test_feed')
+    client = MagicMock()
+    client.test_feed.status.return_value = OCSReply(ocs.OK, 'msg', session.encoded())
+    watcher = SessionWatcher(client, ['test_feed'])
+    mock_agent.publish_to_feed = MagicMock(
+        side_effect=lambda feed, update: watcher._on_event(update))
+    mock_agent._publish_session(session)
+
+    session.data = {'x': 5}
+    session.add_message('changed x')
+    mock_agent._publish_session(session)
+    mock_agent._publish_session(session, include_data=True)
+    assert watcher.get('test_feed').session == session.encoded()
+    watcher.close()
+
+
+def test_session_updated_disabled(mock_agent):
+    """Without a session feed, nothing is published."""
+    mock_agent.publish_to_feed = MagicMock()
+    session = OpSession(1, 'test_feed', app=mock_agent)
+    session.add_message('hello')
+    assert mock_agent._session_feed_pending == set()
+    mock_agent.publish_to_feed.assert_not_called()
+
+
+def _run_in_pool_thread(func, *args, **kwargs):
+    """Run func in a thread named like a twisted worker thread."""
+    t = threading.Thread(target=func, args=args, kwargs=kwargs,
+                         name='PoolThread-test')
+    t.start()
+    t.join()
+
+
+@patch('ocs.ocs_agent.reactor')
+def test_set_status_from_thread(mock_reactor):
+    session = create_session('test_status')
+    session.set_status('running')
+
+    # Scheduled without blocking, and applied in order
+    _run_in_pool_thread(session.set_status, 'stopping', wait=False)
+    _run_in_pool_thread(session.set_status, 'done', wait=False)
+    assert session.status == 'running'
+    assert mock_reactor.callFromThread.call_count == 2
+    for args, kwargs in mock_reactor.callFromThread.call_args_list:
+        args[0](*args[1:], **kwargs)
+    assert session.status == 'done'
+
+    # A change overtaken by the status moving on is dropped
+    session = create_session('test_status')
+    mock_reactor.reset_mock()
+    _run_in_pool_thread(session.set_status, 'running', wait=False)
+    session.set_status('stopping')
+    args, kwargs = mock_reactor.callFromThread.call_args
+    args[0](*args[1:], **kwargs)
+    assert session.status == 'stopping'
+
+
+@patch('ocs.ocs_agent.threads')
+def test_set_status_from_thread_blocks(mock_threads):
+    session = create_session('test_status')
+    _run_in_pool_thread(session.set_status, 'running')
+    mock_threads.blockingCallFromThread.assert_called_once()
+
+
+# Batch
+@pytest_twisted.inlineCallbacks
+def test_batch_in_order(mock_agent):
+    """Test that batched requests run in order, each waiting for the
+    previous one."""
+    mock_agent.register_task('test_task', tfunc)
+    replies = yield mock_agent._management_handler('batch', requests=[
+        ['start', 'test_task', {'a': 1}],
+        ['wait', 'test_task', None, {'timeout': 5}],
+        ['status', 'test_task']])
+    assert [r[0] for r in replies] == [ocs.OK] * 3
+    assert replies[1][2]['status'] == 'done'
+    assert replies[2][2]['success'] is True
+
+
+@pytest_twisted.inlineCallbacks
+def test_batch_concurrent_errors(mock_agent):
+    """Test that bad requests in a batch get error replies, without
+    affecting the others."""
+    mock_agent.register_task('test_task', tfunc)
+    replies = yield mock_agent._management_handler('batch', concurrent=True, requests=[
+        ['start', 'test_task'],
+        ['start'],
+        ['start', 'missing_task'],
+        ['wait', 'test_task', None, {'invalid_kwarg': 1}]])
+    assert [r[0] for r in replies] == [ocs.OK, ocs.ERROR, ocs.ERROR, ocs.ERROR]
+    assert replies[3][1].startswith('CRASH')
+    yield mock_agent.wait('test_task')
+
+
+@pytest_twisted.inlineCallbacks
+def test_batch_password(mock_agent):
+    """Test that the batch password is used unless a request has its own."""
+    assert mock_agent._management_handler('get_api')['batch'] is True
+    with patch.object(mock_agent, '_ops_handler',
+                      return_value=(ocs.OK, 'ok', {})) as ops_handler:
+        yield mock_agent._management_handler('batch', password='batch-pass', requests=[
+            ['status', 'a'],
+            ['status', 'b', None, {'password': 'own-pass'}]])
+    passwords = [c.kwargs['password'] for c in ops_handler.call_args_list]
+    assert passwords == ['batch-pass', 'own-pass']
+
+
 #
 # Tests for the @param decorator
 #
@@ -623,3 +1012,53 @@ def test_params_decorated():
         ParamHandler({'b': 12.}).batch(func_a._ocs_prescreen)
     with pytest.raises(ParamError):
         ParamHandler({'b': 12.}).batch(func_nothing._ocs_prescreen)
+
+
+def test_compile_params():
+    """Test that compiled validators match ParamHandler.batch."""
+    @param('a', type=float)
+    @param('b', default=None, cast=str.lower, choices=['x', 'y'])
+    @param('c', default=(1, 2), type=tuple)
+    @param('d', default=3, check=lambda x: x > 0, treat_none_as_missing=False)
+    def func(session, params):
+        pass
+
+    cases = [
+        None,
+        {},
+        {'a': 1},
+        {'a': 1.5, 'b': 'X', 'c': [3, 4]},
+        {'a': '1.5'},
+        {'a': 1, 'b': 'z'},
+        {'a': 1, 'b': 5},
+        {'a': 1, 'd': None},
+        {'a': 1, 'd': -1},
+        {'a': 1, 'e': 0},
+    ]
+    validator = compile_params(func._ocs_prescreen)
+    for params in cases:
+        try:
+            expected = ParamHandler(params).batch(func._ocs_prescreen)
+        except ParamError as err:
+            with pytest.raises(ParamError) as exc_info:
+                validator(params)
+            assert exc_info.value.msg == err.msg
+        else:
+            assert validator(params) == expected
+
+
+def test_compile_params_special_keys():
+    """Test the '_' and '_no_check_strays' instructions."""
+    @param('_')
+    def func_nothing(session, params):
+        pass
+
+    @param('a', default=12)
+    @param('_no_check_strays')
+    def func_whatever(session, params):
+        pass
+
+    assert compile_params(func_nothing._ocs_prescreen)({}) == {}
+    with pytest.raises(ParamError):
+        compile_params(func_nothing._ocs_prescreen)({'b': 12.})
+    assert compile_params(func_whatever._ocs_prescreen)({'b': 12.}) == {'a': 12}
@@ -9,8 +9,10 @@ from ocs.ocs_client import (
     _humanized_time,
     _get_op,
     _opname_to_attr,
+    merge_session,
     OCSClient,
     OCSReply,
+    SessionWatcher,
 )
 
 from util import fake_get_control_client, password_file  # noqa: F401
@@ -91,7 +93,7 @@ class TestGetOp:
         return client
 
     def _client_operation(self, op_type, op_name, response_code=ocs.OK,
-                          password=DUMMY_PASS):
+                          password=DUMMY_PASS, session_versions=False):
         """Build a mocked client, and get an Operation for it, returning
         both.
 
@@ -99,7 +101,8 @@ class TestGetOp:
         client = self.mock_client(op_name, response_code)
         encoded_task = {'blocking': True,
                         'docstring': 'Example docstring'}
-        task = _get_op(op_type, op_name, encoded_task, client, password)
+        task = _get_op(op_type, op_name, encoded_task, client, password,
+                       session_versions)
 
         return (client, task)
 
@@ -139,6 +142,23 @@ class TestGetOp:
         client.request.assert_called_with('status', 'task_name',
                                           password=DUMMY_PASS)
 
+    def test_task_status_since(self):
+        client, task = self._client_operation('task', 'task_name',
+                                              session_versions=True)
+        print(task.status(since=3))
+        client.request.assert_called_with('status', 'task_name', since=3,
+                                          password=DUMMY_PASS)
+        print(task.wait(since=3))
+        client.request.assert_called_with('wait', 'task_name', timeout=None,
+                                          since=3, password=DUMMY_PASS)
+
+    def test_task_status_since_old_agent(self, client_task):
+        # Agents that don't support since return the full session
+        client, task = client_task
+        print(task.status(since=3))
+        client.request.assert_called_with('status', 'task_name',
+                                          password=DUMMY_PASS)
+
     def test_task_call(self):
         client, task = self._client_operation('task', 'task_name', ocs.OK)
         print(task())
@@ -172,6 +192,28 @@ class TestGetOp:
         client.request.assert_called_with('status', 'process_name')
 
 
+def test_merge_session():
+    session = create_session('test')
+    session.data = {'a': 1, 'b': 2, 'c': 3}
+    session.add_message('first')
+    received = merge_session(None, session.encoded(since=0))
+    assert received == session.encoded()
+
+    version = session.version
+    session.data['a'] = 10
+    del session.data['c']
+    session.add_message('second')
+    session.set_status('done')
+    received = merge_session(received, session.encoded(since=version))
+    assert received == session.encoded()
+
+    # A full session replaces the previous one
+    other = create_session('test')
+    other.session_id = 2
+    assert merge_session(received, other.encoded()) == other.encoded()
+    assert merge_session(received, other.encoded(since=version)) == other.encoded()
+
+
 class TestOCSClient:
     @patch('ocs.site_config.get_control_client', fake_get_control_client())
     def test_ocsclient_object(self):
@@ -206,6 +248,74 @@ class TestOCSClient:
         client = OCSClient('agent-id', privs=DUMMY_PASS)
         assert client._password is None
 
+    @patch('ocs.site_config.get_control_client', fake_get_control_client())
+    def test_ocsclient_batch(self):
+        client = OCSClient('agent-id', privs=DUMMY_PASS)
+        client._api['batch'] = True
+        client._client.batch.return_value = [[ocs.OK, 'ok', {}],
+                                             [ocs.ERROR, 'no', {}]]
+        replies = client.batch([('start', 'task_name', {'a': 1}),
+                                ('wait', 'task_name', None, {'timeout': 1})],
+                               concurrent=True)
+        assert replies == [OCSReply(ocs.OK, 'ok', {}), OCSReply(ocs.ERROR, 'no', {})]
+        client._client.batch.assert_called_once_with(
+            [['start', 'task_name', {'a': 1}], ['wait', 'task_name', None, {'timeout': 1}]],
+            concurrent=True, password=DUMMY_PASS)
+
+    @patch('ocs.site_config.get_control_client', fake_get_control_client())
+    def test_ocsclient_batch_old_agent(self):
+        client = OCSClient('agent-id')
+        client._client.request.return_value = (ocs.OK, 'ok', {})
+        replies = client.batch([('start', 'task_name', {'a': 1}),
+                                ('wait', 'task_name', None, {'timeout': 1})])
+        assert replies == [OCSReply(ocs.OK, 'ok', {})] * 2
+        client._client.batch.assert_not_called()
+        assert client._client.request.call_args_list[1].kwargs == {
+            'params': None, 'timeout': 1}
+
+    @patch('ocs.site_config.get_control_client', fake_get_control_client())
+    def test_ocsclient_watch_no_feed(self):
+        client = OCSClient('agent-id')
+        with pytest.raises(RuntimeError):
+            client.watch()
+
+
+@patch.object(SessionWatcher, '_subscribe', MagicMock())
+def test_session_watcher():
+    session = create_session('task_name')
+    first_version = session.version
+    session.data = {'a': 1}
+    session.add_message('first')
+    seed_version = session.version
+
+    client = MagicMock()
+    client.task_name.status.return_value = OCSReply(ocs.OK, 'msg', session.encoded())
+    watcher = SessionWatcher(client, ['task_name'])
+    assert watcher.get('task_name').session == session.encoded()
+
+    # Updates from before the seed are dropped, and overlapping
+    # messages are not repeated
+    watcher._on_event(session.encoded(since=first_version))
+    assert watcher._updates.empty()
+    session.add_message('second')
+    update = dict(session.encoded(since=first_version), data={})
+    watcher._on_event(update)
+    op_name, reply = watcher._updates.get_nowait()
+    assert op_name == 'task_name'
+    assert reply.session == session.encoded()
+
+    session.data['a'] = 2
+    watcher._on_event(session.encoded(since=seed_version))
+    assert watcher.get('task_name').session['data'] == {'a': 2}
+
+    # Other operations are ignored
+    other = create_session('process_name')
+    watcher._on_event(other.encoded())
+    assert 'process_name' not in watcher.sessions
+
+    watcher.close()
+    assert len(list(watcher.updates())) == 1
+
 
 class TestOCSReply:
     """Test various scenarios in OCSReply decoding. Since the representation
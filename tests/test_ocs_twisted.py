@@ -1,7 +1,10 @@
+import threading
 import time
 import numpy as np
 import pytest
-from ocs.ocs_twisted import Pacemaker
+import pytest_twisted
+from autobahn.twisted.util import sleep as dsleep
+from ocs.ocs_twisted import Pacemaker, ReactorLagMonitor, WorkerPool
 
 
 def test_quantized():
@@ -50,3 +53,64 @@ def test_non_integer_quantization():
     """
     with pytest.raises(ValueError):
         Pacemaker(5.5, quantize=True)
+
+
+@pytest_twisted.inlineCallbacks
+def test_worker_pool_stats():
+    """Test that WorkerPool tracks running and queued jobs."""
+    pool = WorkerPool(1, name='test')
+    release = threading.Event()
+    started = threading.Event()
+
+    def job():
+        started.set()
+        release.wait(5)
+        return threading.current_thread().name
+
+    d1 = pool.defer('first', job)
+    d2 = pool.defer('second', job)
+    started.wait(5)
+    stats = pool.stats()
+    assert stats['busy'] == 1
+    assert stats['utilization'] == 1.
+    assert stats['queued'] == 1
+    assert stats['oldest_queued'] >= 0
+    assert stats['longest_running']['name'] == 'first'
+
+    release.set()
+    names = yield d1
+    yield d2
+    assert 'PoolThread' in names
+    stats = pool.stats()
+    assert stats['busy'] == 0
+    assert stats['queued'] == 0
+    assert stats['jobs_completed'] == 2
+    assert stats['max_queue_wait'] > 0
+    assert stats['longest_running'] is None
+    pool.stop()
+
+
+@pytest_twisted.inlineCallbacks
+def test_reactor_lag_monitor():
+    """Test that ReactorLagMonitor catches code blocking the reactor."""
+    monitor = ReactorLagMonitor(0.01, threshold=0.05)
+    monitor.start()
+    yield dsleep(0.1)
+    assert monitor.stall_count == 0
+
+    time.sleep(0.3)  # Block the reactor
+    yield dsleep(0.05)
+    monitor.stop()
+
+    assert monitor.stall_count == 1
+    stall = monitor.stalls[0]
+    assert stall['lag'] >= 0.25
+    assert 'test_reactor_lag_monitor' in stall['stack']
+
+    stats = monitor.stats()
+    assert stats['max_lag'] == pytest.approx(stall['lag'])
+    assert sum(count for _, count in stats['histogram']) > 5
+    assert stats['histogram'][-3] == [1., 0]
+    window = monitor.window_stats()
+    assert window['max_lag'] == stats['max_lag']
+    assert monitor.window_stats()['count'] == 0
@@ -55,3 +55,31 @@ def password_file(tmp_path_factory):
          'password_2': 'spec-test'},
     ], fn.open('w'))
     return fn
+
+
+def write_hk_file(path, t0, n=10, feed='temps', frames=1, temps=None):
+    """Write an HK file with a single provider and two fields, with n samples
+    in each of the given number of data frames. The 'temp' field of sample i
+    is temps[i], or float(i) if temps isn't given."""
+    # dependent on so3g
+    import so3g
+    from so3g.spt3g import core
+
+    session = so3g.hk.HKSessionHelper(hkagg_version=2)
+    writer = core.G3Writer(path)
+    writer.Process(session.session_frame())
+    prov_id = session.add_provider(f'observatory.fake-agent.feeds.{feed}')
+    writer.Process(session.status_frame())
+
+    for i0 in range(0, n * frames, n):
+        frame = session.data_frame(prov_id)
+        block = core.G3TimesampleMap()
+        block.times = core.G3VectorTime([core.G3Time((t0 + i) * core.G3Units.s)
+                                         for i in range(i0, i0 + n)])
+        block['temp'] = core.G3VectorDouble([float(i) if temps is None else temps[i]
+                                             for i in range(i0, i0 + n)])
+        block['count'] = core.G3VectorInt(list(range(i0, i0 + n)))
+        frame['blocks'].append(block)
+        frame['block_names'].append('temps')
+        writer.Process(frame)
+    del writer